@@ -3,7 +3,6 @@ import os
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
 from utils.early_stopping import EarlyStopping
 import numpy as np
 import copy
@@ -11,16 +10,25 @@ from tqdm import tqdm
 from model.sld import HierarchicalPredictor, NUM_EMO
 from sklearn.metrics import classification_report
 from data.evaluate import load_dev_labels, get_metrics
-import pickle as pkl
 import emoji
 import nltk
 import sys
-from allennlp.modules.elmo import Elmo, batch_to_ids
 from copy import deepcopy
 import argparse
 import random
 from utils.focalloss import FocalLoss
-from utils.tweet_processor import processing_pipeline
+from utils.glove import build_embedding
+from utils.device import get_device, cpu_throughput_mode, inference_mode
+from utils.elmo_cache import ElmoCache
+from utils.checkpoint import save_fold_model, save_training_state, save_fold_result, load_training_state, \
+    restore_training_state, clear_training_state, data_order, run_configuration
+from utils.fold_pool import run_folds
+from utils.shared_memory import share_array, load_shared_state_dict
+from data.reader import iter_conversation_batches
+from data.vocab import build_vocab
+from data.sampler import BucketBatchSampler
+from data.columnar import ColumnarDataSet, RaggedColumn, ElmoColumn, BatchLoader, label_columns
+from collections import OrderedDict
 import json
 from torchmoji.sentence_tokenizer import SentenceTokenizer
 from torchmoji.global_variables import PRETRAINED_PATH, VOCAB_PATH
@@ -54,8 +62,32 @@ parser.add_argument('-dim', default=1500, type=int,
                     help="post name")
 parser.add_argument('-glovepath', type=int,
                     help="please specify the path to a GloVe 300d emb file")
+parser.add_argument('-workers', default=0, type=int,
+                    help="processes used for text preprocessing and TorchMoji tokenization, 0 uses all cores")
+parser.add_argument('-device', default=None, type=str,
+                    help="cpu, cuda or cuda:N, default is cuda when available")
+parser.add_argument('-threads', default=0, type=int,
+                    help="intra-op threads in cpu mode (of each fold process with -foldworkers), 0 keeps the torch default")
+parser.add_argument('-foldworkers', default=1, type=int,
+                    help="folds trained at the same time in separate processes, cpu only")
+parser.add_argument('-elmocache', default='data/elmo_cache', type=str,
+                    help="directory of the precomputed ELMo representations")
+parser.add_argument('-savedir', default='checkpoints/sld', type=str,
+                    help="directory of the fold checkpoints")
+parser.add_argument('-resume', default=0, type=int,
+                    help="1 resumes the interrupted run saved in -savedir, with the same options; 0 starts again")
+parser.add_argument('-bucket', default=1, type=int,
+                    help="1 batches training conversations of similar length together, 0 shuffles them freely")
 opt = parser.parse_args()
 
+DEVICE = get_device(opt.device)
+if DEVICE.type == 'cpu':
+    cpu_throughput_mode(opt.threads)
+elif opt.foldworkers > 1:
+    raise ValueError('Parallel folds (-foldworkers) run on cpu only')
+# pinned memory speeds up the copies of the batches to the gpu
+PIN_MEMORY = DEVICE.type == 'cuda'
+
 
 NUM_OF_FOLD = opt.folds
 learning_rate = opt.lr
@@ -96,9 +128,6 @@ weight_file = "https://s3-us-west-2.amazonaws.com/allennlp/model/elmo/2x4096_512
 # options_file = 'https://s3-us-west-2.amazonaws.com/allennlp/models/elmo/2x4096_512_2048cnn_2xhighway_5.5B/elmo_2x4096_512_2048cnn_2xhighway_5.5B_options.json'
 # weight_file = 'https://s3-us-west-2.amazonaws.com/allennlp/models/elmo/2x4096_512_2048cnn_2xhighway_5.5B/elmo_2x4096_512_2048cnn_2xhighway_5.5B_weights.hdf5'
 
-elmo = Elmo(options_file, weight_file, 2, dropout=0).cuda()
-elmo.eval()
-
 print('Tokenizing using dictionary from {}'.format(VOCAB_PATH))
 with open(VOCAB_PATH, 'r') as f:
     vocabulary = json.load(f)
@@ -112,32 +141,10 @@ def load_data_context(data_path='data/train.txt', is_train=True):
 
     data_list = []
     target_list = []
-    f_data = open(data_path, 'r')
-    data_lines = f_data.readlines()
-    f_data.close()
-
-    for i, text in enumerate(data_lines):
-        # skip the first line
-        if i == 0:
-            continue
-
-        tokens = text.split('\t')
-
-        convers = tokens[1:CONV_PAD_LEN+1]
-
-        # normal preprocessing
-        raw_a = convers[0]
-        raw_b = convers[1]
-        raw_c = convers[2]
-
-        a = processing_pipeline(raw_a)
-        b = processing_pipeline(raw_b)
-        c = processing_pipeline(raw_c)
-
-        data_list.append(a + ' ' + b + ' ' + c)
-        if is_train:
-            emo = tokens[CONV_PAD_LEN + 1].strip()
-            target_list.append(EMOS_DIC[emo])
+    # normal preprocessing, streamed in batches and cached on disk
+    for batch, targets in iter_conversation_batches(data_path, is_train=is_train, workers=opt.workers):
+        data_list.extend(a + ' ' + b + ' ' + c for a, b, c, _, _, _ in batch)
+        target_list.extend(targets)
 
     if is_train:
         return data_list, target_list
@@ -145,80 +152,26 @@ def load_data_context(data_path='data/train.txt', is_train=True):
         return data_list
 
 
-def build_vocab(data_list_list, vocab_size, fill_vocab=False):
-
-    all_str_list = []
-    for data_list in data_list_list:
-        all_str_list.extend(data_list)
-
-    word_count = {}
-    word2id = {}
-    id2word = {}
-    for tokens in all_str_list:
-        for word in tokens.split():
-            if word in word_count:
-                word_count[word] += 1
-            else:
-                word_count[word] = 1
-
-    word_list = [x for x, _ in sorted(word_count.items(), key=lambda v: v[1], reverse=True)]
-    print('found', len(word_count), 'words')
-
-    if len(word_count) < vocab_size:
-        raise Exception('Vocab less than requested!!!')
-
-    # add <pad> first
-    word2id['<pad>'] = 0
-    id2word[0] = '<pad>'
-
-    word2id['<unk>'] = 1
-    id2word[1] = '<unk>'
-    word2id['<empty>'] = 2
-    id2word[2] = '<empty>'
-
-    n = len(word2id)
-    if not fill_vocab:
-        word_list = word_list[:vocab_size - n]
-
-    for word in word_list:
-        word2id[word] = n
-        id2word[n] = word
-        n += 1
-
-    if fill_vocab:
-        print('filling vocab to', len(id2word))
-        return word2id, id2word, len(id2word)
-    return word2id, id2word, len(word2id)
-
-
-class TrainDataSet(Dataset):
-    def __init__(self, data_list, target_list, conv_pad_len, sent_pad_len, word2id, max_size=None, use_unk=False):
+class TrainDataSet(ColumnarDataSet):
+    def __init__(self, data_list, target_list, conv_pad_len, sent_pad_len, word2id, elmo_cache, max_size=None,
+                 use_unk=False):
 
         self.sent_pad_len = sent_pad_len
         self.conv_pad_len = conv_pad_len
         self.word2id = word2id
         self.pad_int = word2id['<pad>']
+        self.elmo_cache = elmo_cache
 
         self.use_unk = use_unk
 
         # set max size for the purpose of testing
         if max_size is not None:
-            self.data = self.data[:max_size]
-            self.target = self.target[:max_size]
+            data_list = data_list[:max_size]
+            target_list = target_list[:max_size]
 
-        # internal data
-        self.a = []
-        self.a_len = []
-        self.emoji_a = []
-
-        self.e_c = []
-        self.e_c_binary = []
-        self.e_c_emo = []
         self.num_empty_lines = 0
-
-        self.weights = []
         # prepare dataset
-        self.read_data(data_list, target_list)
+        super(TrainDataSet, self).__init__(self.read_data(data_list, target_list))
 
     def sent_to_ids(self, text):
         tokens = text.split()
@@ -230,70 +183,38 @@ class TrainDataSet(Dataset):
             tmp = [self.word2id['<empty>']]
             self.num_empty_lines += 1
 
-        # PADDING
-        if len(tmp) > self.sent_pad_len:
-            tmp = tmp[: self.sent_pad_len]
-        text_len = len(tmp)
-
-        tmp = tmp + [self.pad_int] * (self.sent_pad_len - len(tmp))
-
-        return tmp, text_len
+        # cut to sent_pad_len, batches are padded to their longest sentence
+        return tmp[: self.sent_pad_len]
 
     def read_data(self, data_list, target_list):
         assert len(data_list) == len(target_list)
 
-        for X, y in zip(data_list, target_list):
-            clean_a = X
-
-            a, a_len = self.sent_to_ids(clean_a)
-
-            self.a.append(a)
-
-            self.a_len.append(a_len)
-
-            self.emoji_a.append(emoji_st.tokenize_sentences([clean_a])[0].reshape((-1)).astype(np.int64))
-
-            self.e_c.append(int(y))
-            self.e_c_binary.append(1 if int(y) == len(EMOS) - 1 else 0)
-
-            e_c_emo = [0] * (len(EMOS) - 1)
-            if int(y) < len(EMOS) - 1:  # i.e. only first three emotions
-                e_c_emo[int(y)] = 1
-            self.e_c_emo.append(e_c_emo)
-
+        columns, elmo_columns = sentence_columns(data_list, self.sent_to_ids, self.elmo_cache)
         print('num of empty lines,', self.num_empty_lines)
 
-    def __len__(self):
-        return len(self.a)
-
-    def __getitem__(self, idx):
-        return torch.LongTensor(self.a[idx]), torch.LongTensor([self.a_len[idx]]), \
-               torch.LongTensor(self.emoji_a[idx]), \
-               torch.LongTensor([self.e_c[idx]]), torch.LongTensor([self.e_c_binary[idx]]), \
-               torch.FloatTensor(self.e_c_emo[idx])
+        # in the order of the batches
+        columns.update(label_columns(target_list, len(EMOS)))
+        columns.update(elmo_columns)
+        return columns
 
 
-class TestDataSet(Dataset):
-    def __init__(self, data_list, conv_pad_len, sent_pad_len, word2id, id2word, use_unk=False):
+class TestDataSet(ColumnarDataSet):
+    def __init__(self, data_list, conv_pad_len, sent_pad_len, word2id, id2word, elmo_cache, use_unk=False):
 
         self.sent_pad_len = sent_pad_len
         self.conv_pad_len = conv_pad_len
         self.word2id = word2id
         self.pad_int = word2id['<pad>']
+        self.elmo_cache = elmo_cache
 
         self.use_unk = use_unk
 
-        # internal data
-        self.a = []
-        self.a_len = []
-        self.emoji_a = []
-
         self.num_empty_lines = 0
         # prepare dataset
         self.ex_word2id = copy.deepcopy(word2id)
         self.ex_id2word = copy.deepcopy(id2word)
         self.unk_words_idx = set()
-        self.read_data(data_list)
+        super(TestDataSet, self).__init__(self.read_data(data_list))
 
     def sent_to_ids(self, text):
         tokens = text.split()
@@ -305,174 +226,69 @@ class TestDataSet(Dataset):
             tmp = [self.word2id['<empty>']]
             self.num_empty_lines += 1
 
-        # PADDING
-        if len(tmp) > self.sent_pad_len:
-            tmp = tmp[: self.sent_pad_len]
-        text_len = len(tmp)
-
-        tmp = tmp + [self.pad_int] * (self.sent_pad_len - len(tmp))
-
-        return tmp, text_len
+        # cut to sent_pad_len, batches are padded to their longest sentence
+        return tmp[: self.sent_pad_len]
 
     def read_data(self, data_list):
-        for X in data_list:
-            clean_a= X
-
-            a, a_len = self.sent_to_ids(clean_a)
-
-            self.a.append(a)
-
-            self.a_len.append(a_len)
-
-            self.emoji_a.append(emoji_st.tokenize_sentences([clean_a])[0].reshape((-1)).astype(np.int64))
-
-
+        columns, elmo_columns = sentence_columns(data_list, self.sent_to_ids, self.elmo_cache)
         print('num of empty lines,', self.num_empty_lines)
-
-    def __len__(self):
-        return len(self.a)
-
-    def __getitem__(self, idx):
-        return torch.LongTensor(self.a[idx]), torch.LongTensor([self.a_len[idx]]), \
-               torch.LongTensor(self.emoji_a[idx])
+        columns.update(elmo_columns)
+        return columns
 
 
-def build_embedding(id2word, fname, num_of_vocab):
+def sentence_columns(data_list, sent_to_ids, elmo_cache):
     """
-    :param id2word, fname:
-    :return:
+    :return: columns a, a_len, emoji_a and column elmo_a
     """
-    import io
-
-    def load_vectors(fname):
-        print("Loading Glove Model")
-        f = open(fname, 'r', encoding='utf8')
-        model = {}
-        for line in tqdm(f.readlines(), total=2196017):
-            values = line.split(' ')
-            word = values[0]
-            try:
-                embedding = np.array(values[1:], dtype=np.float32)
-                model[word] = embedding
-            except ValueError:
-                print(len(values), values[0])
-
-        print("Done.", len(model), " words loaded!")
-        f.close()
-        return model
-
-    def get_emb(emb_dict, vocab_size, embedding_dim):
-        # emb_dict = load_vectors(fname)
-        all_embs = np.stack(emb_dict.values())
-        emb_mean, emb_std = all_embs.mean(), all_embs.std()
-
-        emb = np.random.normal(emb_mean, emb_std, (vocab_size, embedding_dim))
-
-        # emb = np.zeros((vocab_size, embedding_dim))
-        num_found = 0
-        print('loading glove')
-        for idx in tqdm(range(vocab_size)):
-            word = id2word[idx]
-            if word == '<pad>' or word == '<unk>':
-                emb[idx] = np.zeros([embedding_dim])
-            elif word in emb_dict:
-                emb[idx] = emb_dict[word]
-                num_found += 1
-
-        return emb, num_found
-
-    pkl_path = fname + '.pkl'
-    if not os.path.isfile(pkl_path):
-        print('creating pkl file for the emb text file')
-        emb_dict = load_vectors(fname)
-        with open(pkl_path, 'wb') as f:
-            pkl.dump(emb_dict, f)
-    else:
-        print('loading pkl file')
-        with open(pkl_path, 'rb') as f:
-            emb_dict = pkl.load(f)
-        print('loading finished')
-
-    emb, num_found = get_emb(emb_dict, num_of_vocab, SENT_EMB_DIM)
-
-    print(num_found, 'of', num_of_vocab, 'found', 'coverage', num_found/num_of_vocab)
-
-    return emb
-
-
-def main():
-    num_of_vocab = 10000
+    ids = [sent_to_ids(clean_a) for clean_a in data_list]
+    columns = OrderedDict()
+    columns['a'] = RaggedColumn(ids)
+    columns['a_len'] = columns['a'].lengths().reshape(-1, 1)
+    # uint16, TorchMoji has 50000 tokens. All the sentences in one bulk tokenization, on -workers processes
+    columns['emoji_a'] = emoji_st.tokenize_sentences_bulk(data_list, opt.workers)
+    elmo_columns = OrderedDict([('elmo_a', ElmoColumn(elmo_cache, [elmo_cache.sentence_id(a) for a in ids]))])
+    return columns, elmo_columns
 
-    # load data
-    train_file = 'data/train.txt'
-    data_list, target_list = load_data_context(data_path=train_file)
 
-    # dev set
-    dev_file = 'data/dev.txt'
-    dev_data_list, dev_target_list = load_data_context(data_path=dev_file)
+def elmo_encode(elmo_data, data_len):
+    # cached representations are padded to SENT_PAD_LEN, ELMo outputs the longest sentence of the batch
+    return elmo_data[:, :int(data_len.max())].to(DEVICE).float()
 
-    # test set
-    test_file = 'data/test.txt'
-    test_data_list, test_target_list = load_data_context(data_path=test_file)
-
-    # load final test data
-    final_test_file = 'data/testwithoutlabels.txt'
-    final_test_data_list = load_data_context(data_path=final_test_file, is_train=False)
-
-    # build vocab
-    word2id, id2word, num_of_vocab = build_vocab([data_list, dev_data_list, test_data_list], num_of_vocab,
-                                                 FILL_VOCAB)
-    emb = build_embedding(id2word, GLOVE_EMB_PATH, num_of_vocab)
 
-    gold_dev_data_set = TestDataSet(dev_data_list, CONV_PAD_LEN, SENT_PAD_LEN, word2id, id2word, use_unk=False)
-    gold_dev_data_loader = DataLoader(gold_dev_data_set, batch_size=BATCH_SIZE, shuffle=False)
-    print("Size of test data", len(gold_dev_data_set))
-
-    test_data_set = TestDataSet(test_data_list, CONV_PAD_LEN, SENT_PAD_LEN, word2id, id2word, use_unk=False)
-    test_data_loader = DataLoader(test_data_set, batch_size=BATCH_SIZE, shuffle=False)
-    print("Size of test data", len(test_data_set))
-    # ex_id2word, unk_words_idx = test_data_set.get_ex_id2word_unk_words()
-
-    final_test_data_set = TestDataSet(final_test_data_list, CONV_PAD_LEN, SENT_PAD_LEN, word2id, id2word, use_unk=False)
-    final_test_data_loader = DataLoader(final_test_data_set, batch_size=BATCH_SIZE, shuffle=False)
-    print("Size of final test data", len(final_test_data_set))
-
-    # final_ex_id2word, _ = final_test_data_set.get_ex_id2word_unk_words()
-    def glove_tokenizer(ids, __id2word):
-        return [__id2word[int(x)] for x in ids if x != 0]
-
-    def elmo_encode(data, __id2word=id2word):
-        data_text = [glove_tokenizer(x, __id2word) for x in data]
-        with torch.no_grad():
-            character_ids = batch_to_ids(data_text).cuda()
-            elmo_emb = elmo(character_ids)['elmo_representations']
-            elmo_emb = (elmo_emb[0] + elmo_emb[1]) / 2  # avg of two layers
-        return elmo_emb.cuda()
-
-    X = data_list
-    y = target_list
-    y = np.array(y)
-
-    combined = list(zip(X, y))
-    random.shuffle(combined)
-    X[:], y[:] = zip(*combined)
-
-    # train dev split
-    from sklearn.model_selection import StratifiedKFold
-    skf = StratifiedKFold(n_splits=NUM_OF_FOLD, random_state=0)
-    all_fold_results = []
-    real_test_results = []
+def make_one_fold(context):
+    """
+    Fold training of main, built from what the folds share so that it also runs in the spawned processes
+    of utils/fold_pool.py
+    :param context: dict of the datasets, embeddings and pretrained weights of main
+    :return: function (num_fold, train_index, dev_index) -> predictions of the fold
+    """
+    full_data_set = context['full_data_set']
+    emb = context['emb']
+    pretrained_moji = context['pretrained_moji']
+    num_of_vocab = context['num_of_vocab']
+    model_config = context['model_config']
+    run_config = context['run_config']
+    gold_dev_data_loader = BatchLoader(context['gold_dev_data_set'], batch_size=BATCH_SIZE, pin_memory=PIN_MEMORY)
+    test_data_loader = BatchLoader(context['test_data_set'], batch_size=BATCH_SIZE, pin_memory=PIN_MEMORY)
 
     def one_fold(num_fold, train_index, dev_index):
         print("Training on fold:", num_fold)
-        X_train, X_dev = [X[i] for i in train_index], [X[i] for i in dev_index]
-        y_train, y_dev = y[train_index], y[dev_index]
-
-        # construct data loader
-        train_data_set = TrainDataSet(X_train, y_train, CONV_PAD_LEN, SENT_PAD_LEN, word2id, use_unk=True)
-
-        dev_data_set = TrainDataSet(X_dev, y_dev, CONV_PAD_LEN, SENT_PAD_LEN, word2id, use_unk=True)
-        dev_data_loader = DataLoader(dev_data_set, batch_size=BATCH_SIZE, shuffle=False)
+        state = load_training_state(opt.savedir, num_fold, run_config) if opt.resume == 1 else None
+        if state is not None and state['completed']:
+            print('Fold', num_fold, 'already trained, skipping')
+            return state['predictions']['pred_list_test_best'], state['predictions']['final_pred_best']
+
+        # construct data loader, the folds are views of the training set tokenized once in main
+        train_data_set = full_data_set.subset(train_index)
+
+        dev_data_set = full_data_set.subset(dev_index)
+        dev_data_loader = BatchLoader(dev_data_set, batch_size=BATCH_SIZE, pin_memory=PIN_MEMORY)
+        if opt.bucket == 1:
+            # conversations are batched by their length
+            lengths = train_data_set.column('a_len').reshape(-1)
+            train_batching = {'batch_sampler': BucketBatchSampler(lengths, BATCH_SIZE)}
+        else:
+            train_batching = {'batch_size': BATCH_SIZE, 'shuffle': True}
         # device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
         pred_list_test_best = None
@@ -482,8 +298,8 @@ def main():
             is_diverged = False
             model = HierarchicalPredictor(SENT_EMB_DIM, SENT_HIDDEN_SIZE, num_of_vocab, USE_ELMO=True, ADD_LINEAR=False)
             model.load_embedding(emb)
-            model.deepmoji_model.load_specific_weights(PRETRAINED_PATH, exclude_names=['output_layer'])
-            model.cuda()
+            model.deepmoji_model.load_specific_weights(pretrained_moji, exclude_names=['output_layer'])
+            model.to(DEVICE)
             # model = nn.DataParallel(model)
             # model.to(device)
             optimizer = optim.Adam(model.parameters(), lr=learning_rate, amsgrad=True) #
@@ -497,10 +313,10 @@ def main():
                 weight_list = [0.3198680179, 0.246494733, 0.2484349259, 1.74527696]
                 weight_list_binary = [2 - weight_list[-1], weight_list[-1]]
             weight_list = [x**FLAT for x in weight_list]
-            weight_label = torch.Tensor(weight_list).cuda()
+            weight_label = torch.Tensor(weight_list).to(DEVICE)
 
             weight_list_binary = [x**FLAT for x in weight_list_binary]
-            weight_binary = torch.Tensor(weight_list_binary).cuda()
+            weight_binary = torch.Tensor(weight_list_binary).to(DEVICE)
             print('classification reweight: ', weight_list)
             print('binary loss reweight = weight_list_binary', weight_list_binary)
             # loss_criterion_binary = nn.CrossEntropyLoss(weight=weight_list_binary)  #
@@ -518,9 +334,17 @@ def main():
             # best_model = None
             final_pred_list_test = None
             pred_list_test = None
-            for num_epoch in range(MAX_EPOCH):
+            start_epoch = 0
+            if state is not None:
+                start_epoch = restore_training_state(state, model, optimizer, scheduler, es)
+                pred_list_test_best = state['predictions']['pred_list_test_best']
+                final_pred_best = state['predictions']['final_pred_best']
+                pred_list_test = state['predictions']['pred_list_test']
+                final_pred_list_test = state['predictions']['final_pred_list_test']
+                state = None
+            for num_epoch in range(start_epoch, MAX_EPOCH):
                 # to ensure shuffle at ever epoch
-                train_data_loader = DataLoader(train_data_set, batch_size=BATCH_SIZE, shuffle=True)
+                train_data_loader = BatchLoader(train_data_set, pin_memory=PIN_MEMORY, **train_batching)
 
                 print('Begin training epoch:', num_epoch, end='...\t')
                 sys.stdout.flush()
@@ -531,26 +355,26 @@ def main():
 
                 train_loss = 0
                 model.train()
-                for i, (a, a_len, emoji_a, e_c, e_c_binary, e_c_emo) \
+                for i, (a, a_len, emoji_a, e_c, e_c_binary, e_c_emo, elmo_a) \
                         in tqdm(enumerate(train_data_loader), total=len(train_data_set)/BATCH_SIZE):
                     optimizer.zero_grad()
-                    elmo_a = elmo_encode(a)
+                    elmo_a = elmo_encode(elmo_a, a_len)
 
-                    pred, pred2, pred3 = model(a.cuda(), a_len, emoji_a.cuda(), elmo_a)
+                    pred, pred2, pred3 = model(a.to(DEVICE), a_len, emoji_a.to(DEVICE), elmo_a)
 
-                    loss_label = loss_criterion(pred, e_c.view(-1).cuda()).cuda()
-                    loss_label = torch.matmul(torch.gather(weight_label, 0, e_c.view(-1).cuda()), loss_label) / \
+                    loss_label = loss_criterion(pred, e_c.view(-1).to(DEVICE)).to(DEVICE)
+                    loss_label = torch.matmul(torch.gather(weight_label, 0, e_c.view(-1).to(DEVICE)), loss_label) / \
                                  e_c.view(-1).shape[0]
 
-                    loss_binary = loss_criterion_binary(pred2, e_c_binary.view(-1).cuda()).cuda()
-                    loss_binary = torch.matmul(torch.gather(weight_binary, 0, e_c_binary.view(-1).cuda()),
+                    loss_binary = loss_criterion_binary(pred2, e_c_binary.view(-1).to(DEVICE)).to(DEVICE)
+                    loss_binary = torch.matmul(torch.gather(weight_binary, 0, e_c_binary.view(-1).to(DEVICE)),
                                                loss_binary) / e_c.view(-1).shape[0]
 
-                    loss_emo = loss_criterion_emo_only(pred3, e_c_emo.cuda())
+                    loss_emo = loss_criterion_emo_only(pred3, e_c_emo.to(DEVICE))
 
                     loss = (loss_label + LAMBDA1 * loss_binary + LAMBDA2 * loss_emo) / float(1 + LAMBDA1 + LAMBDA2)
 
-                    # loss = torch.matmul(torch.gather(weight, 0, trg.view(-1).cuda()), loss) / trg.view(-1).shape[0]
+                    # loss = torch.matmul(torch.gather(weight, 0, trg.view(-1).to(DEVICE)), loss) / trg.view(-1).shape[0]
 
                     # training trilogy
                     loss.backward()
@@ -565,20 +389,20 @@ def main():
                 dev_loss = 0
                 # pred_list = []
                 # gold_list = []
-                for i, (a, a_len, emoji_a, e_c, e_c_binary, e_c_emo) \
+                for i, (a, a_len, emoji_a, e_c, e_c_binary, e_c_emo, elmo_a) \
                         in enumerate(dev_data_loader):
-                    with torch.no_grad():
-                        elmo_a = elmo_encode(a)
+                    with inference_mode():
+                        elmo_a = elmo_encode(elmo_a, a_len)
 
-                        pred, pred2, pred3 = model(a.cuda(), a_len, emoji_a.cuda(), elmo_a)
+                        pred, pred2, pred3 = model(a.to(DEVICE), a_len, emoji_a.to(DEVICE), elmo_a)
 
-                        loss_label = loss_criterion(pred, e_c.view(-1).cuda()).cuda()
-                        loss_label = torch.matmul(torch.gather(weight_label, 0, e_c.view(-1).cuda()), loss_label) / e_c.view(-1).shape[0]
+                        loss_label = loss_criterion(pred, e_c.view(-1).to(DEVICE)).to(DEVICE)
+                        loss_label = torch.matmul(torch.gather(weight_label, 0, e_c.view(-1).to(DEVICE)), loss_label) / e_c.view(-1).shape[0]
 
-                        loss_binary = loss_criterion_binary(pred2, e_c_binary.view(-1).cuda()).cuda()
-                        loss_binary = torch.matmul(torch.gather(weight_binary, 0, e_c_binary.view(-1).cuda()), loss_binary) / e_c.view(-1).shape[0]
+                        loss_binary = loss_criterion_binary(pred2, e_c_binary.view(-1).to(DEVICE)).to(DEVICE)
+                        loss_binary = torch.matmul(torch.gather(weight_binary, 0, e_c_binary.view(-1).to(DEVICE)), loss_binary) / e_c.view(-1).shape[0]
 
-                        loss_emo = loss_criterion_emo_only(pred3, e_c_emo.cuda())
+                        loss_emo = loss_criterion_emo_only(pred3, e_c_emo.to(DEVICE))
 
                         loss = (loss_label + LAMBDA1 * loss_binary + LAMBDA2 * loss_emo) / float(1 + LAMBDA1 + LAMBDA2)
 
@@ -603,6 +427,7 @@ def main():
                 else:
                     if es.is_best():
                         print('saving best model ...')
+                        save_fold_model(opt.savedir, num_fold, model, model_config)
                         if final_pred_best is not None:
                             del final_pred_best
                         final_pred_best = deepcopy(final_pred_list_test)
@@ -612,6 +437,8 @@ def main():
                     else:
                         print('not best model, ignoring ...')
                         if final_pred_best is None:
+                            # first epoch, the early stopping reference
+                            save_fold_model(opt.savedir, num_fold, model, model_config)
                             final_pred_best = deepcopy(final_pred_list_test)
                         if pred_list_test_best is None:
                             pred_list_test_best = deepcopy(pred_list_test)
@@ -620,11 +447,11 @@ def main():
                 print('Gold Dev testing....')
                 pred_list_test = []
                 model.eval()
-                for i, (a, a_len, emoji_a) in enumerate(gold_dev_data_loader):
-                    with torch.no_grad():
-                        elmo_a = elmo_encode(a)  # , __id2word=ex_id2word
+                for i, (a, a_len, emoji_a, elmo_a) in enumerate(gold_dev_data_loader):
+                    with inference_mode():
+                        elmo_a = elmo_encode(elmo_a, a_len)
 
-                        pred, _, _ = model(a.cuda(), a_len, emoji_a.cuda(), elmo_a)
+                        pred, _, _ = model(a.to(DEVICE), a_len, emoji_a.to(DEVICE), elmo_a)
 
                         pred_list_test.append(pred.data.cpu().numpy())
                     del elmo_a, a, pred
@@ -635,34 +462,118 @@ def main():
                 print('Gold test testing...')
                 final_pred_list_test = []
                 model.eval()
-                for i, (a, a_len, emoji_a) in enumerate(test_data_loader):
-                    with torch.no_grad():
-                        elmo_a = elmo_encode(a)  # , __id2word=ex_id2word
+                for i, (a, a_len, emoji_a, elmo_a) in enumerate(test_data_loader):
+                    with inference_mode():
+                        elmo_a = elmo_encode(elmo_a, a_len)
 
-                        pred, _, _ = model(a.cuda(), a_len, emoji_a.cuda(), elmo_a)
+                        pred, _, _ = model(a.to(DEVICE), a_len, emoji_a.to(DEVICE), elmo_a)
 
                         final_pred_list_test.append(pred.data.cpu().numpy())
                     del elmo_a, a, pred
                 final_pred_list_test = np.argmax(np.concatenate(final_pred_list_test, axis=0), axis=1)
                 # get_metrics(load_dev_labels('data/test.txt'), final_pred_list_test)
 
+                save_training_state(opt.savedir, num_fold, num_epoch, model, optimizer, scheduler, es,
+                                    {'pred_list_test_best': pred_list_test_best, 'final_pred_best': final_pred_best,
+                                     'pred_list_test': pred_list_test, 'final_pred_list_test': final_pred_list_test},
+                                    run_config)
+
             if is_diverged:
                 print("Reinitialize model ...")
+                clear_training_state(opt.savedir, num_fold)
                 del model
                 continue
 
-            all_fold_results.append(pred_list_test_best)
-            real_test_results.append(final_pred_best)
+            save_fold_result(opt.savedir, num_fold, {'pred_list_test_best': pred_list_test_best,
+                                                     'final_pred_best': final_pred_best}, run_config)
             del model
-            break
+            return pred_list_test_best, final_pred_best
+
+    return one_fold
+
+
+def main():
+    num_of_vocab = 10000
+
+    # load data
+    train_file = 'data/train.txt'
+    data_list, target_list = load_data_context(data_path=train_file)
+
+    # dev set
+    dev_file = 'data/dev.txt'
+    dev_data_list, dev_target_list = load_data_context(data_path=dev_file)
+
+    # test set
+    test_file = 'data/test.txt'
+    test_data_list, test_target_list = load_data_context(data_path=test_file)
+
+    # load final test data
+    final_test_file = 'data/testwithoutlabels.txt'
+    final_test_data_list = load_data_context(data_path=final_test_file, is_train=False)
+
+    # build vocab
+    word2id, id2word, num_of_vocab = build_vocab([data_list, dev_data_list, test_data_list], num_of_vocab,
+                                                 FILL_VOCAB)
+    # read-only, in shared memory for the fold processes
+    emb = share_array(build_embedding(id2word, GLOVE_EMB_PATH, num_of_vocab, SENT_EMB_DIM))
+    pretrained_moji = load_shared_state_dict(PRETRAINED_PATH)
+    elmo_cache = ElmoCache(opt.elmocache, id2word, options_file, weight_file)
+    # saved with the weights of every fold, for inference
+    model_config = {'model': 'sld', 'embedding_dim': SENT_EMB_DIM, 'hidden_dim': SENT_HIDDEN_SIZE,
+                    'vocab_size': num_of_vocab, 'add_linear': False, 'sent_pad_len': SENT_PAD_LEN,
+                    'emoji_pad_len': EMOJ_SENT_PAD_LEN, 'id2word': [id2word[i] for i in range(num_of_vocab)],
+                    'elmo_options_file': options_file, 'elmo_weight_file': weight_file}
+
+    gold_dev_data_set = TestDataSet(dev_data_list, CONV_PAD_LEN, SENT_PAD_LEN, word2id, id2word, elmo_cache,
+                                    use_unk=False)
+    print("Size of test data", len(gold_dev_data_set))
+
+    test_data_set = TestDataSet(test_data_list, CONV_PAD_LEN, SENT_PAD_LEN, word2id, id2word, elmo_cache,
+                                use_unk=False)
+    print("Size of test data", len(test_data_set))
+    # ex_id2word, unk_words_idx = test_data_set.get_ex_id2word_unk_words()
+
+    final_test_data_set = TestDataSet(final_test_data_list, CONV_PAD_LEN, SENT_PAD_LEN, word2id, id2word, elmo_cache,
+                                      use_unk=False)
+    final_test_data_loader = BatchLoader(final_test_data_set, batch_size=BATCH_SIZE, pin_memory=PIN_MEMORY)
+    print("Size of final test data", len(final_test_data_set))
+
+    # final_ex_id2word, _ = final_test_data_set.get_ex_id2word_unk_words()
+    # offline ELMo pass over the test sets, only sentences missing from the cache are computed
+    elmo_cache.build(DEVICE)
+
+    X = data_list
+    y = target_list
+    y = np.array(y)
+
+    order = list(range(len(X)))
+    random.shuffle(order)
+    # an interrupted run is resumed on the same folds, only by a run with the same configuration
+    run_config = run_configuration(opt, model_config)
+    order = data_order(opt.savedir, order, run_config, opt.resume == 1)
+    X[:] = [X[i] for i in order]
+    y = y[order]
+
+    # train dev split
+    from sklearn.model_selection import StratifiedKFold
+    skf = StratifiedKFold(n_splits=NUM_OF_FOLD, random_state=0)
 
     if torch.cuda.device_count() > 1:
         print("Let's use", torch.cuda.device_count(), "GPUs!")
 
-    # Training the folds
-    for idx, (_train_index, _dev_index) in enumerate(skf.split(X, y)):
-        print('Train size:', len(_train_index), 'Dev size:', len(_dev_index))
-        one_fold(idx, _train_index, _dev_index)
+    # the whole training set is tokenized once, the folds only index it. Its ELMo is computed before the
+    # folds, which then only read the cache and can run in parallel
+    full_data_set = TrainDataSet(X, y, CONV_PAD_LEN, SENT_PAD_LEN, word2id, elmo_cache, use_unk=True)
+    elmo_cache.build(DEVICE)
+
+    # what the folds share, sent to every fold process
+    context = {'full_data_set': full_data_set, 'emb': emb, 'pretrained_moji': pretrained_moji,
+               'num_of_vocab': num_of_vocab, 'model_config': model_config, 'run_config': run_config,
+               'gold_dev_data_set': gold_dev_data_set, 'test_data_set': test_data_set}
+    # Training the folds, -foldworkers of them at a time
+    fold_results = run_folds(make_one_fold, context, skf.split(X, y), opt.foldworkers, opt.threads)
+    all_fold_results = [pred_list_test_best for pred_list_test_best, _ in fold_results]
+    real_test_results = [final_pred_best for _, final_pred_best in fold_results]
 
     # Function of majority voting
     def find_majority(k):
@@ -716,4 +627,5 @@ def main():
     print('I am SLD :)))) Final testing')
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+    Columnar datasets. Every field of a split is stored once in contiguous numpy arrays: fixed size fields
+    (lengths, labels, TorchMoji ids) as (N, ...) matrices, variable length ones (token ids) as the values of
+    all the items back to back with the offset of each item. A batch is a single fancy-index gather per
+    column, zero padded to its longest item, and a subset (e.g. a fold) is only an index array into the
+    same columns.
+"""
+from collections import OrderedDict
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler
+
+
+def gather_rows(values, offsets, index):
+    """
+    :param values: rows back to back along the first dimension, may be a memory map
+    :param offsets: int64 (num_rows + 1), start of each row in values
+    :param index: int array of the rows to gather
+    :return: array (len(index), longest row, ...) zero padded after the end of every row
+    """
+    starts = offsets[index]
+    lengths = offsets[index + 1] - starts
+    max_len = int(lengths.max()) if len(index) > 0 else 0
+    steps = np.arange(max_len)
+    mask = steps[None, :] < lengths[:, None]
+    out = values[np.where(mask, starts[:, None] + steps[None, :], 0)]
+    out[~mask] = 0
+    return out
+
+
+class RaggedColumn(object):
+    """
+    Variable length rows, e.g. the token ids of the sentences
+    """
+    __slots__ = ('values', 'offsets')
+
+    def __init__(self, rows, dtype=np.int32):
+        """
+        :param rows: list of 1d arrays or lists
+        """
+        lengths = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+        self.offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.values = np.zeros(int(self.offsets[-1]), dtype=dtype)
+        for row, start, end in zip(rows, self.offsets[:-1], self.offsets[1:]):
+            self.values[start:end] = row
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def gather(self, index):
+        return gather_rows(self.values, self.offsets, index)
+
+
+class ElmoColumn(object):
+    """
+    ELMo vectors of the sentences, gathered from the store of utils.elmo_cache.ElmoCache by sentence id.
+    The store is read at gather time, so the column can be built before ElmoCache.build.
+    """
+    __slots__ = ('elmo_cache', 'ids')
+
+    def __init__(self, elmo_cache, ids):
+        self.elmo_cache = elmo_cache
+        self.ids = np.asarray(ids, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def gather(self, index):
+        return gather_rows(self.elmo_cache.vectors, self.elmo_cache.offsets, self.ids[index])
+
+
+def _gather(column, index):
+    if isinstance(column, np.ndarray):
+        return column[index]
+    return column.gather(index)
+
+
+class ColumnarDataSet(object):
+    def __init__(self, columns, index=None):
+        """
+        :param columns: OrderedDict name -> numpy array (N, ...), RaggedColumn or ElmoColumn, in the order
+                        of the batch tuples
+        :param index: items of the columns in this dataset, all of them by default
+        """
+        self.columns = columns
+        if index is None:
+            index = np.arange(len(next(iter(columns.values()))))
+        self.index = np.asarray(index, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, index):
+        """
+        :param index: positions in this dataset
+        :return: tuple of batch tensors, one per column; integers are given as int64
+        """
+        index = self.index[np.atleast_1d(index)]
+        batch = []
+        for column in self.columns.values():
+            values = _gather(column, index)
+            if values.dtype.kind in 'iub':
+                values = values.astype(np.int64, copy=False)
+            batch.append(torch.from_numpy(values))
+        return tuple(batch)
+
+    def subset(self, index):
+        """
+        :param index: positions in this dataset
+        :return: dataset of these items, sharing the columns
+        """
+        return ColumnarDataSet(self.columns, self.index[index])
+
+    def column(self, name):
+        """
+        :return: the rows of this dataset in a fixed size column
+        """
+        return self.columns[name][self.index]
+
+    def row_lengths(self, name):
+        """
+        :return: the lengths of the rows of this dataset in a RaggedColumn
+        """
+        return self.columns[name].lengths()[self.index]
+
+
+class BatchLoader(object):
+    def __init__(self, data_set, batch_size=1, shuffle=False, batch_sampler=None, pin_memory=False):
+        """
+        Batches of a ColumnarDataSet, one gather per batch, in place of a DataLoader whose per-item fetch and
+        collate the columns avoid. The arguments mean the same as for DataLoader.
+        """
+        self.data_set = data_set
+        if batch_sampler is None:
+            items = range(len(data_set))
+            sampler = RandomSampler(items) if shuffle else SequentialSampler(items)
+            batch_sampler = BatchSampler(sampler, batch_size, drop_last=False)
+        self.batch_sampler = batch_sampler
+        self.pin_memory = pin_memory
+
+    def __iter__(self):
+        for index in self.batch_sampler:
+            batch = self.data_set[np.asarray(index, dtype=np.int64)]
+            if self.pin_memory:
+                batch = tuple(tensor.pin_memory() for tensor in batch)
+            yield batch
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+def label_columns(target_list, num_emo):
+    """
+    Label columns of the trainers: e_c (N, 1), e_c_binary (N, 1), 1 for the last class ('others'),
+    and e_c_emo (N, num_emo - 1), one-hot over the emotional classes only
+    """
+    e_c = np.asarray(target_list, dtype=np.int64).reshape(-1, 1)
+    e_c_emo = np.zeros((len(e_c), num_emo - 1), dtype=np.float32)
+    emotional = np.flatnonzero(e_c[:, 0] < num_emo - 1)
+    e_c_emo[emotional, e_c[emotional, 0]] = 1
+    return OrderedDict([('e_c', e_c), ('e_c_binary', (e_c == num_emo - 1).astype(np.int64)), ('e_c_emo', e_c_emo)])
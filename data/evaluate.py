@@ -9,22 +9,21 @@ EMOS_DIC = {'happy': 0,
 NUM_EMO = len(EMOS)
 
 
-def load_dev_labels(data_path='data/dev.txt'):
+def iter_dev_labels(data_path='data/dev.txt'):
     # data_path = 'data/train.txt'
     CONV_PAD_LEN = 3
-    target_list = []
-    f_data = open(data_path, 'r', encoding='utf8')
-    data_lines = f_data.readlines()
-    f_data.close()
-
-    for i, text in enumerate(data_lines):
+    with open(data_path, 'r', encoding='utf8') as f_data:
         # Ignore the first line as it is the name of the columns
-        if i == 0:
-            continue
-        tokens = text.split('\t')
-        emo = tokens[CONV_PAD_LEN + 1].strip()
-        target_list.append(EMOS_DIC[emo])
-    return np.asarray(target_list)
+        next(f_data, None)
+        for text in f_data:
+            tokens = text.split('\t')
+            emo = tokens[CONV_PAD_LEN + 1].strip()
+            yield EMOS_DIC[emo]
+
+
+def load_dev_labels(data_path='data/dev.txt'):
+    # streamed line by line, only the label array is kept in memory
+    return np.fromiter(iter_dev_labels(data_path), dtype=np.int64)
 
 
 def to_categorical(vec):
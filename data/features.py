@@ -0,0 +1,159 @@
+"""
+    Padded model inputs of whole files of conversations, for export checks and batch inference.
+    They follow the test datasets of the trainers, so exported or reloaded models see the same ids
+    as during training.
+"""
+import numpy as np
+import torch
+from data.reader import CONV_PAD_LEN
+
+
+def pad_ids(ids, pad_len, pad_int=0):
+    """
+    :return: ids cut or padded to pad_len, length before padding
+    """
+    ids = ids[:pad_len]
+    return ids + [pad_int] * (pad_len - len(ids)), len(ids)
+
+
+def sent_to_ids(text, word2id, sent_pad_len, use_unk=False):
+    """
+    Glove ids of a cleaned sentence, as sent_to_ids of the trainer datasets
+    :return: padded ids, length, whether the sentence had no known word
+    """
+    if use_unk:
+        ids = [word2id.get(x, word2id['<unk>']) for x in text.split()]
+    else:
+        ids = [word2id[x] for x in text.split() if x in word2id]
+    is_empty = len(ids) == 0
+    if is_empty:
+        ids = [word2id['<empty>']]
+    ids, length = pad_ids(ids, sent_pad_len, word2id['<pad>'])
+    return ids, length, is_empty
+
+
+class HRLCEInputs(object):
+    def __init__(self, data_list, word2id, elmo_cache, emoji_tokenize_many, sent_pad_len=30, use_unk=False):
+        """
+        :param data_list: (a, b, c, raw_a, raw_b, raw_c) tuples, as given by data.reader
+        :param elmo_cache: utils.elmo_cache.ElmoCache, the sentences are registered here and served
+                           after elmo_cache.build()
+        :param emoji_tokenize_many: function from a list of cleaned turns to their padded TorchMoji ids,
+                                    one row per turn, e.g. SentenceTokenizer.tokenize_sentences_bulk
+        """
+        self.elmo_cache = elmo_cache
+        self.sent_pad_len = sent_pad_len
+        num_conv = len(data_list)
+
+        self.turns = np.zeros((num_conv, CONV_PAD_LEN, sent_pad_len), dtype=np.int64)
+        self.lengths = np.zeros((num_conv, CONV_PAD_LEN), dtype=np.int64)
+        self.elmo_ids = np.zeros((num_conv, CONV_PAD_LEN), dtype=np.int64)
+        self.num_empty_lines = 0
+
+        for i, conv in enumerate(data_list):
+            for j, text in enumerate(conv[:CONV_PAD_LEN]):
+                ids, self.lengths[i, j], is_empty = sent_to_ids(text, word2id, sent_pad_len, use_unk)
+                self.num_empty_lines += is_empty
+                self.turns[i, j] = ids
+                self.elmo_ids[i, j] = elmo_cache.sentence_id(ids)
+        # all the turns in one call
+        emoji = emoji_tokenize_many([text for conv in data_list for text in conv[:CONV_PAD_LEN]])
+        self.emoji = np.asarray(emoji, dtype=np.int64).reshape(num_conv, CONV_PAD_LEN, -1)
+
+    def __len__(self):
+        return self.turns.shape[0]
+
+    def batch(self, start, end):
+        """
+        Conversations start:end, in the order of HierarchicalPredictor.forward
+        """
+        inputs = []
+        for j in range(CONV_PAD_LEN):
+            inputs.append(torch.from_numpy(self.turns[start:end, j]))
+            inputs.append(torch.from_numpy(self.lengths[start:end, j:j + 1]))
+        for j in range(CONV_PAD_LEN):
+            inputs.append(torch.from_numpy(self.emoji[start:end, j]))
+        for j in range(CONV_PAD_LEN):
+            inputs.append(torch.from_numpy(np.stack(
+                [self.elmo_cache.get(sid, self.sent_pad_len) for sid in self.elmo_ids[start:end, j]])).float())
+        return tuple(inputs)
+
+    def batches(self, batch_size):
+        return [self.batch(i, min(i + batch_size, len(self))) for i in range(0, len(self), batch_size)]
+
+
+class SentenceInputs(object):
+    def __init__(self, sentences, word2id, elmo_cache, emoji_tokenize_many, sent_pad_len=30, use_unk=False):
+        """
+        Inputs of the single sentence baselines (model/sl.py, model/sld.py), the turns joined by spaces
+        :param sentences: cleaned sentences
+        :param elmo_cache, emoji_tokenize_many: see HRLCEInputs
+        """
+        self.elmo_cache = elmo_cache
+        self.sent_pad_len = sent_pad_len
+        num_sent = len(sentences)
+
+        self.tokens = np.zeros((num_sent, sent_pad_len), dtype=np.int64)
+        self.lengths = np.zeros((num_sent, 1), dtype=np.int64)
+        self.elmo_ids = np.zeros(num_sent, dtype=np.int64)
+        self.num_empty_lines = 0
+
+        for i, text in enumerate(sentences):
+            ids, self.lengths[i, 0], is_empty = sent_to_ids(text, word2id, sent_pad_len, use_unk)
+            self.num_empty_lines += is_empty
+            self.tokens[i] = ids
+            self.elmo_ids[i] = elmo_cache.sentence_id(ids)
+        self.emoji = np.asarray(emoji_tokenize_many(sentences), dtype=np.int64).reshape(num_sent, -1)
+
+    def __len__(self):
+        return self.tokens.shape[0]
+
+    def batch(self, start, end):
+        """
+        Sentences start:end, in the order of HierarchicalPredictor.forward of model/sl.py and model/sld.py
+        """
+        elmo = np.stack([self.elmo_cache.get(sid, self.sent_pad_len) for sid in self.elmo_ids[start:end]])
+        return torch.from_numpy(self.tokens[start:end]), torch.from_numpy(self.lengths[start:end]), \
+            torch.from_numpy(self.emoji[start:end]), torch.from_numpy(elmo).float()
+
+    def batches(self, batch_size):
+        return [self.batch(i, min(i + batch_size, len(self))) for i in range(0, len(self), batch_size)]
+
+
+class BertInputs(object):
+    def __init__(self, data_list, tokenizer, sent_pad_len=30, use_token_type=True):
+        """
+        :param data_list: (a, b, c, raw_a, raw_b, raw_c) tuples, as given by data.reader
+        :param tokenizer: pytorch_pretrained_bert BertTokenizer
+        :param use_token_type: False gives all zero segments, as calling the model without token_type_ids
+        """
+        num_conv = len(data_list)
+        self.tokens = np.zeros((num_conv, sent_pad_len), dtype=np.int64)
+        self.masks = np.zeros((num_conv, sent_pad_len), dtype=np.int64)
+        self.segments = np.zeros((num_conv, sent_pad_len), dtype=np.int64)
+
+        for i, conv in enumerate(data_list):
+            a, b, c = [tokenizer.tokenize(text) for text in conv[:CONV_PAD_LEN]]
+            a = tokenizer.convert_tokens_to_ids(['[CLS]'] + a + ['[SEP]'])
+            b = tokenizer.convert_tokens_to_ids(b + ['[SEP]'])
+            c = tokenizer.convert_tokens_to_ids(c + ['[SEP]'])
+
+            tokens, length = pad_ids(a + b + c, sent_pad_len)
+            self.tokens[i] = tokens
+            self.masks[i, :length] = 1
+            if use_token_type:
+                segments, _ = pad_ids([0] * (len(a) + len(b) - 1) + [1] * (len(c) + 1), sent_pad_len)
+                self.segments[i] = segments
+
+    def __len__(self):
+        return self.tokens.shape[0]
+
+    def batch(self, start, end):
+        """
+        Conversations start:end, in the order of BERT_classifer.forward
+        """
+        return torch.from_numpy(self.tokens[start:end]), torch.from_numpy(self.masks[start:end]), \
+            torch.from_numpy(self.segments[start:end])
+
+    def batches(self, batch_size):
+        return [self.batch(i, min(i + batch_size, len(self))) for i in range(0, len(self), batch_size)]
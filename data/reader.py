@@ -0,0 +1,73 @@
+"""
+    Streaming reader for the EmoContext tsv files: id, turn1, turn2, turn3 and, for labelled files, the label.
+    Lines are parsed and preprocessed in batches, so memory stays bounded by the batch size
+    and arbitrarily large conversation dumps can be fed to batch inference.
+"""
+from itertools import islice
+from data.evaluate import EMOS_DIC
+from utils.tweet_processor import processing_pipeline_many, PipelinePool, PreprocessCache, PREPROCESS_CACHE_PATH
+
+CONV_PAD_LEN = 3
+
+
+def iter_conversation_lines(data_path, is_train=True):
+    """
+    Parse the file one line at a time, without preprocessing.
+    :return: generator of (raw turns list, label id or None)
+    """
+    with open(data_path, 'r', encoding='utf8') as f_data:
+        # skip the first line, it is the name of the columns
+        next(f_data, None)
+        for text in f_data:
+            tokens = text.split('\t')
+            convers = tokens[1:CONV_PAD_LEN + 1]
+            emo = EMOS_DIC[tokens[CONV_PAD_LEN + 1].strip()] if is_train else None
+            yield convers, emo
+
+
+def iter_conversation_batches(data_path, batch_size=10000, is_train=True,
+                              cache_path=PREPROCESS_CACHE_PATH, workers=1):
+    """
+    Read and preprocess the file in batches of conversations.
+    :param cache_path, workers: see utils.tweet_processor.processing_pipeline_many
+    :return: generator of (data_list, target_list), data_list holds (a, b, c, raw_a, raw_b, raw_c)
+             tuples and target_list is empty when is_train is False
+    """
+    lines = iter_conversation_lines(data_path, is_train)
+    # one cache connection and one pool for all the batches of the file, the pool is only started by the
+    # first batch with texts missing from the cache
+    cache = PreprocessCache(cache_path) if cache_path is not None else None
+    pool = PipelinePool(workers)
+    try:
+        while True:
+            batch = list(islice(lines, batch_size))
+            if len(batch) == 0:
+                break
+
+            clean_list = processing_pipeline_many([raw for convers, _ in batch for raw in convers],
+                                                  workers=workers, cache=cache, pool=pool)
+            data_list = []
+            target_list = []
+            for i, (convers, emo) in enumerate(batch):
+                a, b, c = clean_list[CONV_PAD_LEN * i: CONV_PAD_LEN * (i + 1)]
+                data_list.append((a, b, c, convers[0], convers[1], convers[2]))
+                if is_train:
+                    target_list.append(emo)
+            yield data_list, target_list
+    finally:
+        pool.close()
+        if cache is not None:
+            cache.close()
+
+
+def load_conversations(data_path, is_train=True, workers=1):
+    """
+    Read and preprocess a whole file.
+    :return: data_list, target_list, as concatenated from iter_conversation_batches
+    """
+    data_list = []
+    target_list = []
+    for batch, targets in iter_conversation_batches(data_path, is_train=is_train, workers=workers):
+        data_list.extend(batch)
+        target_list.extend(targets)
+    return data_list, target_list
@@ -0,0 +1,40 @@
+"""
+    Length-bucketed batching. With plain shuffling most batches hold at least one long conversation, so the
+    LSTMs run for the whole padding length and BERT attends over all -padlen positions. Batching items of
+    similar length together, with batches padded to their longest item (data/columnar.py), makes the compute
+    follow the real number of tokens.
+"""
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+# batches sorted together, a larger bucket gives tighter batches but less random ones
+BUCKET_BATCHES = 50
+
+
+class BucketBatchSampler(Sampler):
+    def __init__(self, lengths, batch_size, bucket_batches=BUCKET_BATCHES):
+        """
+        Every epoch the items are shuffled, cut into buckets of bucket_batches * batch_size items, sorted by
+        length inside each bucket and split into batches; the batches are then shuffled.
+        To be given to BatchLoader (data/columnar.py) as batch_sampler.
+        :param lengths: length of every item of the dataset (e.g. longest turn, number of BERT tokens)
+        """
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_batches
+
+    def __iter__(self):
+        num_items = len(self.lengths)
+        # torch generator, so torch.manual_seed fixes the batches as it fixes a shuffled DataLoader
+        order = torch.randperm(num_items).numpy()
+        batches = []
+        for start in range(0, num_items, self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='mergesort')]
+            batches.extend(bucket[i:i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size))
+        for i in torch.randperm(len(batches)).tolist():
+            yield batches[i]
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
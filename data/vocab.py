@@ -0,0 +1,60 @@
+"""
+    Word vocabulary of the glove based models. The trainers and the export/inference scripts build it from the
+    same files, so that the ids match the embedding matrix of a trained model.
+"""
+from data.reader import CONV_PAD_LEN
+
+
+def build_vocab(data_list_list, vocab_size, fill_vocab=False):
+    """
+    :param data_list_list: lists of conversations ((a, b, c, ...) tuples) or of single sentences
+    :param vocab_size: number of ids, including <pad>, <unk> and <empty>
+    :param fill_vocab: keep every word found, whatever vocab_size is
+    :return: word2id, id2word, number of ids
+    """
+    all_str_list = []
+    for data_list in data_list_list:
+        for data in data_list:
+            if isinstance(data, str):
+                all_str_list.append(data)
+            else:
+                all_str_list.extend(data[:CONV_PAD_LEN])
+
+    word_count = {}
+    word2id = {}
+    id2word = {}
+    for tokens in all_str_list:
+        for word in tokens.split():
+            if word in word_count:
+                word_count[word] += 1
+            else:
+                word_count[word] = 1
+
+    word_list = [x for x, _ in sorted(word_count.items(), key=lambda v: v[1], reverse=True)]
+    print('found', len(word_count), 'words')
+
+    if len(word_count) < vocab_size:
+        raise Exception('Vocab less than requested!!!')
+
+    # add <pad> first
+    word2id['<pad>'] = 0
+    id2word[0] = '<pad>'
+
+    word2id['<unk>'] = 1
+    id2word[1] = '<unk>'
+    word2id['<empty>'] = 2
+    id2word[2] = '<empty>'
+
+    n = len(word2id)
+    if not fill_vocab:
+        word_list = word_list[:vocab_size - n]
+
+    for word in word_list:
+        word2id[word] = n
+        id2word[n] = word
+        n += 1
+
+    if fill_vocab:
+        print('filling vocab to', len(id2word))
+        return word2id, id2word, len(id2word)
+    return word2id, id2word, len(word2id)
@@ -0,0 +1,120 @@
+"""
+    Export a trained HRLCE model (fold checkpoint of trainer_hrlce.py, or state dict of HierarchicalPredictor)
+    into a single TorchScript file, which serving processes load with torch.jit.load, without the model code
+    or Python-side graph overhead.
+
+    python export_hrlce.py -model checkpoints/hrlce/fold0.pt -out hrlce_script.pt
+
+    The exported graph takes turns padded to SENT_PAD_LEN tokens, TorchMoji ids padded to EMOJ_SENT_PAD_LEN
+    and the ELMo representations padded to SENT_PAD_LEN (as served by utils.elmo_cache). The batch size is free.
+"""
+import argparse
+import time
+import torch
+from model.hrlce import HierarchicalPredictor
+from model.hrlce_inference import InferenceHierarchicalPredictor
+from utils.checkpoint import load_model_checkpoint
+
+SENT_PAD_LEN = 30
+EMOJ_SENT_PAD_LEN = 30
+
+
+def example_inputs(batch_size, vocab_size, elmo_dim=1024, nb_tokens=50000, seed=0):
+    """
+    Random padded inputs, in the order of HierarchicalPredictor.forward
+    """
+    generator = torch.Generator().manual_seed(seed)
+    inputs = []
+    for _ in range(3):
+        x_len = torch.randint(1, SENT_PAD_LEN + 1, (batch_size, 1), generator=generator)
+        x = torch.randint(3, vocab_size, (batch_size, SENT_PAD_LEN), generator=generator)
+        x[torch.arange(SENT_PAD_LEN).unsqueeze(0) >= x_len] = 0
+        inputs += [x, x_len]
+    for _ in range(3):
+        emoji_len = torch.randint(1, EMOJ_SENT_PAD_LEN + 1, (batch_size, 1), generator=generator)
+        emoji = torch.randint(10, nb_tokens, (batch_size, EMOJ_SENT_PAD_LEN), generator=generator)
+        emoji[torch.arange(EMOJ_SENT_PAD_LEN).unsqueeze(0) >= emoji_len] = 0
+        inputs.append(emoji)
+    for i in range(3):
+        elmo = torch.randn(batch_size, SENT_PAD_LEN, elmo_dim, generator=generator)
+        elmo[torch.arange(SENT_PAD_LEN).unsqueeze(0) >= inputs[2 * i + 1]] = 0
+        inputs.append(elmo)
+    return tuple(inputs)
+
+
+def hrlce_state_dict(checkpoint):
+    """
+    :param checkpoint: as returned by utils.checkpoint.load_model_checkpoint
+    :return: the state dict of HierarchicalPredictor
+    """
+    if checkpoint['config'] is not None and checkpoint['config']['model'] != 'hrlce':
+        raise ValueError('Checkpoint of a {} model, not hrlce'.format(checkpoint['config']['model']))
+    return checkpoint['model']
+
+
+def load_hrlce(state_dict):
+    """
+    The trained HierarchicalPredictor, in evaluation mode
+    """
+    reference = InferenceHierarchicalPredictor.from_state_dict(state_dict)
+    model = HierarchicalPredictor(reference.embeddings.embedding_dim, reference.a_lstm.hidden_size,
+                                  reference.embeddings.num_embeddings, USE_ELMO=True,
+                                  ADD_LINEAR=reference.add_linear)
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+
+def export_torchscript(state_dict, out_path, batch_size=2):
+    """
+    Trace the inference model and save it.
+    :return: the traced module
+    """
+    model = InferenceHierarchicalPredictor.from_state_dict(state_dict)
+    inputs = example_inputs(batch_size, model.embeddings.num_embeddings,
+                            model.a_lstm.input_size - model.embeddings.embedding_dim,
+                            model.deepmoji_model.embed.num_embeddings)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, inputs, check_trace=False)
+    traced.save(out_path)
+    print('TorchScript model saved to', out_path)
+    return traced
+
+
+def check_export(state_dict, traced, batch_size=16):
+    """
+    Compare the exported model with HierarchicalPredictor on a batch size other than the traced one.
+    :return: max absolute difference of the label logits
+    """
+    inputs = example_inputs(batch_size, state_dict['embeddings.weight'].size(0), seed=1)
+    model = load_hrlce(state_dict)
+
+    with torch.no_grad():
+        # the first calls of a TorchScript module include its optimisation passes
+        for _ in range(2):
+            traced(*inputs)
+        start = time.time()
+        expected = model(*inputs)[0]
+        eager_time = time.time() - start
+        start = time.time()
+        output = traced(*inputs)[0]
+        script_time = time.time() - start
+    diff = float((expected - output).abs().max())
+    print('max abs diff {:.2e}, eager {:.3f}s, torchscript {:.3f}s'.format(diff, eager_time, script_time))
+    return diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export HRLCE to TorchScript')
+    parser.add_argument('-model', type=str, required=True,
+                        help="fold checkpoint of trainer_hrlce.py, or state dict of HierarchicalPredictor")
+    parser.add_argument('-out', default='hrlce_script.pt', type=str,
+                        help="path of the TorchScript file")
+    parser.add_argument('-check', default=1, type=int,
+                        help="1 compares the export with the eager model on random inputs")
+    opt = parser.parse_args()
+
+    state_dict = hrlce_state_dict(load_model_checkpoint(opt.model))
+    traced = export_torchscript(state_dict, opt.out)
+    if opt.check:
+        check_export(state_dict, torch.jit.load(opt.out))
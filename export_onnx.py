@@ -0,0 +1,168 @@
+"""
+    Export a trained HRLCE or BERT_classifer to ONNX, served on CPU by onnxruntime through
+    utils.onnx_runtime.OnnxModel. -model is a fold checkpoint of the trainer (see utils/checkpoint.py), the model
+    is rebuilt from the configuration and vocabulary saved in it; a bare state dict can be exported, but not checked.
+
+    python export_onnx.py -type hrlce -model checkpoints/hrlce/fold0.pt -out hrlce.onnx
+    python export_onnx.py -type bert -model checkpoints/bert/fold0.pt -out bert.onnx
+
+    HRLCE is exported through model/hrlce_inference.py, whose masked LSTMs (the hard-sigmoid ones of TorchMoji
+    included) trace into plain ONNX ops. With -check 1 the graph is compared with the PyTorch model on
+    data/dev.txt: max difference of the logits, agreement of the predictions and throughput of both.
+"""
+import argparse
+import json
+import torch
+from export_hrlce import example_inputs, load_hrlce, hrlce_state_dict
+from model.hrlce_inference import InferenceHierarchicalPredictor
+from data.reader import load_conversations
+from data.features import HRLCEInputs, BertInputs
+from utils.checkpoint import load_model_checkpoint
+from utils.onnx_runtime import export_onnx, OnnxModel, compare_with_torch
+
+HRLCE_INPUT_NAMES = ['a', 'a_len', 'b', 'b_len', 'c', 'c_len', 'a_emoji', 'b_emoji', 'c_emoji',
+                     'elmo_a', 'elmo_b', 'elmo_c']
+BERT_INPUT_NAMES = ['input_ids', 'attention_mask', 'token_type_ids']
+OUTPUT_NAMES = ['label', 'binary', 'emo']
+NUM_EMO = 4
+
+
+def export_hrlce_onnx(state_dict, out_path, batch_size=2):
+    model = InferenceHierarchicalPredictor.from_state_dict(state_dict)
+    inputs = example_inputs(batch_size, model.embeddings.num_embeddings,
+                            model.a_lstm.input_size - model.embeddings.embedding_dim,
+                            model.deepmoji_model.embed.num_embeddings)
+    export_onnx(model, inputs, out_path, HRLCE_INPUT_NAMES, OUTPUT_NAMES)
+
+
+def checkpoint_config(checkpoint, model_path):
+    """
+    :return: the configuration saved with a fold checkpoint, ValueError for a bare state dict
+    """
+    if checkpoint['config'] is None:
+        raise ValueError('{} is a bare state dict, the vocabulary and padding of the model are saved in the fold '
+                         'checkpoints of the trainers only'.format(model_path))
+    return checkpoint['config']
+
+
+def bert_config(checkpoint, bert_model, pad_len, use_token_type):
+    """
+    The settings of a BERT checkpoint, the given ones for a bare state dict
+    :return: bert_model, pad_len, use_token_type
+    """
+    config = checkpoint['config']
+    if config is None:
+        return bert_model, pad_len, use_token_type
+    if config['model'] != 'bert':
+        raise ValueError('Checkpoint of a {} model, not bert'.format(config['model']))
+    return config['bert_model'], config['sent_pad_len'], config['use_token_type']
+
+
+def load_bert(state_dict, bert_model):
+    from model.bert import BERT_classifer
+
+    model = BERT_classifer.from_pretrained(bert_model)
+    model.add_output_layer(bert_model, NUM_EMO)
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+
+def export_bert_onnx(model, out_path, pad_len, batch_size=2):
+    tokens = torch.randint(1000, 2000, (batch_size, pad_len), dtype=torch.long)
+    masks = torch.ones(batch_size, pad_len, dtype=torch.long)
+    segments = torch.zeros(batch_size, pad_len, dtype=torch.long)
+    export_onnx(model, (tokens, masks, segments), out_path, BERT_INPUT_NAMES, OUTPUT_NAMES)
+
+
+def hrlce_dev_inputs(config, elmo_cache_dir, workers=1):
+    """
+    data/dev.txt as HRLCE inputs, with the vocabulary and padding saved in the fold checkpoint
+    :param config: configuration of the checkpoint, see checkpoint_config
+    """
+    from utils.elmo_cache import checkpoint_elmo_cache
+    from torchmoji.sentence_tokenizer import SentenceTokenizer
+    from torchmoji.global_variables import VOCAB_PATH
+
+    dev_data_list, _ = load_conversations('data/dev.txt', workers=workers)
+    word2id = {word: i for i, word in enumerate(config['id2word'])}
+
+    with open(VOCAB_PATH, 'r') as f:
+        emoji_st = SentenceTokenizer(json.load(f), config['emoji_pad_len'])
+    elmo_cache = checkpoint_elmo_cache(elmo_cache_dir, config)
+    inputs = HRLCEInputs(dev_data_list, word2id, elmo_cache,
+                         lambda sentences: emoji_st.tokenize_sentences_bulk(sentences, workers),
+                         config['sent_pad_len'])
+    elmo_cache.build(torch.device('cpu'))
+    return inputs
+
+
+def bert_dev_inputs(bert_model, pad_len, use_token_type=True, workers=1):
+    from pytorch_pretrained_bert import BertTokenizer
+
+    dev_data_list, _ = load_conversations('data/dev.txt', workers=workers)
+    return BertInputs(dev_data_list, BertTokenizer.from_pretrained(bert_model), pad_len, use_token_type)
+
+
+def check_onnx(model, onnx_model, batches):
+    max_diff, agreement, torch_speed, onnx_speed = compare_with_torch(model, onnx_model, batches)
+    print('dev parity: max abs diff {:.2e}, same prediction {:.2%}'.format(max_diff, agreement))
+    print('throughput: pytorch {:.1f} conv/s, onnxruntime {:.1f} conv/s ({:.2f}x)'.format(
+        torch_speed, onnx_speed, onnx_speed / torch_speed))
+    return max_diff, agreement
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export HRLCE or BERT to ONNX')
+    parser.add_argument('-type', default='hrlce', type=str,
+                        help="hrlce or bert")
+    parser.add_argument('-model', type=str, required=True,
+                        help="fold checkpoint of the trainer, or state dict of the model")
+    parser.add_argument('-out', default=None, type=str,
+                        help="path of the ONNX file, default is <type>.onnx")
+    parser.add_argument('-check', default=1, type=int,
+                        help="1 compares the export with the PyTorch model on data/dev.txt")
+    parser.add_argument('-bs', default=128, type=int,
+                        help="batch size of the check")
+    parser.add_argument('-threads', default=0, type=int,
+                        help="intra-op threads of both runtimes, 0 keeps their default")
+    parser.add_argument('-size', default='base', type=str,
+                        help='bert model of a bare state dict, base or large')
+    parser.add_argument('-padlen', default=30, type=int,
+                        help='bert padding size of a bare state dict, default is 30')
+    parser.add_argument('-tokentype', default='True', type=str,
+                        help="bert, whether the model of a bare state dict was trained with token types")
+    parser.add_argument('-elmocache', default='data/elmo_cache', type=str,
+                        help="directory of the precomputed ELMo representations")
+    parser.add_argument('-workers', default=0, type=int,
+                        help="processes used for text preprocessing and TorchMoji tokenization, 0 uses all cores")
+    opt = parser.parse_args()
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    out_path = opt.out if opt.out is not None else opt.type + '.onnx'
+
+    checkpoint = load_model_checkpoint(opt.model)
+    if opt.type == 'hrlce':
+        state_dict = hrlce_state_dict(checkpoint)
+        export_hrlce_onnx(state_dict, out_path)
+        if opt.check:
+            inputs = hrlce_dev_inputs(checkpoint_config(checkpoint, opt.model), opt.elmocache, opt.workers)
+            model = load_hrlce(state_dict)
+            check_onnx(model, OnnxModel(out_path, opt.threads), inputs.batches(opt.bs))
+    elif opt.type == 'bert':
+        if opt.size == 'large':
+            BERT_MODEL = 'bert-large-uncased'
+        elif opt.size == 'base':
+            BERT_MODEL = 'bert-base-uncased'
+        else:
+            raise ValueError
+        BERT_MODEL, pad_len, use_token_type = bert_config(checkpoint, BERT_MODEL, opt.padlen,
+                                                          opt.tokentype == 'True')
+        model = load_bert(checkpoint['model'], BERT_MODEL)
+        export_bert_onnx(model, out_path, pad_len)
+        if opt.check:
+            inputs = bert_dev_inputs(BERT_MODEL, pad_len, use_token_type, opt.workers)
+            check_onnx(model, OnnxModel(out_path, opt.threads), inputs.batches(opt.bs))
+    else:
+        raise ValueError('Model type is not recognised')
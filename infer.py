@@ -0,0 +1,222 @@
+"""
+    Batch inference with the fold checkpoints saved by a trainer (see utils/checkpoint.py), without retraining.
+
+    python infer.py -savedir checkpoints/hrlce -input data/testwithoutlabels.txt -out test_hrlce.txt
+
+    The input tsv is streamed and preprocessed in chunks of -chunk conversations. The ELMo representations are
+    read from -elmocache, those of the sentences it does not hold are computed for the current chunk only and
+    never added to it (see utils.elmo_cache.ChunkElmoCache). Every fold model scores every
+    batch, the label is the majority vote of the folds, ties going to the label that reaches the top number
+    of votes first in fold order, as find_majority of the trainers. Each output line is the input line followed by the label
+    and the mean probabilities.
+"""
+import argparse
+import json
+import numpy as np
+import torch
+import torch.nn.functional as F
+from data.reader import iter_conversation_batches
+from data.features import HRLCEInputs, SentenceInputs, BertInputs
+from utils.checkpoint import load_fold_models
+from utils.device import get_device, cpu_throughput_mode, inference_mode
+from utils.interning import SentenceInterner
+
+EMOS = ['happy', 'angry', 'sad', 'others']
+NUM_EMO = len(EMOS)
+GLOVE_MODELS = ('hrlce', 'sl', 'sld')
+
+
+def build_model(config, state_dict):
+    """
+    :return: the model of a fold checkpoint, in evaluation mode
+    """
+    if config['model'] in GLOVE_MODELS:
+        if config['model'] == 'hrlce':
+            from model.hrlce import HierarchicalPredictor
+        elif config['model'] == 'sl':
+            from model.sl import HierarchicalPredictor
+        else:
+            from model.sld import HierarchicalPredictor
+        model = HierarchicalPredictor(config['embedding_dim'], config['hidden_dim'], config['vocab_size'],
+                                      USE_ELMO=True, ADD_LINEAR=config['add_linear'])
+    elif config['model'] == 'bert':
+        from model.bert import BERT_classifer
+        model = BERT_classifer.from_pretrained(config['bert_model'])
+        model.add_output_layer(config['bert_model'], NUM_EMO)
+    else:
+        raise ValueError('Model type is not recognised')
+    model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+
+def elmo_encode(elmo_data, data_len, device):
+    # cached representations are padded, the models expect the length of the longest sentence of the batch
+    return elmo_data[:, :int(data_len.max())].to(device)
+
+
+def majority_vote(fold_labels):
+    """
+    find_majority of the trainers on every row: the most voted label, and of tied labels the one that reaches
+    that number of votes first in fold order.
+    :param fold_labels: LongTensor (N, number of folds), the labels of the folds in fold order
+    :return: LongTensor (N,)
+    """
+    counts = F.one_hot(fold_labels, NUM_EMO).cumsum(1)
+    top = counts[:, -1].max(1)[0]
+    # fold at which each label reaches the top count, the number of folds for the labels that never do
+    reached = fold_labels.size(1) - (counts >= top.view(-1, 1, 1)).long().sum(1)
+    return reached.argmin(1)
+
+
+class FoldEnsemble(object):
+    def __init__(self, checkpoints, device, quantize=False):
+        """
+        :param checkpoints: as returned by utils.checkpoint.load_fold_models
+        :param quantize: dynamic int8 quantization of every fold model, cpu only
+        """
+        self.config = checkpoints[0]['config']
+        self.kind = self.config['model']
+        for checkpoint in checkpoints[1:]:
+            if checkpoint['config'] != self.config:
+                raise ValueError('Fold {} was trained with another configuration'.format(checkpoint['fold']))
+        self.device = device
+
+        self.models = []
+        for checkpoint in checkpoints:
+            model = build_model(self.config, checkpoint['model'])
+            if quantize:
+                from utils.quantization import quantize_model
+                model = quantize_model(model)
+            self.models.append(model.to(device))
+        print('Loaded', len(self.models), self.kind, 'folds')
+
+    def run(self, model, inputs):
+        device = self.device
+        if self.kind == 'hrlce':
+            a, a_len, b, b_len, c, c_len, emoji_a, emoji_b, emoji_c, elmo_a, elmo_b, elmo_c = inputs
+            return model(a.to(device), a_len, b.to(device), b_len, c.to(device), c_len,
+                         emoji_a.to(device), emoji_b.to(device), emoji_c.to(device),
+                         elmo_encode(elmo_a, a_len, device), elmo_encode(elmo_b, b_len, device),
+                         elmo_encode(elmo_c, c_len, device))[0]
+        elif self.kind in GLOVE_MODELS:
+            a, a_len, emoji_a, elmo_a = inputs
+            return model(a.to(device), a_len, emoji_a.to(device), elmo_encode(elmo_a, a_len, device))[0]
+        tokens, masks, segments = inputs
+        return model(tokens.to(device), masks.to(device), segments.to(device))[0]
+
+    def predict(self, batches):
+        """
+        :return: labels (N,), mean probabilities of the folds (N, NUM_EMO)
+        """
+        labels = []
+        probs = []
+        with inference_mode():
+            for inputs in batches:
+                fold_labels = []
+                prob = 0
+                for model in self.models:
+                    logits = self.run(model, inputs).float()
+                    prob = prob + F.softmax(logits, dim=1)
+                    fold_labels.append(logits.argmax(1))
+                prob = prob / len(self.models)
+                labels.append(majority_vote(torch.stack(fold_labels, 1)).cpu().numpy())
+                probs.append(prob.cpu().numpy())
+        return np.concatenate(labels), np.concatenate(probs)
+
+
+class ChunkEncoder(object):
+    """
+    Turns preprocessed conversations into the inputs of the model kind of the checkpoints
+    """
+    def __init__(self, config, elmo_cache_dir, device, workers=1):
+        """
+        :param workers: processes of the TorchMoji tokenization, see SentenceTokenizer.tokenize_sentences_bulk
+        """
+        self.config = config
+        self.kind = config['model']
+        self.device = device
+        self.workers = workers
+        if self.kind in GLOVE_MODELS:
+            from utils.elmo_cache import ChunkElmoCache, checkpoint_elmo_cache
+            from torchmoji.sentence_tokenizer import SentenceTokenizer
+            from torchmoji.global_variables import VOCAB_PATH
+
+            self.word2id = {word: i for i, word in enumerate(config['id2word'])}
+            # the store of the trainer, keyed on the ELMo model the folds were trained with
+            self.elmo_cache = ChunkElmoCache(checkpoint_elmo_cache(elmo_cache_dir, config))
+            with open(VOCAB_PATH, 'r') as f:
+                self.emoji_st = SentenceTokenizer(json.load(f), config['emoji_pad_len'])
+        else:
+            from pytorch_pretrained_bert import BertTokenizer
+            self.tokenizer = BertTokenizer.from_pretrained(config['bert_model'])
+
+    def __call__(self, data_list):
+        config = self.config
+        if self.kind == 'bert':
+            return BertInputs(data_list, self.tokenizer, config['sent_pad_len'], config['use_token_type'])
+
+        # the ELMo representations of the previous chunk are not needed any more
+        self.elmo_cache.clear()
+        # the unique sentences of the chunk are TorchMoji tokenized together, once each
+        emoji_interner = SentenceInterner(
+            bulk_encoder=lambda sentences: self.emoji_st.tokenize_sentences_bulk(sentences, self.workers))
+        if self.kind == 'hrlce':
+            inputs = HRLCEInputs(data_list, self.word2id, self.elmo_cache, emoji_interner.encode_many,
+                                 config['sent_pad_len'])
+        else:
+            inputs = SentenceInputs([a + ' ' + b + ' ' + c for a, b, c, _, _, _ in data_list], self.word2id,
+                                    self.elmo_cache, emoji_interner.encode_many, config['sent_pad_len'])
+        self.elmo_cache.build(self.device)
+        return inputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fold ensemble inference')
+    parser.add_argument('-savedir', type=str, required=True,
+                        help="directory of the fold checkpoints of a trainer")
+    parser.add_argument('-input', default='data/testwithoutlabels.txt', type=str,
+                        help="tsv file of conversations, without labels")
+    parser.add_argument('-out', default='predictions.txt', type=str,
+                        help="output tsv, the input lines with the label and probabilities")
+    parser.add_argument('-bs', default=512, type=int,
+                        help="batch size")
+    parser.add_argument('-chunk', default=10000, type=int,
+                        help="conversations read and preprocessed at a time")
+    parser.add_argument('-workers', default=0, type=int,
+                        help="processes used for text preprocessing and TorchMoji tokenization, 0 uses all cores")
+    parser.add_argument('-device', default=None, type=str,
+                        help="cpu, cuda or cuda:N, default is cuda when available")
+    parser.add_argument('-threads', default=0, type=int,
+                        help="intra-op threads in cpu mode, 0 keeps the torch default")
+    parser.add_argument('-quantize', default=0, type=int,
+                        help="1 runs dynamic int8 quantized models, cpu only")
+    parser.add_argument('-elmocache', default='data/elmo_cache', type=str,
+                        help="directory of the precomputed ELMo representations, read only")
+    opt = parser.parse_args()
+
+    DEVICE = get_device(opt.device)
+    if DEVICE.type == 'cpu':
+        cpu_throughput_mode(opt.threads)
+    elif opt.quantize:
+        raise ValueError('Quantized models run on cpu only')
+
+    ensemble = FoldEnsemble(load_fold_models(opt.savedir), DEVICE, quantize=opt.quantize == 1)
+    encoder = ChunkEncoder(ensemble.config, opt.elmocache, DEVICE, opt.workers)
+
+    num_conv = 0
+    with open(opt.input, 'r', encoding='utf8') as f_in, open(opt.out, 'w', encoding='utf8') as f_out:
+        # the raw lines are read alongside the reader, which skips the same header line
+        f_out.write(next(f_in).strip() + '\tlabel\t' + '\t'.join(EMOS) + '\n')
+        for data_list, _ in iter_conversation_batches(opt.input, batch_size=opt.chunk, is_train=False,
+                                                      workers=opt.workers):
+            inputs = encoder(data_list)
+            # batches are built as they are consumed, a whole chunk of ELMo inputs would not fit in memory
+            labels, probs = ensemble.predict(inputs.batch(i, min(i + opt.bs, len(inputs)))
+                                             for i in range(0, len(inputs), opt.bs))
+            for label, prob in zip(labels, probs):
+                f_out.write(next(f_in).strip() + '\t' + EMOS[label] + '\t' +
+                            '\t'.join('{:.4f}'.format(p) for p in prob) + '\n')
+            num_conv += len(data_list)
+            print(num_conv, 'conversations scored')
+    print('Predictions written to', opt.out)
@@ -5,6 +5,8 @@ import torch
 from torch.autograd import Variable
 from module.self_attention import SelfAttentive, AttentionOneParaPerChan
 from module.torch_moji import TorchMoji
+from module.rnn_utils import sort_batch
+from utils.interning import dedup_rows
 
 import pickle as pkl
 import os
@@ -77,25 +79,18 @@ class HierarchicalPredictor(nn.Module):
 
     def init_hidden(self, x):
         batch_size = x.size(0)
+        # hidden states follow the input, so the same model runs on cpu and gpu
+        device = x.device
         if self.bidirectional:
-            h0 = Variable(torch.zeros(2*self.num_layers, batch_size, self.SENT_LSTM_DIM), requires_grad=False).cuda()
-            c0 = Variable(torch.zeros(2*self.num_layers, batch_size, self.SENT_LSTM_DIM), requires_grad=False).cuda()
+            h0 = Variable(torch.zeros(2*self.num_layers, batch_size, self.SENT_LSTM_DIM, device=device), requires_grad=False)
+            c0 = Variable(torch.zeros(2*self.num_layers, batch_size, self.SENT_LSTM_DIM, device=device), requires_grad=False)
         else:
-            h0 = Variable(torch.zeros(1*self.num_layers, batch_size, self.SENT_LSTM_DIM), requires_grad=False).cuda()
-            c0 = Variable(torch.zeros(1*self.num_layers, batch_size, self.SENT_LSTM_DIM), requires_grad=False).cuda()
+            h0 = Variable(torch.zeros(1*self.num_layers, batch_size, self.SENT_LSTM_DIM, device=device), requires_grad=False)
+            c0 = Variable(torch.zeros(1*self.num_layers, batch_size, self.SENT_LSTM_DIM, device=device), requires_grad=False)
         return (h0, c0)
 
-    @staticmethod
-    def sort_batch(batch, lengths):
-        seq_lengths, perm_idx = lengths.sort(0, descending=True)
-        seq_tensor = batch[perm_idx]
-        rever_sort = np.zeros(len(seq_lengths))
-        for i, l in enumerate(perm_idx):
-            rever_sort[l] = i
-        return seq_tensor, seq_lengths, rever_sort.astype(int), perm_idx
-
     def lstm_forward(self, x, x_len, elmo_x, lstm, hidden=None, attention_layer=None):
-        x, x_len_sorted, reverse_idx, perm_idx = self.sort_batch(x, x_len.view(-1))
+        x, x_len_sorted, reverse_idx, perm_idx = sort_batch(x, x_len.view(-1))
         max_len = int(x_len_sorted[0])
 
         emb_x = self.embeddings(x)
@@ -103,7 +98,7 @@ class HierarchicalPredictor(nn.Module):
         emb_x = emb_x[:, :max_len, :]
 
         if self.use_elmo:
-            elmo_x = elmo_x[perm_idx]
+            elmo_x = elmo_x[perm_idx][:, :max_len]
             elmo_x = self.drop_out(elmo_x)
             emb_x = torch.cat((emb_x, elmo_x), dim=2)
 
@@ -116,7 +111,7 @@ class HierarchicalPredictor(nn.Module):
         attention_layer = None  # testing
         if attention_layer is None:
             seq_len = torch.LongTensor(unpacked_len).view(-1, 1, 1).expand(output.size(0), 1, output.size(2))
-            seq_len = Variable(seq_len - 1).cuda()
+            seq_len = Variable(seq_len - 1).to(output.device)
             output = torch.gather(output, 1, seq_len).squeeze(1)
         else:
             if isinstance(attention_layer, AttentionOneParaPerChan):
@@ -126,7 +121,7 @@ class HierarchicalPredictor(nn.Module):
                 # print(unpacked_len)
                 max_len = max(unpacked_len)
                 mask = [[1] * l + [0] * (max_len - l) for l in unpacked_len]
-                mask = torch.FloatTensor(np.asarray(mask)).cuda()
+                mask = torch.FloatTensor(np.asarray(mask)).to(output.device)
                 attention_mask = torch.ones_like(mask)
                 extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
                 # extended_attention_mask = extended_attention_mask.to(
@@ -138,51 +133,54 @@ class HierarchicalPredictor(nn.Module):
 
         return output[reverse_idx], (hidden[0][:, reverse_idx, :], hidden[1][:, reverse_idx, :])
 
+    def unique_forward(self, fn, x, *inputs):
+        """
+        In evaluation mode, run fn only on the unique rows of x and scatter the result back to the batch.
+        Encoders are deterministic there, so repeated turns get the same output.
+        """
+        if self.training:
+            return fn(x, *inputs)
+        index, inverse = dedup_rows(x)
+        if index.size(0) == x.size(0):
+            return fn(x, *inputs)
+        inputs = [t[index.to(t.device)] if t is not None else None for t in inputs]
+        return fn(x[index], *inputs)[inverse]
+
+    def sent_forward(self, x, x_len, elmo_x, attention_layer):
+        return self.unique_forward(
+            lambda _x, _x_len, _elmo_x: self.lstm_forward(_x, _x_len, _elmo_x, self.a_lstm,
+                                                          attention_layer=attention_layer)[0],
+            x, x_len, elmo_x)
+
+    @staticmethod
+    def cat_turns(turns):
+        """
+        Concatenate the turns along the batch dimension, zero padding the time dimension to the longest turn
+        """
+        max_len = max(t.size(1) for t in turns)
+        return torch.cat([F.pad(t, [0, 0] * (t.dim() - 2) + [0, max_len - t.size(1)]) for t in turns], dim=0)
+
     def forward(self, a, a_len, b, b_len, c, c_len, a_emoji, b_emoji, c_emoji, elmo_a=None, elmo_b=None, elmo_c=None):
-        # Sentence LSTM A
-        a_out, a_hidden = self.lstm_forward(a, a_len, elmo_a, self.a_lstm,
-                                            attention_layer=self.a_self_attention)
-        # a_out = a_out[:, 0, :]
+        batch_size = a.size(0)
+        # Sentence LSTM, the three turns share a_lstm and run as one 3B batch.
+        # lstm_forward pools the last state (attention is switched off there), so a single call covers b as well
+        x = self.cat_turns([a, b, c])
+        x_len = torch.cat((a_len, b_len, c_len), dim=0)
+        elmo_x = self.cat_turns([elmo_a, elmo_b, elmo_c]) if self.use_elmo else None
+        a_out, b_out, c_out = self.sent_forward(x, x_len, elmo_x, self.a_self_attention).split(batch_size)
+
+        # TorchMoji, one call for the three turns as well
+        emoji = self.unique_forward(self.deepmoji_model, self.cat_turns([a_emoji, b_emoji, c_emoji]))
         if self.add_linear:
-            a_emoji = self.deepmoji_model(a_emoji)
-            a_emoji = self.deepmoji2linear(a_emoji)
-            a_emoji = F.relu(a_emoji)
-            a_emoji = self.drop_out(a_emoji)
+            emoji = self.deepmoji2linear(emoji)
+            emoji = F.relu(emoji)
+            emoji = self.drop_out(emoji)
         else:
-            a_emoji = self.deepmoji_model(a_emoji)
-            a_emoji = F.relu(a_emoji)
+            emoji = F.relu(emoji)
+        a_emoji, b_emoji, c_emoji = emoji.split(batch_size)
 
-        # a_out = torch.cat((F.relu(a_out), a_emoji), dim=1)
         a_out = torch.cat((a_out, a_emoji), dim=1)
-        # Sentence LSTM B
-        b_out, b_hidden = self.lstm_forward(b, b_len, elmo_b, self.a_lstm,
-                                            attention_layer=self.b_self_attention)
-        # b_out = b_out[:, 0, :]
-        if self.add_linear:
-            b_emoji = self.deepmoji_model(b_emoji)
-            b_emoji = self.deepmoji2linear(b_emoji)
-            b_emoji = F.relu(b_emoji)
-            b_emoji = self.drop_out(b_emoji)
-        else:
-            b_emoji = self.deepmoji_model(b_emoji)
-            b_emoji = F.relu(b_emoji)
-
-        # b_out = torch.cat((F.relu(b_out), b_emoji), dim=1)
         b_out = torch.cat((b_out, b_emoji), dim=1)
-        # Sentence LSTM A
-        c_out, c_hidden = self.lstm_forward(c, c_len, elmo_c, self.a_lstm,  # a_hidden,
-                                            attention_layer=self.a_self_attention)
-        # c_out = c_out[:, 0, :]
-        if self.add_linear:
-            c_emoji = self.deepmoji_model(c_emoji)
-            c_emoji = self.deepmoji2linear(c_emoji)
-            c_emoji = F.relu(c_emoji)
-            c_emoji = self.drop_out(c_emoji)
-        else:
-            c_emoji = self.deepmoji_model(c_emoji)
-            c_emoji = F.relu(c_emoji)
-
-        # c_out = torch.cat((F.relu(c_out), c_emoji), dim=1)
         c_out = torch.cat((c_out, c_emoji), dim=1)
         # Context LSTM
         context_in = torch.cat((a_out.unsqueeze(1), b_out.unsqueeze(1), c_out.unsqueeze(1)), dim=1)
@@ -203,4 +201,5 @@ class HierarchicalPredictor(nn.Module):
         return out1, out2, out3
 
     def load_embedding(self, emb):
-        self.embeddings.weight = nn.Parameter(torch.FloatTensor(emb))
+        # always a copy, emb may be shared by several models
+        self.embeddings.weight = nn.Parameter(torch.as_tensor(emb, dtype=torch.float).clone())
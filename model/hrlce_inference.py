@@ -0,0 +1,119 @@
+"""
+    Inference-only HRLCE that can be traced into TorchScript. Inputs are padded to a fixed length and the
+    recurrences are masked instead of sorted and packed, so there is no numpy, no Python branching on the data
+    and no per-batch host round-trip. Module and parameter names are the ones of HierarchicalPredictor and
+    TorchMoji, the state dict of a trained model loads as it is.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from module.masked_lstm import MaskedLSTM
+from module.self_attention import AttentionOneParaPerChan
+from model.hrlce import NUM_EMO
+
+
+class InferenceTorchMoji(nn.Module):
+    """
+    Feature extractor of TorchMoji (nb_classes=None), in evaluation mode
+    """
+    def __init__(self, nb_tokens):
+        super(InferenceTorchMoji, self).__init__()
+        embedding_dim = 256
+        hidden_size = 512
+        attention_size = 4 * hidden_size + embedding_dim
+
+        self.embed = nn.Embedding(nb_tokens, embedding_dim)
+        self.lstm_0 = MaskedLSTM(embedding_dim, hidden_size, bidirectional=True, hard_sigmoid=True)
+        self.lstm_1 = MaskedLSTM(hidden_size * 2, hidden_size, bidirectional=True, hard_sigmoid=True)
+        self.attention_layer = AttentionOneParaPerChan(attention_size=attention_size)
+
+    def forward(self, input_seqs):
+        # length: index of the last non-zero token + 1, as in TorchMoji.sequence_lengths
+        positions = torch.arange(1, input_seqs.size(1) + 1, dtype=torch.long,
+                                 device=input_seqs.device).unsqueeze(0)
+        input_lengths = (positions * (input_seqs != 0).long()).max(1)[0].clamp(min=1)
+        mask = (positions <= input_lengths.unsqueeze(1)).unsqueeze(2).float()
+
+        x = torch.tanh(self.embed(input_seqs)) * mask
+        lstm_0_output = self.lstm_0(x, input_lengths)
+        lstm_1_output = self.lstm_1(lstm_0_output, input_lengths)
+
+        # skip-connection, same merge order as TorchMoji
+        x = torch.cat((lstm_1_output, lstm_0_output, x), dim=2)
+        x, _ = self.attention_layer(x, input_lengths)
+        return x
+
+
+class InferenceHierarchicalPredictor(nn.Module):
+    """
+    HierarchicalPredictor (with ELMo) for inference. All the inputs are padded to the length used at export time.
+    """
+    def __init__(self, embedding_dim, hidden_dim, vocab_size, ADD_LINEAR, elmo_dim=1024, nb_tokens=50000):
+        super(InferenceHierarchicalPredictor, self).__init__()
+        self.add_linear = ADD_LINEAR
+        self.deepmoji_dim = 2304
+        self.deepmoji_out = 300 if ADD_LINEAR else self.deepmoji_dim
+        self.ctx_lstm_dim = 800
+
+        self.embeddings = nn.Embedding(vocab_size, embedding_dim, padding_idx=0)
+        self.a_lstm = MaskedLSTM(embedding_dim + elmo_dim, hidden_dim, num_layers=2, bidirectional=True)
+        self.deepmoji_model = InferenceTorchMoji(nb_tokens)
+        if self.add_linear:
+            self.deepmoji2linear = nn.Linear(self.deepmoji_dim, self.deepmoji_out)
+
+        self.context_lstm = nn.LSTM(hidden_dim * 2 + self.deepmoji_out, self.ctx_lstm_dim,
+                                    num_layers=2, batch_first=True, bidirectional=True)
+        self.ctx_self_attention = AttentionOneParaPerChan(self.ctx_lstm_dim * 2)
+
+        self.out2label = nn.Linear(self.ctx_lstm_dim * 2, NUM_EMO)
+        self.out2binary = nn.Linear(self.ctx_lstm_dim * 2, 2)
+        self.out2emo = nn.Linear(self.ctx_lstm_dim * 2, NUM_EMO - 1)
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        """
+        Build the model from the state dict of a trained HierarchicalPredictor, the sizes are read from the
+        weights. Parameters that are not used for inference (b_lstm, the sentence attention layers) are skipped.
+        """
+        vocab_size, embedding_dim = state_dict['embeddings.weight'].size()
+        hidden_dim = state_dict['a_lstm.weight_hh_l0'].size(1)
+        elmo_dim = state_dict['a_lstm.weight_ih_l0'].size(1) - embedding_dim
+        ctx_input_dim = state_dict['context_lstm.weight_ih_l0'].size(1)
+        add_linear = ctx_input_dim - hidden_dim * 2 != 2304
+        nb_tokens = state_dict['deepmoji_model.embed.weight'].size(0)
+
+        model = cls(embedding_dim, hidden_dim, vocab_size, add_linear, elmo_dim=elmo_dim, nb_tokens=nb_tokens)
+        own_keys = set(model.state_dict().keys())
+        model.load_state_dict({k: v for k, v in state_dict.items() if k in own_keys})
+        model.eval()
+        return model
+
+    def forward(self, a, a_len, b, b_len, c, c_len, a_emoji, b_emoji, c_emoji, elmo_a, elmo_b, elmo_c):
+        # the three turns share a_lstm and run as one 3B batch
+        x = torch.cat((a, b, c), dim=0)
+        x_len = torch.cat((a_len.view(-1), b_len.view(-1), c_len.view(-1)), dim=0)
+        emb_x = torch.cat((self.embeddings(x), torch.cat((elmo_a, elmo_b, elmo_c), dim=0)), dim=2)
+
+        output = self.a_lstm(emb_x, x_len)
+        # last state of every sentence, as HierarchicalPredictor.lstm_forward
+        last = (x_len - 1).view(-1, 1, 1).expand(output.size(0), 1, output.size(2))
+        sent_out = output.gather(1, last).squeeze(1)
+
+        emoji = self.deepmoji_model(torch.cat((a_emoji, b_emoji, c_emoji), dim=0))
+        if self.add_linear:
+            emoji = self.deepmoji2linear(emoji)
+        emoji = F.relu(emoji)
+
+        sent_out = torch.cat((sent_out, emoji), dim=1)
+        a_out, b_out, c_out = sent_out.chunk(3)
+
+        context_in = torch.stack((a_out, b_out, c_out), dim=1)
+        ctx_out, _ = self.context_lstm(context_in)
+        # derived from an input rather than from the batch size, so that traced graphs keep a dynamic batch
+        ctx_len = torch.ones_like(a_len.view(-1)) * 3
+        ctx_out, _ = self.ctx_self_attention(ctx_out, ctx_len)
+
+        out1 = self.out2label(ctx_out)
+        out2 = self.out2binary(ctx_out)
+        out3 = torch.sigmoid(self.out2emo(ctx_out))
+        return out1, out2, out3
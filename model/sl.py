@@ -5,6 +5,7 @@ import torch
 from torch.autograd import Variable
 from module.self_attention import SelfAttentive, AttentionOneParaPerChan
 from module.torch_moji import TorchMoji
+from module.rnn_utils import sort_batch
 
 import pickle as pkl
 import os
@@ -49,25 +50,18 @@ class HierarchicalPredictor(nn.Module):
 
     def init_hidden(self, x):
         batch_size = x.size(0)
+        # hidden states follow the input, so the same model runs on cpu and gpu
+        device = x.device
         if self.bidirectional:
-            h0 = Variable(torch.zeros(2*self.num_layers, batch_size, self.SENT_LSTM_DIM), requires_grad=False).cuda()
-            c0 = Variable(torch.zeros(2*self.num_layers, batch_size, self.SENT_LSTM_DIM), requires_grad=False).cuda()
+            h0 = Variable(torch.zeros(2*self.num_layers, batch_size, self.SENT_LSTM_DIM, device=device), requires_grad=False)
+            c0 = Variable(torch.zeros(2*self.num_layers, batch_size, self.SENT_LSTM_DIM, device=device), requires_grad=False)
         else:
-            h0 = Variable(torch.zeros(1*self.num_layers, batch_size, self.SENT_LSTM_DIM), requires_grad=False).cuda()
-            c0 = Variable(torch.zeros(1*self.num_layers, batch_size, self.SENT_LSTM_DIM), requires_grad=False).cuda()
+            h0 = Variable(torch.zeros(1*self.num_layers, batch_size, self.SENT_LSTM_DIM, device=device), requires_grad=False)
+            c0 = Variable(torch.zeros(1*self.num_layers, batch_size, self.SENT_LSTM_DIM, device=device), requires_grad=False)
         return (h0, c0)
 
-    @staticmethod
-    def sort_batch(batch, lengths):
-        seq_lengths, perm_idx = lengths.sort(0, descending=True)
-        seq_tensor = batch[perm_idx]
-        rever_sort = np.zeros(len(seq_lengths))
-        for i, l in enumerate(perm_idx):
-            rever_sort[l] = i
-        return seq_tensor, seq_lengths, rever_sort.astype(int), perm_idx
-
     def lstm_forward(self, x, x_len, elmo_x, lstm, hidden=None, attention_layer=None):
-        x, x_len_sorted, reverse_idx, perm_idx = self.sort_batch(x, x_len.view(-1))
+        x, x_len_sorted, reverse_idx, perm_idx = sort_batch(x, x_len.view(-1))
         max_len = int(x_len_sorted[0])
 
         emb_x = self.embeddings(x)
@@ -88,7 +82,7 @@ class HierarchicalPredictor(nn.Module):
         # attention_layer = None  # testing
         if attention_layer is None:
             seq_len = torch.LongTensor(unpacked_len).view(-1, 1, 1).expand(output.size(0), 1, output.size(2))
-            seq_len = Variable(seq_len - 1).cuda()
+            seq_len = Variable(seq_len - 1).to(output.device)
             output = torch.gather(output, 1, seq_len).squeeze(1)
         else:
             if isinstance(attention_layer, AttentionOneParaPerChan):
@@ -98,7 +92,7 @@ class HierarchicalPredictor(nn.Module):
                 # print(unpacked_len)
                 max_len = max(unpacked_len)
                 mask = [[1] * l + [0] * (max_len - l) for l in unpacked_len]
-                mask = torch.FloatTensor(np.asarray(mask)).cuda()
+                mask = torch.FloatTensor(np.asarray(mask)).to(output.device)
                 attention_mask = torch.ones_like(mask)
                 extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
                 # extended_attention_mask = extended_attention_mask.to(
@@ -122,4 +116,5 @@ class HierarchicalPredictor(nn.Module):
         return out1, out2, out3
 
     def load_embedding(self, emb):
-        self.embeddings.weight = nn.Parameter(torch.FloatTensor(emb))
+        # always a copy, emb may be shared by several models
+        self.embeddings.weight = nn.Parameter(torch.as_tensor(emb, dtype=torch.float).clone())
@@ -0,0 +1,99 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.parameter import Parameter
+
+
+def reverse_padded(x, lengths):
+    """
+    Index that reverses every sequence of a padded batch within its length, padding stays in place.
+    Applying it twice gives the identity.
+    :return: (B, T) LongTensor
+    """
+    idx = torch.arange(x.size(1), dtype=torch.long, device=x.device).unsqueeze(0)
+    lengths = lengths.view(-1, 1).to(x.device)
+    return torch.where(idx < lengths, lengths - 1 - idx, idx.expand(x.size(0), x.size(1)))
+
+
+class MaskedLSTM(nn.Module):
+    """
+    Multi-layer LSTM over padded, unsorted batches for inference. The backward direction runs on the sequences
+    reversed within their length, so no sorting or packing is needed and the module can be traced.
+    Parameter names follow nn.LSTM and LSTMHardSigmoid, the weights of either load directly.
+    Outputs past the length of a sequence are zero, as after pad_packed_sequence.
+    """
+    def __init__(self, input_size, hidden_size, num_layers=1, bidirectional=True, hard_sigmoid=False):
+        super(MaskedLSTM, self).__init__()
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.bidirectional = bidirectional
+        self.hard_sigmoid = hard_sigmoid
+        num_directions = 2 if bidirectional else 1
+
+        gate_size = 4 * hidden_size
+        self._all_weights = []
+        for layer in range(num_layers):
+            for direction in range(num_directions):
+                layer_input_size = input_size if layer == 0 else hidden_size * num_directions
+                suffix = '_reverse' if direction == 1 else ''
+                param_names = [x.format(layer, suffix) for x in
+                               ['weight_ih_l{}{}', 'weight_hh_l{}{}', 'bias_ih_l{}{}', 'bias_hh_l{}{}']]
+                layer_params = (Parameter(torch.Tensor(gate_size, layer_input_size)),
+                                Parameter(torch.Tensor(gate_size, hidden_size)),
+                                Parameter(torch.Tensor(gate_size)),
+                                Parameter(torch.Tensor(gate_size)))
+                for name, param in zip(param_names, layer_params):
+                    setattr(self, name, param)
+                self._all_weights.append(param_names)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        stdv = 1.0 / math.sqrt(self.hidden_size)
+        for weight in self.parameters():
+            weight.data.uniform_(-stdv, stdv)
+
+    def gate(self, x):
+        if self.hard_sigmoid:
+            return torch.clamp(0.2 * x + 0.5, 0., 1.)
+        return torch.sigmoid(x)
+
+    def direction_forward(self, x, w_ih, w_hh, b_ih, b_hh):
+        # input-to-hidden projection of every timestep at once
+        input_gates = F.linear(x, w_ih, b_ih)
+        h = x.new_zeros((x.size(0), self.hidden_size))
+        c = x.new_zeros((x.size(0), self.hidden_size))
+        output = []
+        for t in range(x.size(1)):
+            gates = input_gates[:, t] + F.linear(h, w_hh, b_hh)
+            ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+            c = self.gate(forgetgate) * c + self.gate(ingate) * torch.tanh(cellgate)
+            h = self.gate(outgate) * torch.tanh(c)
+            output.append(h)
+        return torch.stack(output, 1)
+
+    def forward(self, x, lengths):
+        """
+        :param x: (B, T, input_size), batch first
+        :param lengths: (B,) LongTensor
+        :return: (B, T, hidden_size * num_directions)
+        """
+        mask = (torch.arange(x.size(1), dtype=torch.long, device=x.device).unsqueeze(0) <
+                lengths.view(-1, 1).to(x.device)).unsqueeze(2).type_as(x)
+        if self.bidirectional:
+            rev_idx = reverse_padded(x, lengths).unsqueeze(2)
+
+        num_directions = 2 if self.bidirectional else 1
+        for layer in range(self.num_layers):
+            outputs = []
+            for direction in range(num_directions):
+                weights = [getattr(self, name) for name in self._all_weights[layer * num_directions + direction]]
+                if direction == 0:
+                    outputs.append(self.direction_forward(x, *weights))
+                else:
+                    x_rev = x.gather(1, rev_idx.expand(x.size(0), x.size(1), x.size(2)))
+                    output = self.direction_forward(x_rev, *weights)
+                    outputs.append(output.gather(1, rev_idx.expand(output.size(0), output.size(1), output.size(2))))
+            x = torch.cat(outputs, 2) * mask
+        return x
@@ -0,0 +1,21 @@
+import torch
+
+
+def sort_batch(batch, lengths):
+    """
+    Sort a batch by decreasing length, as pack_padded_sequence expects.
+    Lengths are best kept on the cpu (where the packing needs them anyway), the permutations are moved to the
+    device of the batch once so that no indexing goes back to the host.
+
+    # Arguments:
+        batch: tensor whose first dimension is the batch.
+        lengths: 1d LongTensor of the sequence lengths.
+
+    # Return:
+        sorted batch, sorted lengths, inverse permutation (restores the original order), permutation
+    """
+    seq_lengths, perm_idx = lengths.sort(0, descending=True)
+    reverse_idx = perm_idx.argsort()
+    perm_idx = perm_idx.to(batch.device)
+    reverse_idx = reverse_idx.to(batch.device)
+    return batch[perm_idx], seq_lengths, reverse_idx, perm_idx
@@ -162,11 +162,12 @@ class AttentionOneParaPerChan(Module):
         # Compute a mask for the attention on the padded sequences
         # See e.g. https://discuss.pytorch.org/t/self-attention-on-words-and-masking/5671/5
         max_len = unnorm_ai.size(1)
-        idxes = torch.arange(0, max_len, out=torch.LongTensor(max_len)).unsqueeze(0)
+        idxes = torch.arange(0, max_len, dtype=torch.long, device=inputs.device).unsqueeze(0)
+        input_lengths = input_lengths.to(inputs.device)
         if self.is_half:
-            mask = Variable((idxes < input_lengths.unsqueeze(1)).half()).cuda()
+            mask = Variable((idxes < input_lengths.unsqueeze(1)).half())
         else:
-            mask = Variable((idxes < input_lengths.unsqueeze(1)).float()).cuda()
+            mask = Variable((idxes < input_lengths.unsqueeze(1)).float())
         masked_weights = unnorm_ai * mask
 
         # apply mask and renormalize attention scores (weights)
@@ -0,0 +1,70 @@
+"""
+    Dynamic int8 quantization of a trained HRLCE or BERT_classifer (fold checkpoint of the trainer, see
+    export_onnx.py), evaluated against the float model on data/dev.txt: get_metrics of both, speedup and size
+    reduction.
+
+    python quantize.py -type hrlce -model checkpoints/hrlce/fold0.pt -out hrlce_int8.pt
+    python quantize.py -type bert -model checkpoints/bert/fold0.pt
+
+    The quantized model is saved whole with torch.save (-out), quantization itself only takes seconds and
+    can also be done at load time with utils.quantization.quantize_model.
+"""
+import argparse
+import torch
+from data.evaluate import load_dev_labels, get_metrics
+from export_hrlce import load_hrlce, hrlce_state_dict
+from export_onnx import hrlce_dev_inputs, bert_dev_inputs, load_bert, checkpoint_config, bert_config
+from utils.checkpoint import load_model_checkpoint
+from utils.quantization import quantize_model, compare_quantized
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantize HRLCE or BERT to int8')
+    parser.add_argument('-type', default='hrlce', type=str,
+                        help="hrlce or bert")
+    parser.add_argument('-model', type=str, required=True,
+                        help="fold checkpoint of the trainer, or state dict of a bert model")
+    parser.add_argument('-out', default=None, type=str,
+                        help="path of the quantized model, not saved by default")
+    parser.add_argument('-bs', default=128, type=int,
+                        help="batch size of the evaluation")
+    parser.add_argument('-threads', default=0, type=int,
+                        help="intra-op threads, 0 keeps the torch default")
+    parser.add_argument('-size', default='base', type=str,
+                        help='bert model of a bare state dict, base or large')
+    parser.add_argument('-padlen', default=30, type=int,
+                        help='bert padding size of a bare state dict, default is 30')
+    parser.add_argument('-tokentype', default='True', type=str,
+                        help="bert, whether the model of a bare state dict was trained with token types")
+    parser.add_argument('-elmocache', default='data/elmo_cache', type=str,
+                        help="directory of the precomputed ELMo representations")
+    parser.add_argument('-workers', default=0, type=int,
+                        help="processes used for text preprocessing and TorchMoji tokenization, 0 uses all cores")
+    opt = parser.parse_args()
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    checkpoint = load_model_checkpoint(opt.model)
+    if opt.type == 'hrlce':
+        model = load_hrlce(hrlce_state_dict(checkpoint))
+        inputs = hrlce_dev_inputs(checkpoint_config(checkpoint, opt.model), opt.elmocache, opt.workers)
+    elif opt.type == 'bert':
+        if opt.size == 'large':
+            BERT_MODEL = 'bert-large-uncased'
+        elif opt.size == 'base':
+            BERT_MODEL = 'bert-base-uncased'
+        else:
+            raise ValueError
+        BERT_MODEL, pad_len, use_token_type = bert_config(checkpoint, BERT_MODEL, opt.padlen,
+                                                          opt.tokentype == 'True')
+        model = load_bert(checkpoint['model'], BERT_MODEL)
+        inputs = bert_dev_inputs(BERT_MODEL, pad_len, use_token_type, opt.workers)
+    else:
+        raise ValueError('Model type is not recognised')
+
+    quantized = quantize_model(model)
+    compare_quantized(model, quantized, inputs.batches(opt.bs), load_dev_labels('data/dev.txt'), get_metrics)
+    if opt.out is not None:
+        torch.save(quantized, opt.out)
+        print('int8 model saved to', opt.out)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the repository root, where the trainers import utils/, data/ and model/ from
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
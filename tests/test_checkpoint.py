@@ -0,0 +1,89 @@
+"""
+    utils/checkpoint.py: a run resumes only from the states of a run with the same configuration.
+"""
+import argparse
+import pytest
+import torch
+import torch.nn as nn
+from utils.checkpoint import run_configuration, data_order, save_training_state, save_fold_result, \
+    load_training_state, training_state_path, save_fold_model, load_model_checkpoint
+from utils.early_stopping import EarlyStopping
+
+
+def _opt(**kwargs):
+    options = {'lr': 5e-4, 'loss': 'ce', 'dim': 1500, 'threads': 0, 'savedir': 'x', 'resume': 0}
+    options.update(kwargs)
+    return argparse.Namespace(**options)
+
+
+def _save_state(save_dir, num_fold, config):
+    model = nn.Linear(2, 2)
+    optimizer = torch.optim.Adam(model.parameters())
+    save_training_state(save_dir, num_fold, 0, model, optimizer, None, EarlyStopping(patience=1),
+                        {'pred_list_test_best': None}, config)
+
+
+def test_run_configuration_ignores_resources():
+    model_config = {'model': 'hrlce', 'vocab_size': 10, 'id2word': ['<pad>', 'a']}
+    assert run_configuration(_opt(), model_config) == run_configuration(_opt(threads=8, resume=1), model_config)
+    assert run_configuration(_opt(), model_config) != run_configuration(_opt(lr=1e-3), model_config)
+    assert run_configuration(_opt(), model_config) != run_configuration(_opt(), dict(model_config, vocab_size=11))
+
+
+def test_resume_same_configuration(tmpdir):
+    save_dir = str(tmpdir)
+    config = run_configuration(_opt(), {'vocab_size': 10})
+    assert data_order(save_dir, [2, 0, 1], config) == [2, 0, 1]
+    _save_state(save_dir, 0, config)
+    save_fold_result(save_dir, 1, {'pred_list_test_best': None}, config)
+
+    assert data_order(save_dir, [0, 1, 2], config, resume=True) == [2, 0, 1]
+    assert load_training_state(save_dir, 0, config)['epoch'] == 0
+    assert load_training_state(save_dir, 1, config)['completed']
+    assert load_training_state(save_dir, 2, config) is None
+
+
+def test_resume_other_configuration_refused(tmpdir):
+    save_dir = str(tmpdir)
+    config = run_configuration(_opt(), {'vocab_size': 10})
+    data_order(save_dir, [2, 0, 1], config)
+    _save_state(save_dir, 0, config)
+
+    other = run_configuration(_opt(loss='focal'), {'vocab_size': 10})
+    with pytest.raises(ValueError):
+        data_order(save_dir, [0, 1, 2], other, resume=True)
+    with pytest.raises(ValueError):
+        load_training_state(save_dir, 0, other)
+    with pytest.raises(ValueError):
+        data_order(save_dir, [0, 1, 2, 3], config, resume=True)
+
+
+def test_new_run_starts_over(tmpdir):
+    save_dir = str(tmpdir)
+    config = run_configuration(_opt(), {'vocab_size': 10})
+    data_order(save_dir, [2, 0, 1], config)
+    _save_state(save_dir, 0, config)
+
+    save_fold_model(save_dir, 4, nn.Linear(2, 2), {'vocab_size': 10})
+
+    other = run_configuration(_opt(dim=300), {'vocab_size': 10})
+    assert data_order(save_dir, [0, 1, 2], other) == [0, 1, 2]
+    assert not tmpdir.join('state_fold0.pt').check()
+    # the weights of a previous run with more folds would join the ensemble
+    assert not tmpdir.join('fold4.pt').check()
+    assert training_state_path(save_dir, 0) == str(tmpdir.join('state_fold0.pt'))
+    assert data_order(save_dir, [1, 2, 0], other, resume=True) == [0, 1, 2]
+
+
+def test_load_model_checkpoint(tmpdir):
+    model = nn.Linear(2, 2)
+    save_fold_model(str(tmpdir), 3, model, {'model': 'hrlce', 'vocab_size': 10})
+    checkpoint = load_model_checkpoint(str(tmpdir.join('fold3.pt')))
+    assert checkpoint['fold'] == 3 and checkpoint['config']['vocab_size'] == 10
+    assert torch.equal(checkpoint['model']['weight'], model.weight.detach())
+
+    # a bare state dict has no configuration
+    torch.save(model.state_dict(), str(tmpdir.join('model.pt')))
+    checkpoint = load_model_checkpoint(str(tmpdir.join('model.pt')))
+    assert checkpoint['config'] is None
+    assert torch.equal(checkpoint['model']['weight'], model.weight.detach())
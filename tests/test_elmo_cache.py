@@ -0,0 +1,63 @@
+"""
+    utils/elmo_cache.py: streamed inputs read the store and compute the other sentences in memory.
+"""
+import os
+import numpy as np
+import utils.elmo_cache as elmo_cache_module
+from utils.elmo_cache import ElmoCache, ChunkElmoCache, checkpoint_elmo_cache, ELMO_OPTIONS_FILE, \
+    ELMO_WEIGHT_FILE
+
+ID2WORD = ['<pad>', 'a', 'b', 'c', 'd', 'e']
+
+
+def _write_store(tmpdir):
+    store = ElmoCache(str(tmpdir), ID2WORD, 'options', 'weights', dim=4)
+    np.save(os.path.join(store.cache_dir, 'vectors.npy'), np.ones((5, 4), dtype=np.float16))
+    np.save(os.path.join(store.cache_dir, 'offsets.npy'), np.array([0, 2, 5], dtype=np.int64))
+    with open(os.path.join(store.cache_dir, 'sentences.txt'), 'w') as f:
+        f.write('a b\nc d e')
+    with open(os.path.join(store.cache_dir, 'meta.json'), 'w') as f:
+        f.write('{}')
+    return ElmoCache(str(tmpdir), ID2WORD, 'options', 'weights', dim=4)
+
+
+def fake_elmo_vectors(elmo, tokens, device, batch_size=64):
+    # every token vector is the number of tokens of its sentence
+    for j, sentence in enumerate(tokens):
+        yield j, np.full((len(sentence), 4), len(sentence), dtype=np.float16)
+
+
+def test_chunk_sentences_not_stored(tmpdir, monkeypatch):
+    monkeypatch.setattr(elmo_cache_module, 'load_elmo', lambda options_file, weight_file, device: 'elmo')
+    monkeypatch.setattr(elmo_cache_module, 'elmo_vectors', fake_elmo_vectors)
+    store = _write_store(tmpdir)
+    files = {name: os.path.getmtime(os.path.join(store.cache_dir, name)) for name in os.listdir(store.cache_dir)}
+    chunk_cache = ChunkElmoCache(store)
+
+    cached = chunk_cache.sentence_id([3, 4, 5, 0])
+    new = chunk_cache.sentence_id([5, 1, 1, 0])
+    assert cached == 1 and new < 0
+    assert chunk_cache.sentence_id([5, 1, 1, 0]) == new
+    chunk_cache.build('cpu')
+    assert chunk_cache.get(cached).shape == (3, 4)
+    assert np.array_equal(chunk_cache.get(new, 4)[:, 0], [3, 3, 3, 0])
+
+    # the next chunk starts empty, the store is untouched
+    chunk_cache.clear()
+    assert chunk_cache.sentence_id([2, 0, 0, 0]) == new
+    chunk_cache.build('cpu')
+    assert np.array_equal(chunk_cache.get(new, 2)[:, 0], [1, 0])
+    assert len(chunk_cache.new_vectors) == 1
+    assert len(store.sentence2id) == 2 and len(store.pending) == 0
+    assert files == {name: os.path.getmtime(os.path.join(store.cache_dir, name))
+                     for name in os.listdir(store.cache_dir)}
+
+
+def test_checkpoint_elmo_cache(tmpdir):
+    # the store of the trainer, keyed on the ELMo model saved with the folds
+    trainer_cache = ElmoCache(str(tmpdir), ID2WORD, 'options', 'weights')
+    config = {'id2word': ID2WORD, 'elmo_options_file': 'options', 'elmo_weight_file': 'weights'}
+    assert checkpoint_elmo_cache(str(tmpdir), config).cache_dir == trainer_cache.cache_dir
+    # checkpoints saved without them used the default model
+    default_cache = ElmoCache(str(tmpdir), ID2WORD, ELMO_OPTIONS_FILE, ELMO_WEIGHT_FILE)
+    assert checkpoint_elmo_cache(str(tmpdir), {'id2word': ID2WORD}).cache_dir == default_cache.cache_dir
@@ -0,0 +1,89 @@
+"""
+    utils/fold_pool.py: folds run in worker processes after the parent has already used multi-threaded torch,
+    as every trainer does before run_folds.
+"""
+import os
+import subprocess
+import sys
+import numpy as np
+import torch
+from utils.fold_pool import run_folds
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# the steps of a trainer before its folds: thread setup, parallel ops, frozen tensors in shared memory
+TRAINER_SCRIPT = """
+import sys
+sys.path[:0] = {paths!r}
+import numpy as np
+import torch
+from utils.device import cpu_throughput_mode
+from utils.shared_memory import share_array
+from utils.fold_pool import run_folds
+import test_fold_pool
+
+cpu_throughput_mode(4)
+emb = share_array(np.ones((1000, 300)))
+x = torch.randn(512, 512)
+(x @ x).sum()
+print(run_folds(test_fold_pool.make_fold, {{'emb': emb}}, test_fold_pool.SPLITS, num_workers=2, num_threads=2))
+"""
+
+SPLITS = [(np.arange(8), np.arange(8, 10)), (np.arange(2, 10), np.arange(2))]
+
+
+def make_fold(context):
+    emb = context['emb']
+
+    def one_fold(num_fold, train_index, dev_index):
+        # the first parallel op of the worker, where a runtime forked from a multi-threaded parent hangs
+        x = torch.randn(256, 256)
+        (x @ x).sum()
+        return num_fold, float(emb[train_index].sum()), torch.get_num_threads()
+    return one_fold
+
+
+def test_sequential_folds():
+    assert run_folds(make_fold, {'emb': torch.ones(10, 3)}, SPLITS) == [(0, 24.0, torch.get_num_threads()),
+                                                                      (1, 24.0, torch.get_num_threads())]
+
+
+def test_two_fold_workers_finish():
+    script = TRAINER_SCRIPT.format(paths=[os.path.dirname(TESTS_DIR), TESTS_DIR])
+    out = subprocess.run([sys.executable, '-c', script], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         universal_newlines=True, timeout=300)
+    assert out.returncode == 0, out.stderr
+    assert out.stdout.strip().split('\n')[-1] == str([(0, 2400.0, 2), (1, 2400.0, 2)])
+
+
+def make_sharing_fold(context):
+    shared, elmo_cache = context['shared'], context['elmo_cache']
+
+    def one_fold(num_fold, train_index, dev_index):
+        # written only to show the pages are the parent's, the trainers never write to them
+        shared[num_fold] = num_fold + 1
+        return float(elmo_cache.get(1).astype(np.float32).sum()), isinstance(elmo_cache.vectors, np.memmap)
+    return one_fold
+
+
+def test_workers_attach_shared_data(tmpdir):
+    from utils.elmo_cache import ElmoCache
+    from utils.shared_memory import share_array
+
+    elmo_cache = ElmoCache(str(tmpdir), {}, 'options', 'weights', dim=4)
+    vectors = np.arange(5 * 4, dtype=np.float16).reshape(5, 4)
+    np.save(os.path.join(elmo_cache.cache_dir, 'vectors.npy'), vectors)
+    np.save(os.path.join(elmo_cache.cache_dir, 'offsets.npy'), np.array([0, 2, 5], dtype=np.int64))
+    with open(os.path.join(elmo_cache.cache_dir, 'sentences.txt'), 'w') as f:
+        f.write('a b\nc d e')
+    with open(os.path.join(elmo_cache.cache_dir, 'meta.json'), 'w') as f:
+        f.write('{}')
+    elmo_cache = ElmoCache(str(tmpdir), {}, 'options', 'weights', dim=4)
+    # the store goes to the workers by path, not by value
+    assert elmo_cache.__getstate__()['vectors'] is None
+
+    shared = share_array(np.zeros(2))
+    results = run_folds(make_sharing_fold, {'shared': shared, 'elmo_cache': elmo_cache}, SPLITS, num_workers=2,
+                        num_threads=1)
+    assert results == [(float(vectors[2:].astype(np.float32).sum()), True)] * 2
+    assert shared.tolist() == [1, 2]
@@ -0,0 +1,38 @@
+"""
+    infer.py: the fold vote breaks ties like find_majority of the trainers.
+"""
+import torch
+from infer import majority_vote, NUM_EMO
+
+
+def find_majority(k):
+    # as in the trainers
+    myMap = {}
+    maximum = ('', 0)  # (occurring element, occurrences)
+    for n in k:
+        if n in myMap:
+            myMap[n] += 1
+        else:
+            myMap[n] = 1
+
+        # Keep track of maximum on the go
+        if myMap[n] > maximum[1]: maximum = (n, myMap[n])
+
+    return maximum
+
+
+def test_tied_vote():
+    fold_labels = torch.tensor([[0, 1, 1, 0, 2],   # 0 and 1 tied, 1 gets its second vote first
+                                [3, 2, 2, 3, 3],   # no tie
+                                [2, 3, 1, 0, 1],   # 1 alone has two votes
+                                [2, 3, 0, 1, 1]])  # 1 has two votes, the others one
+    assert majority_vote(fold_labels).tolist() == [1, 3, 1, 1]
+    assert majority_vote(torch.tensor([[3, 2, 1, 0]])).tolist() == [3]
+
+
+def test_same_labels_as_trainers():
+    generator = torch.Generator().manual_seed(0)
+    for num_folds in (1, 2, 4, 5, 10):
+        fold_labels = torch.randint(0, NUM_EMO, (500, num_folds), generator=generator)
+        expected = [find_majority(row)[0] for row in fold_labels.tolist()]
+        assert majority_vote(fold_labels).tolist() == expected
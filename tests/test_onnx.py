@@ -0,0 +1,28 @@
+"""
+    export_onnx.py: the ONNX graph of HRLCE gives the logits of the PyTorch model under onnxruntime.
+"""
+import pytest
+import torch
+from model.hrlce import HierarchicalPredictor
+from export_hrlce import example_inputs, load_hrlce
+from export_onnx import export_hrlce_onnx
+from utils.onnx_runtime import OnnxModel, compare_with_torch
+
+VOCAB_SIZE = 50
+
+
+def test_hrlce_onnx_parity(tmpdir):
+    pytest.importorskip('onnxruntime')
+    torch.manual_seed(0)
+    # randomly initialised, small glove part, TorchMoji has its own fixed sizes
+    state_dict = HierarchicalPredictor(16, 8, VOCAB_SIZE, USE_ELMO=True, ADD_LINEAR=False).state_dict()
+    out_path = str(tmpdir.join('hrlce.onnx'))
+    export_hrlce_onnx(state_dict, out_path)
+
+    model = load_hrlce(state_dict)
+    onnx_model = OnnxModel(out_path, num_threads=1)
+    # batch sizes other than the exported one, the batch axis is dynamic
+    batches = [example_inputs(batch_size, VOCAB_SIZE, seed=batch_size) for batch_size in (1, 7)]
+    max_diff, agreement, _, _ = compare_with_torch(model, onnx_model, batches)
+    assert max_diff < 1e-4
+    assert agreement == 1.
@@ -0,0 +1,74 @@
+"""
+    data/reader.py: batches of a file share one preprocessing pool and one cache connection.
+"""
+import multiprocessing
+import utils.tweet_processor as tweet_processor
+from data.reader import iter_conversation_batches
+
+
+def fake_pipeline(text):
+    return text.strip().lower()
+
+
+def _write_conversations(path, num):
+    with open(path, 'w', encoding='utf8') as f:
+        f.write('id\tturn1\tturn2\tturn3\tlabel\n')
+        for i in range(num):
+            f.write('{}\tHello {}\tHi\tHow ARE you {}\thappy\n'.format(i, i, i % 3))
+
+
+def test_one_pool_and_cache_per_file(tmpdir, monkeypatch):
+    data_path = str(tmpdir.join('train.txt'))
+    _write_conversations(data_path, 25)
+    opened = {'pool': 0, 'pool_closed': 0, 'cache': 0, 'cache_closed': 0}
+
+    class CountingPool(object):
+        def __init__(self, *args, **kwargs):
+            opened['pool'] += 1
+            self.pool = multiprocessing.get_context('fork').Pool(*args, **kwargs)
+
+        def map(self, *args, **kwargs):
+            return self.pool.map(*args, **kwargs)
+
+        def close(self):
+            opened['pool_closed'] += 1
+            self.pool.close()
+
+        def join(self):
+            self.pool.join()
+
+    class CountingCache(tweet_processor.PreprocessCache):
+        def __init__(self, *args, **kwargs):
+            opened['cache'] += 1
+            super(CountingCache, self).__init__(*args, config_hash='test', **kwargs)
+
+        def close(self):
+            opened['cache_closed'] += 1
+            super(CountingCache, self).close()
+
+    # forked workers see the patched pipeline, without the word statistics of ekphrasis
+    monkeypatch.setattr(tweet_processor, 'processing_pipeline', fake_pipeline)
+    monkeypatch.setattr(tweet_processor, 'build_text_processor', lambda: None)
+    monkeypatch.setattr(tweet_processor, 'Pool', CountingPool)
+    monkeypatch.setattr('data.reader.PreprocessCache', CountingCache)
+
+    batches = list(iter_conversation_batches(data_path, batch_size=10, workers=2,
+                                             cache_path=str(tmpdir.join('cache.sqlite'))))
+    assert [len(data_list) for data_list, _ in batches] == [10, 10, 5]
+    assert batches[2][0][0] == ('hello 20', 'hi', 'how are you 2', 'Hello 20', 'Hi', 'How ARE you 2')
+    assert opened == {'pool': 1, 'pool_closed': 1, 'cache': 1, 'cache_closed': 1}
+
+    # every text is cached now, no process is started
+    batches = list(iter_conversation_batches(data_path, batch_size=10, workers=2,
+                                             cache_path=str(tmpdir.join('cache.sqlite'))))
+    assert batches[2][0][0] == ('hello 20', 'hi', 'how are you 2', 'Hello 20', 'Hi', 'How ARE you 2')
+    assert opened == {'pool': 1, 'pool_closed': 1, 'cache': 2, 'cache_closed': 2}
+
+    # the generator releases them when abandoned too
+    _write_conversations(data_path, 35)
+    batches = iter_conversation_batches(data_path, batch_size=10, workers=2,
+                                        cache_path=str(tmpdir.join('cache.sqlite')))
+    for _ in range(4):
+        next(batches)
+    batches.close()
+    assert opened == {'pool': 2, 'pool_closed': 2, 'cache': 3, 'cache_closed': 3}
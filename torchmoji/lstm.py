@@ -2,6 +2,9 @@
 """ Implement a pyTorch LSTM with hard sigmoid reccurent activation functions.
     Adapted from the non-cuda variant of pyTorch LSTM at
     https://github.com/pytorch/pytorch/blob/master/torch/nn/_functions/rnn.py
+
+    The input-to-hidden projection of all timesteps is computed with one GEMM per layer and direction,
+    only the hidden-to-hidden part runs in the recurrence, as a TorchScript step.
 """
 
 from __future__ import print_function, division
@@ -75,7 +78,9 @@ class LSTMHardSigmoid(Module):
     def forward(self, input, hx=None):
         is_packed = isinstance(input, PackedSequence)
         if is_packed:
-            input, batch_sizes = input
+            packed_batch_sizes = input.batch_sizes
+            input = input.data
+            batch_sizes = packed_batch_sizes.tolist()
             max_batch_size = batch_sizes[0]
         else:
             batch_sizes = None
@@ -110,7 +115,7 @@ class LSTMHardSigmoid(Module):
         )
         output, hidden = func(input, self.all_weights, hx)
         if is_packed:
-            output = PackedSequence(output, batch_sizes)
+            output = PackedSequence(output, packed_batch_sizes)
         return output, hidden
 
     def __repr__(self):
@@ -152,6 +157,82 @@ class LSTMHardSigmoid(Module):
     def all_weights(self):
         return [[getattr(self, weight) for weight in weights] for weights in self._all_weights]
 
+
+class QuantizableLSTMHardSigmoid(Module):
+    """
+    LSTMHardSigmoid for inference, the input-to-hidden and hidden-to-hidden projections of every layer and
+    direction are nn.Linear modules. torch.quantization.quantize_dynamic turns them into int8 dynamic linear
+    layers like those of any other model, the recurrence itself is unchanged.
+    """
+    def __init__(self, input_size, hidden_size, num_layers=1, batch_first=False, bidirectional=False):
+        super(QuantizableLSTMHardSigmoid, self).__init__()
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.batch_first = batch_first
+        self.bidirectional = bidirectional
+        num_directions = 2 if bidirectional else 1
+
+        self.projections = torch.nn.ModuleList()
+        for layer in range(num_layers):
+            for direction in range(num_directions):
+                layer_input_size = input_size if layer == 0 else hidden_size * num_directions
+                self.projections.append(torch.nn.ModuleList([torch.nn.Linear(layer_input_size, 4 * hidden_size),
+                                                             torch.nn.Linear(hidden_size, 4 * hidden_size)]))
+
+    @classmethod
+    def from_float(cls, lstm):
+        """
+        Copy of a trained LSTMHardSigmoid, in evaluation mode
+        """
+        module = cls(lstm.input_size, lstm.hidden_size, num_layers=lstm.num_layers, batch_first=lstm.batch_first,
+                     bidirectional=lstm.bidirectional)
+        for (ih, hh), weights in zip(module.projections, lstm.all_weights):
+            ih.weight.data.copy_(weights[0].data)
+            hh.weight.data.copy_(weights[1].data)
+            if len(weights) == 4:
+                ih.bias.data.copy_(weights[2].data)
+                hh.bias.data.copy_(weights[3].data)
+            else:
+                ih.bias.data.zero_()
+                hh.bias.data.zero_()
+        module.eval()
+        return module
+
+    @property
+    def all_weights(self):
+        return [[ih, hh] for ih, hh in self.projections]
+
+    def forward(self, input, hx=None):
+        is_packed = isinstance(input, PackedSequence)
+        if is_packed:
+            packed_batch_sizes = input.batch_sizes
+            input = input.data
+            batch_sizes = packed_batch_sizes.tolist()
+            max_batch_size = batch_sizes[0]
+        else:
+            batch_sizes = None
+            max_batch_size = input.size(0) if self.batch_first else input.size(1)
+
+        if hx is None:
+            num_directions = 2 if self.bidirectional else 1
+            hx = input.new_zeros((self.num_layers * num_directions, max_batch_size, self.hidden_size))
+            hx = (hx, hx)
+
+        func = AutogradRNN(
+            self.input_size,
+            self.hidden_size,
+            num_layers=self.num_layers,
+            batch_first=self.batch_first,
+            train=False,
+            bidirectional=self.bidirectional,
+            batch_sizes=batch_sizes
+        )
+        output, hidden = func(input, self.all_weights, hx)
+        if is_packed:
+            output = PackedSequence(output, packed_batch_sizes)
+        return output, hidden
+
 def AutogradRNN(input_size, hidden_size, num_layers=1, batch_first=False,
                 dropout=0, train=True, bidirectional=False, batch_sizes=None,
                 dropout_state=None, flat_weight=None):
@@ -189,16 +270,16 @@ def AutogradRNN(input_size, hidden_size, num_layers=1, batch_first=False,
 
 def Recurrent(inner, reverse=False):
     def forward(input, hidden, weight):
-        output = []
+        output = None
         steps = range(input.size(0) - 1, -1, -1) if reverse else range(input.size(0))
         for i in steps:
             hidden = inner(input[i], hidden, *weight)
             # hack to handle LSTM
-            output.append(hidden[0] if isinstance(hidden, tuple) else hidden)
-
-        if reverse:
-            output.reverse()
-        output = torch.cat(output, 0).view(input.size(0), *output[0].size())
+            step_output = hidden[0] if isinstance(hidden, tuple) else hidden
+            # written in place, the steps are not concatenated at the end
+            if output is None:
+                output = step_output.new_empty((input.size(0),) + step_output.size())
+            output[i] = step_output
 
         return hidden, output
 
@@ -215,21 +296,22 @@ def variable_recurrent_factory(batch_sizes):
 
 def VariableRecurrent(batch_sizes, inner):
     def forward(input, hidden, weight):
-        output = []
+        output = None
         input_offset = 0
         last_batch_size = batch_sizes[0]
-        hiddens = []
         flat_hidden = not isinstance(hidden, tuple)
         if flat_hidden:
             hidden = (hidden,)
+        # final state of every sequence, the rows of the sequences that end are written as the batch shrinks
+        final_hidden = tuple(h.new_empty(h.size()) for h in hidden)
         for batch_size in batch_sizes:
             step_input = input[input_offset:input_offset + batch_size]
-            input_offset += batch_size
 
             dec = last_batch_size - batch_size
             if dec > 0:
-                hiddens.append(tuple(h[-dec:] for h in hidden))
-                hidden = tuple(h[:-dec] for h in hidden)
+                for fh, h in zip(final_hidden, hidden):
+                    fh[batch_size:last_batch_size] = h[batch_size:]
+                hidden = tuple(h[:batch_size] for h in hidden)
             last_batch_size = batch_size
 
             if flat_hidden:
@@ -237,15 +319,18 @@ def VariableRecurrent(batch_sizes, inner):
             else:
                 hidden = inner(step_input, hidden, *weight)
 
-            output.append(hidden[0])
-        hiddens.append(hidden)
-        hiddens.reverse()
+            # the packed output has the same layout as the packed input
+            if output is None:
+                output = hidden[0].new_empty((input.size(0), hidden[0].size(1)))
+            output[input_offset:input_offset + batch_size] = hidden[0]
+            input_offset += batch_size
+        for fh, h in zip(final_hidden, hidden):
+            fh[:last_batch_size] = h
 
-        hidden = tuple(torch.cat(h, 0) for h in zip(*hiddens))
+        hidden = final_hidden
         assert hidden[0].size(0) == batch_sizes[0]
         if flat_hidden:
             hidden = hidden[0]
-        output = torch.cat(output, 0)
 
         return hidden, output
 
@@ -254,7 +339,7 @@ def VariableRecurrent(batch_sizes, inner):
 
 def VariableRecurrentReverse(batch_sizes, inner):
     def forward(input, hidden, weight):
-        output = []
+        output = None
         input_offset = input.size(0)
         last_batch_size = batch_sizes[-1]
         initial_hidden = hidden
@@ -265,21 +350,24 @@ def VariableRecurrentReverse(batch_sizes, inner):
         hidden = tuple(h[:batch_sizes[-1]] for h in hidden)
         for batch_size in reversed(batch_sizes):
             inc = batch_size - last_batch_size
+            # only when new sequences start, i.e. once per distinct length. The state cannot grow in place,
+            # the previous step still needs it for the backward pass
             if inc > 0:
                 hidden = tuple(torch.cat((h, ih[last_batch_size:batch_size]), 0)
                                for h, ih in zip(hidden, initial_hidden))
             last_batch_size = batch_size
             step_input = input[input_offset - batch_size:input_offset]
-            input_offset -= batch_size
 
             if flat_hidden:
                 hidden = (inner(step_input, hidden[0], *weight),)
             else:
                 hidden = inner(step_input, hidden, *weight)
-            output.append(hidden[0])
 
-        output.reverse()
-        output = torch.cat(output, 0)
+            if output is None:
+                output = hidden[0].new_empty((input.size(0), hidden[0].size(1)))
+            output[input_offset - batch_size:input_offset] = hidden[0]
+            input_offset -= batch_size
+
         if flat_hidden:
             hidden = hidden[0]
         return hidden, output
@@ -302,8 +390,16 @@ def StackedRNN(inners, num_layers, lstm=False, dropout=0, train=True):
             all_output = []
             for j, inner in enumerate(inners):
                 l = i * num_directions + j
+                w_ih, w_hh = weight[l][:2]
+                b_ih, b_hh = weight[l][2:] if len(weight[l]) == 4 else (None, None)
 
-                hy, output = inner(input, hidden[l], weight[l])
+                # input-to-hidden projection of every timestep in a single GEMM
+                if isinstance(w_ih, torch.Tensor):
+                    input_gates = F.linear(input, w_ih, b_ih)
+                else:
+                    # projection module of QuantizableLSTMHardSigmoid, bias included
+                    input_gates = w_ih(input)
+                hy, output = inner(input_gates, hidden[l], (w_hh, b_hh))
                 next_hidden.append(hy)
                 all_output.append(output)
 
@@ -326,25 +422,46 @@ def StackedRNN(inners, num_layers, lstm=False, dropout=0, train=True):
 
     return forward
 
-def LSTMCell(input, hidden, w_ih, w_hh, b_ih=None, b_hh=None):
+def LSTMCell(input_gates, hidden, w_hh, b_hh=None):
     """
     A modified LSTM cell with hard sigmoid activation on the input, forget and output gates.
+    input_gates is the input-to-hidden projection of the step, F.linear(input, w_ih, b_ih).
     """
     hx, cx = hidden
-    gates = F.linear(input, w_ih, b_ih) + F.linear(hx, w_hh, b_hh)
+    if not isinstance(w_hh, torch.Tensor):
+        # projection module of QuantizableLSTMHardSigmoid, bias included
+        return lstm_hard_sigmoid_gates(input_gates + w_hh(hx), cx)
+    if b_hh is None:
+        b_hh = w_hh.new_zeros(w_hh.size(0))
+    return lstm_hard_sigmoid_step(input_gates, hx, cx, w_hh, b_hh)
 
+
+@torch.jit.script
+def lstm_hard_sigmoid_gates(gates, cx):
+    """
+    Gate activations and state update from the summed projections, hard_sigmoid is written as a clamp,
+    which gives the same values.
+    """
     ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
 
-    ingate = hard_sigmoid(ingate)
-    forgetgate = hard_sigmoid(forgetgate)
-    cellgate = F.tanh(cellgate)
-    outgate = hard_sigmoid(outgate)
+    ingate = torch.clamp(0.2 * ingate + 0.5, 0., 1.)
+    forgetgate = torch.clamp(0.2 * forgetgate + 0.5, 0., 1.)
+    cellgate = torch.tanh(cellgate)
+    outgate = torch.clamp(0.2 * outgate + 0.5, 0., 1.)
 
     cy = (forgetgate * cx) + (ingate * cellgate)
-    hy = outgate * F.tanh(cy)
+    hy = outgate * torch.tanh(cy)
 
     return hy, cy
 
+
+@torch.jit.script
+def lstm_hard_sigmoid_step(input_gates, hx, cx, w_hh, b_hh):
+    """
+    Fused recurrent step.
+    """
+    return lstm_hard_sigmoid_gates(input_gates + torch.addmm(b_hh, hx, w_hh.t()), cx)
+
 def hard_sigmoid(x):
     """
     Computes element-wise hard sigmoid of x.
@@ -166,11 +166,21 @@ class TorchMoji(nn.Module):
         if not self.feature_output:
             nn.init.xavier_uniform(self.output_layer[0].weight.data)
 
-    def forward(self, input_seqs):
+    @staticmethod
+    def sequence_lengths(input_seqs):
+        """ Lengths of a padded batch, i.e. index of the last non-zero token + 1 of every row,
+            computed for the whole batch at once and returned on the cpu for packing.
+        """
+        positions = torch.arange(1, input_seqs.size(1) + 1, device=input_seqs.device).expand_as(input_seqs)
+        return (positions * (input_seqs != 0).long()).max(1)[0].clamp(min=1).cpu()
+
+    def forward(self, input_seqs, input_lengths=None):
         """ Forward pass.
 
         # Arguments:
             input_seqs: Can be one of Numpy array, Torch.LongTensor, Torch.Variable, Torch.PackedSequence.
+            input_lengths: Optional lengths of the sequences (cpu LongTensor), derived from the padding if not given.
+                           Ignored for a PackedSequence.
 
         # Return:
             Same format as input format (except for PackedSequence returned as Variable).
@@ -188,20 +198,23 @@ class TorchMoji(nn.Module):
         # If we don't have a packed inputs, let's pack it
         reorder_output = False
         if not isinstance(input_seqs, PackedSequence):
-            ho = self.lstm_0.weight_hh_l0.data.new(2, input_seqs.size()[0], self.hidden_size).zero_()
-            co = self.lstm_0.weight_hh_l0.data.new(2, input_seqs.size()[0], self.hidden_size).zero_()
+            # dtype and device from the embedding, the LSTM weights may be quantized modules
+            ho = self.embed.weight.data.new(2, input_seqs.size()[0], self.hidden_size).zero_()
+            co = self.embed.weight.data.new(2, input_seqs.size()[0], self.hidden_size).zero_()
 
             # Reorder batch by sequence length
-            input_lengths = torch.LongTensor([torch.max(input_seqs[i, :].data.nonzero()) + 1 for i in range(input_seqs.size()[0])])
-            input_lengths, perm_idx = input_lengths.sort(0, descending=True)
-            input_seqs = input_seqs[perm_idx][:, :input_lengths.max()]
+            if input_lengths is None:
+                input_lengths = self.sequence_lengths(input_seqs)
+            input_lengths, perm_idx = input_lengths.view(-1).sort(0, descending=True)
+            perm_idx = perm_idx.to(input_seqs.device)
+            input_seqs = input_seqs[perm_idx][:, :int(input_lengths[0])]
 
             # Pack sequence and work on data tensor to reduce embeddings/dropout computations
             packed_input = pack_padded_sequence(input_seqs, input_lengths.cpu().numpy(), batch_first=True)
             reorder_output = True
         else:
-            ho = self.lstm_0.weight_hh_l0.data.data.new(2, input_seqs.size()[0], self.hidden_size).zero_()
-            co = self.lstm_0.weight_hh_l0.data.data.new(2, input_seqs.size()[0], self.hidden_size).zero_()
+            ho = self.embed.weight.data.new(2, input_seqs.size()[0], self.hidden_size).zero_()
+            co = self.embed.weight.data.new(2, input_seqs.size()[0], self.hidden_size).zero_()
             input_lengths = input_seqs.batch_sizes
             packed_input = input_seqs
 
@@ -6,6 +6,7 @@ numbers, according to the given vocabulary.
 from __future__ import print_function, division, unicode_literals
 
 import numbers
+import multiprocessing
 import numpy as np
 
 from torchmoji.create_vocab import extend_vocab, VocabBuilder
@@ -18,6 +19,22 @@ from sklearn.model_selection import train_test_split
 
 from copy import deepcopy
 
+# fewer sentences per process than this are tokenized faster than a pool starts
+MIN_SENTENCES_PER_WORKER = 2000
+
+# tokenizer of the pool processes of tokenize_sentences_bulk, set once per process
+_bulk_tokenizer = None
+
+
+def _init_bulk_worker(tokenizer):
+    global _bulk_tokenizer
+    _bulk_tokenizer = tokenizer
+
+
+def _tokenize_shard(sentences):
+    return _bulk_tokenizer.tokenize_sentences(sentences)[0]
+
+
 class SentenceTokenizer():
     """ Create numpy array of tokens corresponding to input sentences.
         The vocabulary can include Unicode tokens.
@@ -124,15 +141,42 @@ class SentenceTokenizer():
 
         return tokens, infos, self.wordgen.stats
 
+    def tokenize_sentences_bulk(self, sentences, workers=1):
+        """ Tokenizes a whole list of sentences, e.g. all the turns of a
+            dataset, into a single array. The sentences are sharded across a
+            process pool, each shard is one tokenize_sentences call.
+
+        # Arguments:
+            sentences: List of sentences to be tokenized.
+            workers: Number of processes, 0 uses all cores, 1 runs in the
+                current process. Small lists always run in the current
+                process.
+
+        # Returns:
+            Numpy uint16 array (len(sentences), fixed_length) of the tokens,
+            the same as the first output of tokenize_sentences.
+        """
+        if workers <= 0:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, len(sentences) // MIN_SENTENCES_PER_WORKER)
+        if workers <= 1:
+            return self.tokenize_sentences(sentences)[0]
+
+        # contiguous shards, so the rows come back in the order of the sentences
+        shard_size = (len(sentences) + workers - 1) // workers
+        shards = [sentences[i:i + shard_size] for i in range(0, len(sentences), shard_size)]
+        pool = multiprocessing.Pool(workers, initializer=_init_bulk_worker, initargs=(self,))
+        try:
+            return np.concatenate(pool.map(_tokenize_shard, shards, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+
     def find_tokens(self, words):
         assert len(words) > 0
-        tokens = []
-        for w in words:
-            try:
-                tokens.append(self.vocabulary[w])
-            except KeyError:
-                tokens.append(self.unknown_value)
-        return tokens
+        vocabulary = self.vocabulary
+        unknown_value = self.unknown_value
+        return [vocabulary.get(w, unknown_value) for w in words]
 
     def split_train_val_test(self, sentences, info_dicts,
                              split_parameter=[0.7, 0.1, 0.2], extend_with=0):
@@ -100,10 +100,12 @@ class WordGenerator():
     def check_ascii(self, word):
         """ Returns whether a word is ASCII """
 
+        # encode, python 3 str has no decode and every word would take the
+        # per-character conversion of convert_unicode_word
         try:
-            word.decode('ascii')
+            word.encode('ascii')
             return True
-        except (UnicodeDecodeError, UnicodeEncodeError, AttributeError):
+        except (UnicodeDecodeError, UnicodeEncodeError):
             return False
 
     def convert_unicode_punctuation(self, word):
@@ -3,7 +3,6 @@ import os
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
 from utils.early_stopping import EarlyStopping
 import numpy as np
 import copy
@@ -16,8 +15,16 @@ import sys
 import argparse
 import random
 from utils.focalloss import FocalLoss
-from utils.tweet_processor import processing_pipeline
+from utils.device import get_device, cpu_throughput_mode, inference_mode
+from utils.checkpoint import save_fold_model, save_training_state, save_fold_result, load_training_state, \
+    restore_training_state, clear_training_state, data_order, run_configuration
+from utils.fold_pool import run_folds
+from utils.shared_memory import share_state_dict
+from data.reader import iter_conversation_batches
+from data.sampler import BucketBatchSampler
+from data.columnar import ColumnarDataSet, RaggedColumn, BatchLoader, label_columns
 from copy import deepcopy
+from collections import OrderedDict
 
 parser = argparse.ArgumentParser(description='Options')
 parser.add_argument('-folds', default=9, type=int,
@@ -53,8 +60,30 @@ parser.add_argument('-size', default = 'base', type=str,
 parser.add_argument('-padlen', default = 30, type=int,
                     help='padding size, default is 30')
 
+parser.add_argument('-workers', default=0, type=int,
+                    help="processes used for text preprocessing, 0 uses all cores")
+parser.add_argument('-device', default=None, type=str,
+                    help="cpu, cuda or cuda:N, default is cuda when available")
+parser.add_argument('-threads', default=0, type=int,
+                    help="intra-op threads in cpu mode (of each fold process with -foldworkers), 0 keeps the torch default")
+parser.add_argument('-foldworkers', default=1, type=int,
+                    help="folds trained at the same time in separate processes, cpu only")
+parser.add_argument('-savedir', default='checkpoints/bert', type=str,
+                    help="directory of the fold checkpoints")
+parser.add_argument('-resume', default=0, type=int,
+                    help="1 resumes the interrupted run saved in -savedir, with the same options; 0 starts again")
+parser.add_argument('-bucket', default=1, type=int,
+                    help="1 batches training conversations of similar length together, 0 shuffles them freely")
 opt = parser.parse_args()
 
+DEVICE = get_device(opt.device)
+if DEVICE.type == 'cpu':
+    cpu_throughput_mode(opt.threads)
+elif opt.foldworkers > 1:
+    raise ValueError('Parallel folds (-foldworkers) run on cpu only')
+# pinned memory speeds up the copies of the batches to the gpu
+PIN_MEMORY = DEVICE.type == 'cuda'
+
 if opt.half == 'True':
     HALF_PRECISION = True
 elif opt.half == 'False':
@@ -103,35 +132,15 @@ def load_data_context(data_path='data/train.txt', is_train=True):
 
     data_list = []
     target_list = []
-    f_data = open(data_path, 'r')
-    data_lines = f_data.readlines()
-    f_data.close()
-
-    for i, text in enumerate(data_lines):
-        # skip the first line
-        if i == 0:
-            continue
-
-        tokens = text.split('\t')
-
-        convers = tokens[1:CONV_PAD_LEN+1]
-
-        a = convers[0]
-        b = convers[1]
-        c = convers[2]
-
-        a = processing_pipeline(a)
-        b = processing_pipeline(b)
-        c = processing_pipeline(c)
-
-        a_len = len(a.split())
-        b_len = len(b.split())
-        c_len = len(c.split())
+    # preprocessing is streamed in batches and cached on disk
+    for batch, targets in iter_conversation_batches(data_path, is_train=is_train, workers=opt.workers):
+        for a, b, c, _, _, _ in batch:
+            a_len = len(a.split())
+            b_len = len(b.split())
+            c_len = len(c.split())
 
-        data_list.append((a, a_len, b, b_len, c, c_len))
-        if is_train:
-            emo = tokens[CONV_PAD_LEN + 1].strip()
-            target_list.append(EMOS_DIC[emo])
+            data_list.append((a, a_len, b, b_len, c, c_len))
+        target_list.extend(targets)
 
     if is_train:
         return data_list, target_list
@@ -139,32 +148,37 @@ def load_data_context(data_path='data/train.txt', is_train=True):
         return data_list
 
 
-class DataSet(Dataset):
+def token_columns(tokens, token_segments):
+    """
+    :param tokens: BERT ids of every conversation, cut to the padding length
+    :param token_segments: segment id of every token
+    :return: OrderedDict of the token, mask and segment columns
+    """
+    columns = OrderedDict()
+    columns['tokens'] = RaggedColumn(tokens)
+    columns['token_masks'] = RaggedColumn([np.ones(len(x)) for x in tokens], dtype=np.uint8)
+    columns['token_segments'] = RaggedColumn(token_segments, dtype=np.uint8)
+    return columns
+
+
+class DataSet(ColumnarDataSet):
     def __init__(self, data_list, target_list, sent_pad_len):
 
         self.sent_pad_len = sent_pad_len
         self.word2id = 0
         self.pad_int = 0
 
-        # set max size for the purpose of testing
-
-        # internal data
-        self.tokens = []
-        self.token_masks = []
-        self.token_segments = []
-        self.e_c = []
-        self.e_c_binary = []
-        self.e_c_emo = []
-
         self.num_empty_lines = 0
         # prepare dataset
-        self.read_data(data_list, target_list)
+        super(DataSet, self).__init__(self.read_data(data_list, target_list))
 
     def read_data(self, data_list, target_list):
 
         assert len(data_list) == len(target_list)
 
-        for X, y in zip(data_list, target_list):
+        tokens = []
+        token_segments = []
+        for X in data_list:
             a, _, b, _, c, _ = X
 
             a = tokenizer.tokenize(a)
@@ -187,62 +201,31 @@ class DataSet(Dataset):
 
             token_seg = [0] * (a_len + b_len - 1) + [1] * (c_len+1)
 
-            if len(combined_tokens) > self.sent_pad_len:
-                combined_tokens = combined_tokens[:self.sent_pad_len]
-                mask = [1] * self.sent_pad_len
-                token_seg = token_seg[:self.sent_pad_len]
-            else:
-                combined_tokens = combined_tokens + [self.pad_int] * (self.sent_pad_len - len(combined_tokens))
-                mask = [1] * (a_len + b_len + c_len) + [0] * (self.sent_pad_len - (a_len + b_len + c_len))
-                token_seg = token_seg + [self.pad_int] * (self.sent_pad_len - len(token_seg))
+            # cut to sent_pad_len, batches are padded to their longest conversation
+            tokens.append(combined_tokens[:self.sent_pad_len])
+            token_segments.append(token_seg[:self.sent_pad_len])
 
-            self.tokens.append(combined_tokens)
+        columns = token_columns(tokens, token_segments)
+        columns.update(label_columns(target_list, len(EMOS)))
+        return columns
 
-            self.token_masks.append(mask)
 
-            self.token_segments.append(token_seg)
-
-            self.e_c.append(int(y))
-
-            self.e_c_binary.append(1 if int(y) == len(EMOS) - 1 else 0)
-
-            e_c_emo = [0] * (len(EMOS) - 1)
-            if int(y) < len(EMOS) - 1:  # i.e. only first three emotions
-                e_c_emo[int(y)] = 1
-            self.e_c_emo.append(e_c_emo)
-
-    def __len__(self):
-        return len(self.tokens)
-
-    def __getitem__(self, idx):
-        return torch.LongTensor(self.tokens[idx]),\
-               torch.LongTensor(self.token_masks[idx]),\
-               torch.LongTensor(self.token_segments[idx]), \
-               torch.LongTensor([self.e_c[idx]]), \
-               torch.LongTensor([self.e_c_binary[idx]]), \
-               torch.FloatTensor(self.e_c_emo[idx])
-
-
-class TestDataSet(Dataset):
+class TestDataSet(ColumnarDataSet):
     def __init__(self, data_list, sent_pad_len):
 
         self.sent_pad_len = sent_pad_len
         self.word2id = 0
         self.pad_int = 0
 
-        # internal data
-        self.tokens = []
-        self.token_masks = []
-        self.token_segments = []
-        self.e_c = []
-
         self.num_empty_lines = 0
         # prepare dataset
 
-        self.read_data(data_list)
+        super(TestDataSet, self).__init__(self.read_data(data_list))
 
     def read_data(self, data_list):
 
+        tokens = []
+        token_segments = []
         for X in data_list:
             a, _, b, _, c, _ = X
 
@@ -266,84 +249,46 @@ class TestDataSet(Dataset):
 
             token_seg = [0] * (a_len + b_len - 1) + [1] * (c_len+1)
 
-            if len(combined_tokens) > self.sent_pad_len:
-                combined_tokens = combined_tokens[:self.sent_pad_len]
-                mask = [1] * self.sent_pad_len
-                token_seg = token_seg[:self.sent_pad_len]
-            else:
-                combined_tokens = combined_tokens + [self.pad_int] * (self.sent_pad_len - len(combined_tokens))
-                mask = [1] * (a_len + b_len + c_len) + [0] * (self.sent_pad_len - (a_len + b_len + c_len))
-                token_seg = token_seg + [self.pad_int] * (self.sent_pad_len - len(token_seg))
-
-            self.tokens.append(combined_tokens)
-
-            self.token_masks.append(mask)
-
-            self.token_segments.append(token_seg)
-
-    def __len__(self):
-        return len(self.tokens)
-
-    def __getitem__(self, idx):
-        return torch.LongTensor(self.tokens[idx]), \
-               torch.LongTensor(self.token_masks[idx]), \
-               torch.LongTensor(self.token_segments[idx])
-
-
-def main():
-    # load data
-    path = 'data/train.txt'
-    data_list, target_list = load_data_context(path)
-
-    # build vocab
-
-    X = data_list
-    y = target_list
-    y = np.array(y)
-
-    combined = list(zip(X, y))
-    random.shuffle(combined)
-    X[:], y[:] = zip(*combined)
-
-    # skf.get_n_splits(X, y)
-    # train dev split
-    from sklearn.model_selection import StratifiedKFold
-    skf = StratifiedKFold(n_splits=NUM_OF_FOLD, random_state=0)
-    all_fold_results = []
-    real_test_results = []
-    # dev set
-    dev_file = 'data/dev.txt'
-    dev_data_list, dev_target_list = load_data_context(data_path=dev_file)
-
-    # test set
-    gold_test_file = 'data/test.txt'
-    gold_test_data_list, gold_test_target_list = load_data_context(data_path=gold_test_file)
+            # cut to sent_pad_len, batches are padded to their longest conversation
+            tokens.append(combined_tokens[:self.sent_pad_len])
+            token_segments.append(token_seg[:self.sent_pad_len])
 
-    gold_dev_data_set = DataSet(dev_data_list, dev_target_list, SENT_PAD_LEN)
-    gold_dev_data_loader = DataLoader(gold_dev_data_set, batch_size=BATCH_SIZE, shuffle=False)
-    print("Size of test data", len(gold_dev_data_set))
+        return token_columns(tokens, token_segments)
 
-    gold_test_data_set = DataSet(gold_test_data_list, gold_test_target_list, SENT_PAD_LEN)
-    gold_test_data_loader = DataLoader(gold_test_data_set, batch_size=BATCH_SIZE, shuffle=False)
-    print("Size of test data", len(gold_test_data_set))
 
-    test_file = 'data/testwithoutlabels.txt'
-    test_data_list = load_data_context(data_path=test_file, is_train=False)
-    test_data_set = TestDataSet(test_data_list, SENT_PAD_LEN)
-    test_data_loader = DataLoader(test_data_set, batch_size=BATCH_SIZE, shuffle=False)
+def make_one_fold(context):
+    """
+    Fold training of main, built from what the folds share so that it also runs in the spawned processes
+    of utils/fold_pool.py
+    :param context: dict of the datasets, embeddings and pretrained weights of main
+    :return: function (num_fold, train_index, dev_index) -> predictions of the fold
+    """
+    full_data_set = context['full_data_set']
+    pretrained_bert = context['pretrained_bert']
+    model_config = context['model_config']
+    run_config = context['run_config']
+    gold_dev_data_loader = BatchLoader(context['gold_dev_data_set'], batch_size=BATCH_SIZE, pin_memory=PIN_MEMORY)
+    gold_test_data_loader = BatchLoader(context['gold_test_data_set'], batch_size=BATCH_SIZE, pin_memory=PIN_MEMORY)
 
     def one_fold(num_fold, train_index, dev_index):
         print("Training on fold:", num_fold)
-        X_train, X_dev = [X[i] for i in train_index], [X[i] for i in dev_index]
-        y_train, y_dev = y[train_index], y[dev_index]
+        state = load_training_state(opt.savedir, num_fold, run_config) if opt.resume == 1 else None
+        if state is not None and state['completed']:
+            print('Fold', num_fold, 'already trained, skipping')
+            return state['predictions']['pred_list_test_best'], state['predictions']['final_pred_best']
 
-        # construct data loader
-        train_data_set = DataSet(X_train, y_train, SENT_PAD_LEN)
+        # construct data loader, the folds are views of the training set tokenized once in main
+        train_data_set = full_data_set.subset(train_index)
         
-        train_data_loader = DataLoader(train_data_set, batch_size=BATCH_SIZE, shuffle=True)
+        if opt.bucket == 1:
+            # conversations are batched by their number of tokens
+            train_sampler = BucketBatchSampler(train_data_set.row_lengths('tokens'), BATCH_SIZE)
+            train_data_loader = BatchLoader(train_data_set, batch_sampler=train_sampler, pin_memory=PIN_MEMORY)
+        else:
+            train_data_loader = BatchLoader(train_data_set, batch_size=BATCH_SIZE, shuffle=True, pin_memory=PIN_MEMORY)
 
-        dev_data_set = DataSet(X_dev, y_dev, SENT_PAD_LEN)
-        dev_data_loader = DataLoader(dev_data_set, batch_size=BATCH_SIZE, shuffle=False)
+        dev_data_set = full_data_set.subset(dev_index)
+        dev_data_loader = BatchLoader(dev_data_set, batch_size=BATCH_SIZE, pin_memory=PIN_MEMORY)
         gradient_accumulation_steps = 1
         num_train_steps = int(
             len(train_data_set) / BATCH_SIZE / gradient_accumulation_steps * MAX_EPOCH)
@@ -353,13 +298,13 @@ def main():
         # This is to prevent model diverge, once happen, retrain
         while True:
             is_diverged = False
-            model = BERT_classifer.from_pretrained(BERT_MODEL)
+            model = BERT_classifer.from_pretrained(BERT_MODEL, state_dict=pretrained_bert)
             model.add_output_layer(BERT_MODEL, NUM_EMO)
             model = nn.DataParallel(model)
             if HALF_PRECISION:
                 # model = network_to_half(model)
                 model.half()
-            model.cuda()
+            model.to(DEVICE)
 
             # BERT optimizer
             param_optimizer = list(model.named_parameters())
@@ -383,10 +328,10 @@ def main():
                 weight_list_binary = [2 - weight_list[-1], weight_list[-1]]
 
             weight_list = [x**FLAT for x in weight_list]
-            weight_label = torch.Tensor(weight_list).cuda()
+            weight_label = torch.Tensor(weight_list).to(DEVICE)
 
             weight_list_binary = [x**FLAT for x in weight_list_binary]
-            weight_binary = torch.Tensor(weight_list_binary).cuda()
+            weight_binary = torch.Tensor(weight_list_binary).to(DEVICE)
             print('binary loss reweight = weight_list_binary', weight_list_binary)
             # loss_criterion_binary = nn.CrossEntropyLoss(weight=weight_list_binary)  #
             if opt.loss == 'focal':
@@ -403,7 +348,15 @@ def main():
             final_pred_best = None
             final_pred_list_test = None
             pred_list_test = None
-            for num_epoch in range(MAX_EPOCH):
+            start_epoch = 0
+            if state is not None:
+                start_epoch = restore_training_state(state, model, optimizer, None, es)
+                pred_list_test_best = state['predictions']['pred_list_test_best']
+                final_pred_best = state['predictions']['final_pred_best']
+                pred_list_test = state['predictions']['pred_list_test']
+                final_pred_list_test = state['predictions']['final_pred_list_test']
+                state = None
+            for num_epoch in range(start_epoch, MAX_EPOCH):
                 print('Begin training epoch:', num_epoch)
                 sys.stdout.flush()
                 train_loss = 0
@@ -413,19 +366,19 @@ def main():
                     optimizer.zero_grad()
 
                     if USE_TOKEN_TYPE:
-                        pred, pred2, pred3 = model(tokens.cuda(), masks.cuda(), segments.cuda())
+                        pred, pred2, pred3 = model(tokens.to(DEVICE), masks.to(DEVICE), segments.to(DEVICE))
                     else:
-                        pred, pred2, pred3 = model(tokens.cuda(), masks.cuda())
+                        pred, pred2, pred3 = model(tokens.to(DEVICE), masks.to(DEVICE))
 
-                    loss_label = loss_criterion(pred, e_c.view(-1).cuda()).cuda()
-                    loss_label = torch.matmul(torch.gather(weight_label, 0, e_c.view(-1).cuda()), loss_label) / \
+                    loss_label = loss_criterion(pred, e_c.view(-1).to(DEVICE)).to(DEVICE)
+                    loss_label = torch.matmul(torch.gather(weight_label, 0, e_c.view(-1).to(DEVICE)), loss_label) / \
                                  e_c.view(-1).shape[0]
 
-                    loss_binary = loss_criterion_binary(pred2, e_c_binary.view(-1).cuda()).cuda()
-                    loss_binary = torch.matmul(torch.gather(weight_binary, 0, e_c_binary.view(-1).cuda()),
+                    loss_binary = loss_criterion_binary(pred2, e_c_binary.view(-1).to(DEVICE)).to(DEVICE)
+                    loss_binary = torch.matmul(torch.gather(weight_binary, 0, e_c_binary.view(-1).to(DEVICE)),
                                                loss_binary) / e_c.view(-1).shape[0]
 
-                    loss_emo = loss_criterion_emo_only(pred3, e_c_emo.cuda())
+                    loss_emo = loss_criterion_emo_only(pred3, e_c_emo.to(DEVICE))
 
                     loss = (loss_label + LAMBDA1 * loss_binary + LAMBDA2 * loss_emo) / float(1 + LAMBDA1 + LAMBDA2)
 
@@ -444,21 +397,21 @@ def main():
                 # pred_list = []
                 # gold_list = []
                 for i, (tokens, masks, segments, e_c, e_c_binary, e_c_emo) in enumerate(dev_data_loader):
-                    with torch.no_grad():
+                    with inference_mode():
                         if USE_TOKEN_TYPE:
-                            pred, pred2, pred3 = model(tokens.cuda(), masks.cuda(), segments.cuda())
+                            pred, pred2, pred3 = model(tokens.to(DEVICE), masks.to(DEVICE), segments.to(DEVICE))
                         else:
-                            pred, pred2, pred3 = model(tokens.cuda(), masks.cuda())
+                            pred, pred2, pred3 = model(tokens.to(DEVICE), masks.to(DEVICE))
 
-                        loss_label = loss_criterion(pred, e_c.view(-1).cuda()).cuda()
-                        loss_label = torch.matmul(torch.gather(weight_label, 0, e_c.view(-1).cuda()), loss_label) / \
+                        loss_label = loss_criterion(pred, e_c.view(-1).to(DEVICE)).to(DEVICE)
+                        loss_label = torch.matmul(torch.gather(weight_label, 0, e_c.view(-1).to(DEVICE)), loss_label) / \
                                      e_c.view(-1).shape[0]
 
-                        loss_binary = loss_criterion_binary(pred2, e_c_binary.view(-1).cuda()).cuda()
-                        loss_binary = torch.matmul(torch.gather(weight_binary, 0, e_c_binary.view(-1).cuda()),
+                        loss_binary = loss_criterion_binary(pred2, e_c_binary.view(-1).to(DEVICE)).to(DEVICE)
+                        loss_binary = torch.matmul(torch.gather(weight_binary, 0, e_c_binary.view(-1).to(DEVICE)),
                                                    loss_binary) / e_c.view(-1).shape[0]
 
-                        loss_emo = loss_criterion_emo_only(pred3, e_c_emo.cuda())
+                        loss_emo = loss_criterion_emo_only(pred3, e_c_emo.to(DEVICE))
 
                         loss = (loss_label + LAMBDA1 * loss_binary + LAMBDA2 * loss_emo) / float(1 + LAMBDA1 + LAMBDA2)
 
@@ -490,6 +443,7 @@ def main():
                 else:
                     if es.is_best():
                         print('saving best model ...')
+                        save_fold_model(opt.savedir, num_fold, model, model_config)
                         if final_pred_best is not None:
                             del final_pred_best
                         final_pred_best = deepcopy(final_pred_list_test)
@@ -499,6 +453,8 @@ def main():
                     else:
                         print('not best model, ignoring ...')
                         if final_pred_best is None:
+                            # first epoch, the early stopping reference
+                            save_fold_model(opt.savedir, num_fold, model, model_config)
                             final_pred_best = deepcopy(final_pred_list_test)
                         if pred_list_test_best is None:
                             pred_list_test_best = deepcopy(pred_list_test)
@@ -507,11 +463,11 @@ def main():
                 pred_list_test = []
                 model.eval()
                 for i, (tokens, masks, segments, e_c, e_c_binary, e_c_emo) in enumerate(gold_dev_data_loader):
-                    with torch.no_grad():
+                    with inference_mode():
                         if USE_TOKEN_TYPE:
-                            pred, _, _ = model(tokens.cuda(), masks.cuda(), segments.cuda())
+                            pred, _, _ = model(tokens.to(DEVICE), masks.to(DEVICE), segments.to(DEVICE))
                         else:
-                            pred, _, _ = model(tokens.cuda(), masks.cuda())
+                            pred, _, _ = model(tokens.to(DEVICE), masks.to(DEVICE))
                         pred_list_test.append(pred.data.cpu().numpy())
 
                 pred_list_test = np.argmax(np.concatenate(pred_list_test, axis=0), axis=1)
@@ -521,33 +477,96 @@ def main():
                 final_pred_list_test = []
                 model.eval()
                 for i, (tokens, masks, segments, e_c, e_c_binary, e_c_emo) in enumerate(gold_test_data_loader):
-                    with torch.no_grad():
+                    with inference_mode():
                         if USE_TOKEN_TYPE:
-                            pred, _, _ = model(tokens.cuda(), masks.cuda(), segments.cuda())
+                            pred, _, _ = model(tokens.to(DEVICE), masks.to(DEVICE), segments.to(DEVICE))
                         else:
-                            pred, _, _ = model(tokens.cuda(), masks.cuda())
+                            pred, _, _ = model(tokens.to(DEVICE), masks.to(DEVICE))
                         final_pred_list_test.append(pred.data.cpu().numpy())
 
                 final_pred_list_test = np.argmax(np.concatenate(final_pred_list_test, axis=0), axis=1)
                 # get_metrics(load_dev_labels('data/test.txt'), final_pred_list_test)
 
+                save_training_state(opt.savedir, num_fold, num_epoch, model, optimizer, None, es,
+                                    {'pred_list_test_best': pred_list_test_best, 'final_pred_best': final_pred_best,
+                                     'pred_list_test': pred_list_test, 'final_pred_list_test': final_pred_list_test},
+                                    run_config)
+
             if is_diverged:
                 print("Reinitialize model ...")
+                clear_training_state(opt.savedir, num_fold)
                 del model
                 continue
-            all_fold_results.append(pred_list_test_best)
-            real_test_results.append(final_pred_best)
-
+            save_fold_result(opt.savedir, num_fold, {'pred_list_test_best': pred_list_test_best,
+                                                     'final_pred_best': final_pred_best}, run_config)
             del model
-            break
+            return pred_list_test_best, final_pred_best
+
+    return one_fold
+
+
+def main():
+    # load data
+    path = 'data/train.txt'
+    data_list, target_list = load_data_context(path)
+
+    # build vocab
+
+    X = data_list
+    y = target_list
+    y = np.array(y)
+
+    # saved with the weights of every fold, for inference
+    model_config = {'model': 'bert', 'bert_model': BERT_MODEL, 'sent_pad_len': SENT_PAD_LEN,
+                    'use_token_type': USE_TOKEN_TYPE}
+
+    order = list(range(len(X)))
+    random.shuffle(order)
+    # an interrupted run is resumed on the same folds, only by a run with the same configuration
+    run_config = run_configuration(opt, model_config)
+    order = data_order(opt.savedir, order, run_config, opt.resume == 1)
+    X[:] = [X[i] for i in order]
+    y = y[order]
+
+    # skf.get_n_splits(X, y)
+    # train dev split
+    from sklearn.model_selection import StratifiedKFold
+    skf = StratifiedKFold(n_splits=NUM_OF_FOLD, random_state=0)
+    # dev set
+    dev_file = 'data/dev.txt'
+    dev_data_list, dev_target_list = load_data_context(data_path=dev_file)
+
+    # test set
+    gold_test_file = 'data/test.txt'
+    gold_test_data_list, gold_test_target_list = load_data_context(data_path=gold_test_file)
+
+    gold_dev_data_set = DataSet(dev_data_list, dev_target_list, SENT_PAD_LEN)
+    print("Size of test data", len(gold_dev_data_set))
+
+    gold_test_data_set = DataSet(gold_test_data_list, gold_test_target_list, SENT_PAD_LEN)
+    print("Size of test data", len(gold_test_data_set))
+
+    test_file = 'data/testwithoutlabels.txt'
+    test_data_list = load_data_context(data_path=test_file, is_train=False)
+    test_data_set = TestDataSet(test_data_list, SENT_PAD_LEN)
+    test_data_loader = BatchLoader(test_data_set, batch_size=BATCH_SIZE, pin_memory=PIN_MEMORY)
+    # pretrained weights read once, in shared memory for the fold processes
+    pretrained_bert = share_state_dict(BERT_classifer.from_pretrained(BERT_MODEL).state_dict())
 
     if torch.cuda.device_count() > 1:
         print("Let's use", torch.cuda.device_count(), "GPUs!")
 
-    # Training the folds
-    for idx, (_train_index, _dev_index) in enumerate(skf.split(X, y)):
-        print('Train size:', len(_train_index), 'Dev size:', len(_dev_index))
-        one_fold(idx, _train_index, _dev_index)
+    # the whole training set is tokenized once, the folds only index it
+    full_data_set = DataSet(X, y, SENT_PAD_LEN)
+
+    # what the folds share, sent to every fold process
+    context = {'full_data_set': full_data_set, 'pretrained_bert': pretrained_bert,
+               'model_config': model_config, 'run_config': run_config, 'gold_dev_data_set': gold_dev_data_set,
+               'gold_test_data_set': gold_test_data_set}
+    # Training the folds, -foldworkers of them at a time
+    fold_results = run_folds(make_one_fold, context, skf.split(X, y), opt.foldworkers, opt.threads)
+    all_fold_results = [pred_list_test_best for pred_list_test_best, _ in fold_results]
+    real_test_results = [final_pred_best for _, final_pred_best in fold_results]
 
     # Function of majority voting
     def find_majority(k):
@@ -599,4 +618,5 @@ def main():
     f_out.close()
     print('Final testing')
 
-main()
+if __name__ == '__main__':
+    main()
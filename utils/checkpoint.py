@@ -0,0 +1,197 @@
+"""
+    Fold checkpoints. Every fold of a trainer saves the weights of its best epoch with the configuration
+    needed to rebuild the model (sizes, vocabulary, padding), so the fold ensemble can be served without
+    retraining, see infer.py.
+
+    The training state is saved after every epoch as well, so an interrupted K-fold run can be resumed (-resume 1
+    of the trainers) where it stopped: completed folds are skipped (their predictions are kept for the majority
+    vote) and the current fold goes on from its last epoch. Every state carries the configuration of its run
+    (run_configuration), a run with other options or another vocabulary refuses to resume from it. A run that
+    does not resume starts again and removes the training states and the fold weights of the previous one.
+
+    Files in <save_dir>/:
+        fold<k>.pt          {'fold': k, 'config': dict, 'model': state dict}
+        state_fold<k>.pt    training state of fold k, or its predictions once completed
+        data_order.json     {'config': dict, 'order': list}, shuffled order of the training conversations,
+                            the folds depend on it
+"""
+import os
+import glob
+import json
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+# options that only change how a run uses the machine or where it writes, a run may resume with other values
+RESOURCE_OPTIONS = ('workers', 'threads', 'foldworkers', 'device', 'elmocache', 'savedir', 'postname', 'resume')
+
+
+def run_configuration(opt, model_config):
+    """
+    :param opt: parsed options of the trainer
+    :param model_config: the config saved with the fold weights, it holds the vocabulary
+    :return: what a resumed run must share with the interrupted one, as plain json values
+    """
+    options = {k: v for k, v in vars(opt).items() if k not in RESOURCE_OPTIONS}
+    return json.loads(json.dumps({'options': options, 'model': model_config}, sort_keys=True))
+
+
+def _check_configuration(path, saved, config):
+    if saved != config:
+        raise ValueError('{} was saved by a run with other options or another vocabulary, it cannot be '
+                         'resumed with these ones; run without -resume to start again'.format(path))
+
+
+def _save(path, obj):
+    torch.save(obj, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def fold_checkpoint_path(save_dir, num_fold):
+    return os.path.join(save_dir, 'fold{}.pt'.format(num_fold))
+
+
+def save_fold_model(save_dir, num_fold, model, config):
+    """
+    Save the weights of a fold. The file is replaced atomically, an interrupted save keeps the previous one.
+    :param config: plain python values describing the model, stored as they are
+    """
+    if not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    state_dict = {k: v.detach().cpu() for k, v in model.state_dict().items()}
+    _save(fold_checkpoint_path(save_dir, num_fold), {'fold': num_fold, 'config': config, 'model': state_dict})
+
+
+def load_fold_models(save_dir):
+    """
+    :return: checkpoints of all the folds found in save_dir, ordered by fold
+    """
+    checkpoints = [torch.load(path, map_location='cpu') for path in glob.glob(os.path.join(save_dir, 'fold*.pt'))]
+    if len(checkpoints) == 0:
+        raise ValueError('No fold checkpoint found in {}'.format(save_dir))
+    return sorted(checkpoints, key=lambda checkpoint: checkpoint['fold'])
+
+
+def load_model_checkpoint(path):
+    """
+    A fold checkpoint saved by save_fold_model, or the bare state dict of a model.
+    :return: dict of 'fold', 'config' and 'model' (the state dict), fold and config are None for a bare
+             state dict
+    """
+    checkpoint = torch.load(path, map_location='cpu')
+    if 'model' in checkpoint and 'config' in checkpoint:
+        return checkpoint
+    return {'fold': None, 'config': None, 'model': checkpoint}
+
+
+def training_state_path(save_dir, num_fold):
+    return os.path.join(save_dir, 'state_fold{}.pt'.format(num_fold))
+
+
+def _labels_to_list(predictions):
+    # label arrays are stored as lists, the state holds plain python values and tensors only
+    return {k: v.tolist() if v is not None else None for k, v in predictions.items()}
+
+
+def save_training_state(save_dir, num_fold, num_epoch, model, optimizer, scheduler, early_stopping, predictions,
+                        config):
+    """
+    State of a fold after an epoch.
+    :param scheduler: may be None
+    :param predictions: dict of the label arrays kept by the trainer between epochs (None when not computed yet)
+    :param config: run_configuration of the run
+    """
+    if not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+    _save(training_state_path(save_dir, num_fold), {
+        'fold': num_fold,
+        'config': config,
+        'completed': False,
+        'epoch': num_epoch,
+        'model': model.state_dict(),
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict() if scheduler is not None else None,
+        'early_stopping': early_stopping.state_dict(),
+        'predictions': _labels_to_list(predictions),
+    })
+
+
+def save_fold_result(save_dir, num_fold, predictions, config):
+    """
+    Mark a fold as completed, only its predictions are kept.
+    """
+    if not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+    _save(training_state_path(save_dir, num_fold),
+          {'fold': num_fold, 'config': config, 'completed': True, 'predictions': _labels_to_list(predictions)})
+
+
+def load_training_state(save_dir, num_fold, config):
+    """
+    :param config: run_configuration of the resuming run, a state saved with another one raises ValueError
+    :return: the state saved by save_training_state or save_fold_result, with the predictions as numpy
+             arrays, or None
+    """
+    path = training_state_path(save_dir, num_fold)
+    if not os.path.isfile(path):
+        return None
+    state = torch.load(path, map_location='cpu')
+    _check_configuration(path, state.get('config'), config)
+    state['predictions'] = {k: np.asarray(v) if v is not None else None for k, v in state['predictions'].items()}
+    return state
+
+
+def restore_training_state(state, model, optimizer, scheduler, early_stopping):
+    """
+    Load a state saved by save_training_state into freshly built training objects.
+    :return: the epoch to start from
+    """
+    model.load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    if scheduler is not None:
+        scheduler.load_state_dict(state['scheduler'])
+    early_stopping.load_state_dict(state['early_stopping'])
+    print('Resuming fold', state['fold'], 'from epoch', state['epoch'] + 1)
+    return state['epoch'] + 1
+
+
+def clear_training_state(save_dir, num_fold):
+    path = training_state_path(save_dir, num_fold)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def data_order(save_dir, order, config, resume=False):
+    """
+    The order the training conversations were shuffled in. A new run saves the given order and removes the
+    training states and fold weights of the previous run, a resumed run gets the order of the interrupted run,
+    so that the folds are the same.
+    :param order: list of indices
+    :param config: run_configuration of the run, a resumed run must have the one of the interrupted run
+    :param resume: whether to resume the run saved in save_dir, ValueError when there is none or it does not
+                   match
+    :return: list of indices
+    """
+    path = os.path.join(save_dir, 'data_order.json')
+    if resume:
+        if not os.path.isfile(path):
+            raise ValueError('No run to resume in {}'.format(save_dir))
+        with open(path, 'r') as f:
+            saved = json.load(f)
+        _check_configuration(path, saved.get('config') if isinstance(saved, dict) else None, config)
+        if len(saved['order']) != len(order):
+            raise ValueError('{} was saved for another training set'.format(path))
+        return saved['order']
+
+    # the weights go too, with fewer folds those of the previous run would join the ensemble of load_fold_models
+    for old_path in glob.glob(os.path.join(save_dir, 'state_fold*.pt')) + glob.glob(os.path.join(save_dir, 'fold*.pt')):
+        os.remove(old_path)
+    if not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'config': config, 'order': list(order)}, f)
+    os.replace(path + '.tmp', path)
+    return order
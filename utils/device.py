@@ -0,0 +1,49 @@
+"""
+    Device selection and CPU throughput settings shared by the trainers.
+"""
+import torch
+
+
+def get_device(name=None):
+    """
+    Resolve the device used by the models, the loss weights and every batch.
+    :param name: 'cpu', 'cuda' or 'cuda:N'; None picks cuda when it is available
+    :return: torch.device
+    """
+    if name is None:
+        name = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(name)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        raise ValueError('CUDA device {} requested but CUDA is not available'.format(name))
+    return device
+
+
+def cpu_throughput_mode(num_threads=0):
+    """
+    Tune torch for many-core CPU execution. Should be called once, before any model is built.
+    :param num_threads: intra-op threads, 0 keeps the torch default (one per physical core)
+    """
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+        # inter-op pool only matters for independent ops, keep it small so it does not oversubscribe
+        if hasattr(torch, 'set_num_interop_threads'):
+            try:
+                torch.set_num_interop_threads(max(1, min(4, num_threads // 8)))
+            except RuntimeError:
+                # already set, or parallel work has started
+                pass
+    # denormals are common in the tails of the attention softmax and are very slow on x86
+    torch.set_flush_denormal(True)
+    if hasattr(torch.backends, 'mkldnn'):
+        torch.backends.mkldnn.enabled = True
+    print('CPU throughput mode, intra-op threads:', torch.get_num_threads())
+
+
+def inference_mode():
+    """
+    Context manager for evaluation loops: torch.inference_mode when available (skips version counting
+    and view tracking on top of no_grad), torch.no_grad otherwise.
+    """
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
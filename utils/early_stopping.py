@@ -23,6 +23,15 @@ class EarlyStopping(object):
     def is_best(self):
         return self.is_current_best
 
+    def state_dict(self):
+        best = float(self.best) if self.best is not None else None
+        return {'best': best, 'num_bad_epochs': self.num_bad_epochs, 'is_current_best': self.is_current_best}
+
+    def load_state_dict(self, state_dict):
+        self.best = state_dict['best']
+        self.num_bad_epochs = state_dict['num_bad_epochs']
+        self.is_current_best = state_dict['is_current_best']
+
     def step(self, metrics):
         self.is_current_best = False
         if self.best is None:
@@ -0,0 +1,283 @@
+"""
+    Precomputed ELMo representations. ELMo is frozen in all trainers, so the average of its two layers
+    is computed once per unique sentence and stored as float16 in a memory-mapped matrix of token
+    vectors. Datasets register their sentences, build() runs ELMo on the new ones only, and
+    get() serves a sentence by id without touching the network.
+
+    Files in <cache_dir>/<hash of the ELMo options and weights>/:
+        vectors.npy     float16 (num_tokens, dim), the tokens of all sentences back to back
+        offsets.npy     int64 (num_sentences + 1), start of each sentence in vectors.npy
+        sentences.txt   one sentence per line, the line number is the sentence id
+        meta.json       ELMo options/weights the vectors were computed with
+
+    ChunkElmoCache serves streamed inputs (infer.py) from a store without growing it.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+from numpy.lib.format import open_memmap
+import torch
+from tqdm import tqdm
+from utils.interning import report_dedup
+
+ELMO_DIM = 1024
+# the ELMo model of all trainers
+ELMO_OPTIONS_FILE = "https://s3-us-west-2.amazonaws.com/allennlp/models/elmo/2x4096_512_2048cnn_2xhighway/elmo_2x4096_512_2048cnn_2xhighway_options.json"
+ELMO_WEIGHT_FILE = "https://s3-us-west-2.amazonaws.com/allennlp/models/elmo/2x4096_512_2048cnn_2xhighway/elmo_2x4096_512_2048cnn_2xhighway_weights.hdf5"
+
+
+def load_elmo(options_file, weight_file, device):
+    # imported here, loading allennlp is slow and not needed when every sentence is cached
+    from allennlp.modules.elmo import Elmo
+
+    elmo = Elmo(options_file, weight_file, 2, dropout=0).to(device)
+    elmo.eval()
+    return elmo
+
+
+def elmo_vectors(elmo, tokens, device, batch_size=64):
+    """
+    :param tokens: list of token lists
+    :return: generator of (index in tokens, float16 array (number of tokens, dim)), the average of the two
+             ELMo layers
+    """
+    from allennlp.modules.elmo import batch_to_ids
+
+    lengths = np.array([len(sentence) for sentence in tokens], dtype=np.int64)
+    # batches of similar length waste less compute on padding
+    order = np.argsort(lengths)
+    for i in tqdm(range(0, len(order), batch_size)):
+        batch_idx = order[i:i + batch_size]
+        with torch.no_grad():
+            character_ids = batch_to_ids([tokens[j] for j in batch_idx]).to(device)
+            elmo_emb = elmo(character_ids)['elmo_representations']
+            elmo_emb = (elmo_emb[0] + elmo_emb[1]) / 2  # avg of two layers
+        elmo_emb = elmo_emb.cpu().numpy().astype(np.float16)
+        for row, j in enumerate(batch_idx):
+            yield j, elmo_emb[row, :lengths[j]]
+
+
+class ElmoCache(object):
+    def __init__(self, cache_dir, id2word, options_file, weight_file, dim=ELMO_DIM):
+        model_key = '{}\n{}\n{}'.format(options_file, weight_file, dim)
+        self.cache_dir = os.path.join(cache_dir, hashlib.sha1(model_key.encode('utf8')).hexdigest()[:16])
+        self.id2word = id2word
+        self.options_file = options_file
+        self.weight_file = weight_file
+        self.dim = dim
+
+        self.sentences = []
+        self.sentence2id = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.vectors = None
+        # sentences registered but not computed yet
+        self.pending = []
+        # dedup statistics of this run
+        self.num_lookups = 0
+        self.used = set()
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self._open()
+
+    def _paths(self):
+        return [os.path.join(self.cache_dir, name) for name in
+                ('vectors.npy', 'offsets.npy', 'sentences.txt', 'meta.json')]
+
+    def _meta(self):
+        return {'options_file': self.options_file, 'weight_file': self.weight_file, 'dim': self.dim}
+
+    def _open(self):
+        vec_path, offsets_path, sentences_path, meta_path = self._paths()
+        # meta.json is written last, a directory without it was never completed
+        if not os.path.isfile(meta_path):
+            return
+        self.offsets = np.load(offsets_path)
+        with open(sentences_path, 'r', encoding='utf8') as f:
+            self.sentences = f.read().split('\n')[:len(self.offsets) - 1]
+        self.sentence2id = {s: i for i, s in enumerate(self.sentences)}
+        self.vectors = np.load(vec_path, mmap_mode='r')
+        assert len(self.offsets) == len(self.sentences) + 1
+        print('ELMo cache:', len(self.sentences), 'sentences loaded from', self.cache_dir)
+
+    def __getstate__(self):
+        """
+        Pickled copies (the fold processes of utils/fold_pool.py) get the location of the store and memory map
+        it again, the vectors are never pickled. A copy only serves get(), its sentences must be built first.
+        """
+        assert len(self.pending) == 0, 'build() the ELMo cache before sending it to other processes'
+        state = self.__dict__.copy()
+        state.update(vectors=None, sentences=[], sentence2id={}, used=set())
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        vec_path = self._paths()[0]
+        if len(self.offsets) > 1:
+            self.vectors = np.load(vec_path, mmap_mode='r')
+
+    def key(self, ids):
+        """
+        The sentence ELMo sees for a padded id list, the same tokens as the glove ids
+        """
+        return ' '.join(self.id2word[int(x)] for x in ids if x != 0)
+
+    def sentence_id(self, ids):
+        """
+        Id of the sentence of a padded id list. New sentences are queued for build().
+        """
+        sentence = self.key(ids)
+        sid = self.sentence2id.get(sentence)
+        if sid is None:
+            sid = len(self.sentence2id)
+            self.sentence2id[sentence] = sid
+            self.pending.append(sentence)
+        self.num_lookups += 1
+        self.used.add(sid)
+        return sid
+
+    def get(self, sid, pad_len=None):
+        """
+        :param pad_len: None gives the vectors of the tokens only, a read-only view of the store
+        :return: float16 array (pad_len, dim), zero padded after the last token
+        """
+        start, end = self.offsets[sid], self.offsets[sid + 1]
+        if pad_len is None:
+            return self.vectors[start:end]
+        out = np.zeros((pad_len, self.dim), dtype=np.float16)
+        length = min(end - start, pad_len)
+        out[:length] = self.vectors[start:start + length]
+        return out
+
+    def build(self, device, batch_size=64):
+        """
+        Run ELMo on the pending sentences and append them to the store.
+        """
+        report_dedup('ELMo', self.num_lookups, len(self.used))
+        if len(self.pending) == 0:
+            return
+
+        print('ELMo cache: computing', len(self.pending), 'new sentences')
+        elmo = load_elmo(self.options_file, self.weight_file, device)
+
+        new_tokens = [sentence.split(' ') for sentence in self.pending]
+        new_lengths = np.array([len(tokens) for tokens in new_tokens], dtype=np.int64)
+        num_old = int(self.offsets[-1])
+        offsets = np.concatenate((self.offsets, num_old + np.cumsum(new_lengths)))
+
+        vec_path, offsets_path, sentences_path, meta_path = self._paths()
+        tmp_path = vec_path + '.tmp.npy'
+        vectors = open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=(int(offsets[-1]), self.dim))
+        if num_old > 0:
+            vectors[:num_old] = self.vectors[:num_old]
+
+        first_new = len(self.sentences)
+        for j, vec in elmo_vectors(elmo, new_tokens, device, batch_size):
+            start = offsets[first_new + j]
+            vectors[start:start + len(vec)] = vec
+        vectors.flush()
+        del vectors, elmo
+
+        self.vectors = None
+        # offsets go last: until they are replaced, the old sentences still index a prefix of the new files
+        os.replace(tmp_path, vec_path)
+        self.sentences.extend(self.pending)
+        with open(sentences_path, 'w', encoding='utf8') as f:
+            f.write('\n'.join(self.sentences))
+        np.save(offsets_path + '.tmp.npy', offsets)
+        os.replace(offsets_path + '.tmp.npy', offsets_path)
+        with open(meta_path, 'w') as f:
+            json.dump(self._meta(), f)
+
+        self.pending = []
+        self.offsets = offsets
+        self.vectors = np.load(vec_path, mmap_mode='r')
+
+
+def checkpoint_elmo_cache(cache_dir, config):
+    """
+    The ElmoCache of the trainer of a fold checkpoint, for the ELMo model it was trained with.
+    :param config: configuration saved with the fold weights (utils/checkpoint.py), those without the ELMo files
+                   were trained with ELMO_OPTIONS_FILE and ELMO_WEIGHT_FILE
+    """
+    return ElmoCache(cache_dir, config['id2word'], config.get('elmo_options_file', ELMO_OPTIONS_FILE),
+                     config.get('elmo_weight_file', ELMO_WEIGHT_FILE))
+
+
+class ChunkElmoCache(object):
+    """
+    ELMo representations of streamed inputs, same interface as ElmoCache. The sentences of the store are read
+    from it, the others are computed by build() and kept in memory until clear(), so the store on disk is
+    never written and the memory is bounded by the inputs between two clear().
+    """
+    def __init__(self, store):
+        """
+        :param store: ElmoCache of the precomputed sentences, read only
+        """
+        self.store = store
+        self.dim = store.dim
+        # sentences missing from the store have negative ids, -1 - index in new_vectors
+        self.sentence2id = {}
+        self.new_vectors = []
+        self.pending = []
+        self.num_lookups = 0
+        self.used = set()
+        # loaded on the first sentence missing from the store and kept for the next inputs
+        self.elmo = None
+
+    def clear(self):
+        """
+        Forget the computed sentences, the ids given so far are no longer valid.
+        """
+        self.sentence2id = {}
+        self.new_vectors = []
+        self.pending = []
+        self.num_lookups = 0
+        self.used = set()
+
+    def sentence_id(self, ids):
+        sentence = self.store.key(ids)
+        sid = self.store.sentence2id.get(sentence)
+        if sid is None:
+            sid = self.sentence2id.get(sentence)
+            if sid is None:
+                sid = -1 - len(self.new_vectors) - len(self.pending)
+                self.sentence2id[sentence] = sid
+                self.pending.append(sentence)
+        self.num_lookups += 1
+        self.used.add(sid)
+        return sid
+
+    def get(self, sid, pad_len=None):
+        """
+        See ElmoCache.get
+        """
+        if sid >= 0:
+            return self.store.get(sid, pad_len)
+        vec = self.new_vectors[-1 - sid]
+        if pad_len is None:
+            return vec
+        out = np.zeros((pad_len, self.dim), dtype=np.float16)
+        length = min(len(vec), pad_len)
+        out[:length] = vec[:length]
+        return out
+
+    def build(self, device, batch_size=64):
+        """
+        Run ELMo on the pending sentences, in memory.
+        """
+        report_dedup('ELMo', self.num_lookups, len(self.used))
+        if len(self.pending) == 0:
+            return
+        print('ELMo: computing', len(self.pending), 'sentences missing from the cache')
+        if self.elmo is None:
+            self.elmo = load_elmo(self.store.options_file, self.store.weight_file, device)
+
+        new_vectors = [None] * len(self.pending)
+        for j, vec in elmo_vectors(self.elmo, [sentence.split(' ') for sentence in self.pending], device,
+                                   batch_size):
+            # a copy, the views would keep the whole padded batch alive
+            new_vectors[j] = vec.copy()
+        self.new_vectors.extend(new_vectors)
+        self.pending = []
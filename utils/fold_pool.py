@@ -0,0 +1,78 @@
+"""
+    Parallel fold training. The folds of a trainer are independent, so they can be trained by a pool of
+    worker processes, each with its own intra-op thread budget, instead of one after the other with all
+    the cores. Small LSTM/attention models do not scale to many threads, a few concurrent folds use a
+    many-core node much better.
+
+    Workers are spawned, not forked: by the time the folds start the trainer has run multi-threaded torch
+    ops (thread setup, ELMo, loading pretrained weights, share_memory_), and an OpenMP runtime forked after
+    that deadlocks in the child on its first parallel op. A spawned worker imports the trainer script
+    again (its main() must be guarded by __name__ == '__main__') and receives the fold context pickled:
+    tensors in shared memory as handles to the same pages (utils/shared_memory.py), the ELMo cache as the
+    paths of its memory maps, and small numpy columns by value.
+"""
+import multiprocessing
+import torch
+
+# fold function of the worker, built once per process from the fold context
+_one_fold = None
+
+
+def _init_worker(num_threads, make_one_fold, context):
+    global _one_fold
+    torch.set_num_threads(num_threads)
+    if hasattr(torch, 'set_num_interop_threads'):
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass
+    _one_fold = make_one_fold(context)
+
+
+def _run_fold(num_fold, train_index, dev_index):
+    print('Train size:', len(train_index), 'Dev size:', len(dev_index))
+    return _one_fold(num_fold, train_index, dev_index)
+
+
+def threads_per_worker(num_workers, num_threads=0):
+    """
+    :param num_threads: threads asked for each worker, 0 shares the cores between the workers
+    """
+    if num_threads > 0:
+        return num_threads
+    return max(1, multiprocessing.cpu_count() // num_workers)
+
+
+def run_folds(make_one_fold, context, splits, num_workers=1, num_threads=0):
+    """
+    Train the folds, sequentially or on a pool of spawned processes.
+    :param make_one_fold: module level function context -> fold function (num_fold, train_index, dev_index)
+                          -> predictions of the fold; called once in every worker
+    :param context: what the folds share (datasets, embeddings, pretrained weights), picklable
+    :param splits: (train_index, dev_index) of every fold, e.g. StratifiedKFold.split
+    :param num_workers: concurrent folds, 1 trains them one after the other in this process
+    :param num_threads: intra-op threads of each worker, see threads_per_worker
+    :return: the predictions of the folds, in fold order
+    """
+    tasks = [(num_fold, train_index, dev_index) for num_fold, (train_index, dev_index) in enumerate(splits)]
+    num_workers = min(num_workers, len(tasks))
+    if num_workers <= 1:
+        one_fold = make_one_fold(context)
+        results = []
+        for num_fold, train_index, dev_index in tasks:
+            print('Train size:', len(train_index), 'Dev size:', len(dev_index))
+            results.append(one_fold(num_fold, train_index, dev_index))
+        return results
+
+    num_threads = threads_per_worker(num_workers, num_threads)
+    print('Training', len(tasks), 'folds on', num_workers, 'processes of', num_threads, 'threads')
+    # one process per fold, the memory of a fold is given back as soon as it is done
+    pool = multiprocessing.get_context('spawn').Pool(num_workers, initializer=_init_worker,
+                                                     initargs=(num_threads, make_one_fold, context),
+                                                     maxtasksperchild=1)
+    try:
+        # chunksize 1, a fold is a long task and the pool takes the next one as soon as a worker is free
+        return pool.starmap(_run_fold, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,252 @@
+"""
+    Binary GloVe store: a float32 .npy matrix opened with mmap_mode='r' plus a sorted word index.
+    The text file is converted once, after that loading takes seconds and the vectors stay on disk
+    until rows are gathered for the vocabulary.
+
+    On top of the store, the rows of each vocabulary are cached in <glove file>.vocab_cache/, keyed by
+    a hash of id2word and a fingerprint of the GloVe file. An unchanged vocabulary is reused without
+    opening the store, and a grown vocabulary only resolves the words that were never looked up.
+
+    Usage for the one-time conversion:
+        python -m utils.glove glove.840B.300d.txt
+"""
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+from numpy.lib.format import open_memmap
+from tqdm import tqdm
+
+STORE_VERSION = 1
+
+
+def store_paths(fname):
+    """
+    :return: paths of the vector matrix, the sorted word index, the row index and the metadata
+    """
+    return fname + '.f32.npy', fname + '.words.txt', fname + '.rows.npy', fname + '.meta.json'
+
+
+def convert_glove(fname, embedding_dim=300):
+    """
+    Convert a GloVe text file into the binary store, streaming the rows straight into the mmap.
+    Lines that cannot be parsed are skipped and, as with a dict, the last occurrence of a word wins.
+    """
+    vec_path, words_path, rows_path, meta_path = store_paths(fname)
+
+    print('Counting lines of', fname)
+    with open(fname, 'r', encoding='utf8') as f:
+        num_lines = sum(1 for _ in f)
+
+    # rows are written in file order, unused trailing rows are never indexed
+    vectors = open_memmap(vec_path, mode='w+', dtype=np.float32, shape=(num_lines, embedding_dim))
+    word2row = {}
+    n = 0
+    print("Converting Glove Model")
+    with open(fname, 'r', encoding='utf8') as f:
+        for line in tqdm(f, total=num_lines):
+            values = line.split(' ')
+            word = values[0]
+            try:
+                vectors[n] = np.array(values[1:], dtype=np.float32)
+            except ValueError:
+                print(len(values), values[0])
+                continue
+            word2row[word] = n
+            n += 1
+    vectors.flush()
+
+    words = sorted(word2row.keys())
+    rows = np.array([word2row[w] for w in words], dtype=np.int32)
+    del word2row
+
+    # statistics of the unique vectors, used to initialise the words that are not found
+    total, total_sq = 0.0, 0.0
+    chunk = 100000
+    for i in range(0, len(rows), chunk):
+        block = vectors[np.sort(rows[i:i + chunk])].astype(np.float64)
+        total += block.sum()
+        total_sq += np.square(block).sum()
+    count = float(len(rows) * embedding_dim)
+    mean = total / count
+    std = float(np.sqrt(max(total_sq / count - mean * mean, 0.0)))
+    del vectors
+
+    with open(words_path, 'w', encoding='utf8', newline='') as f:
+        f.write('\n'.join(words))
+    np.save(rows_path, rows)
+    with open(meta_path, 'w') as f:
+        json.dump({'version': STORE_VERSION, 'num_words': len(words), 'dim': embedding_dim,
+                   'mean': mean, 'std': std}, f)
+    print("Done.", len(words), " words converted!")
+
+
+class GloveStore(object):
+    """
+    Read-only view of a converted GloVe file. The matrix is memory mapped, so only the pages of
+    the rows actually gathered become resident.
+    """
+    def __init__(self, fname, embedding_dim=300):
+        vec_path, words_path, rows_path, meta_path = store_paths(fname)
+        meta = None
+        if os.path.isfile(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        if meta is None or meta.get('version') != STORE_VERSION or meta['dim'] != embedding_dim:
+            convert_glove(fname, embedding_dim)
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+
+        self.mean = meta['mean']
+        self.std = meta['std']
+        self.dim = meta['dim']
+        self.vectors = np.load(vec_path, mmap_mode='r')
+        self.rows = np.load(rows_path)
+        with open(words_path, 'r', encoding='utf8', newline='') as f:
+            self.words = np.array(f.read().split('\n'), dtype=object)
+        assert len(self.words) == len(self.rows) == meta['num_words']
+
+    def lookup(self, word_list):
+        """
+        Vectorized binary search of the sorted word index.
+        :return: (matrix row of each word, boolean mask of the words that were found)
+        """
+        query = np.array(word_list, dtype=object)
+        pos = np.searchsorted(self.words, query)
+        pos = np.minimum(pos, len(self.words) - 1)
+        found = self.words[pos] == query
+        return self.rows[pos], found
+
+    def gather(self, rows):
+        """
+        Read the given rows from the mmap, in disk order for locality.
+        """
+        order = np.argsort(rows)
+        out = np.empty((len(rows), self.dim), dtype=np.float32)
+        out[order] = self.vectors[rows[order]]
+        return out
+
+
+def glove_fingerprint(fname, embedding_dim=300):
+    """
+    Cheap fingerprint of a GloVe file: size and modification time of the text file, or of the
+    converted matrix when the text file is gone.
+    """
+    path = fname if os.path.isfile(fname) else store_paths(fname)[0]
+    stat = os.stat(path)
+    key = '{}:{}:{}:{}:{}'.format(os.path.abspath(fname), stat.st_size, int(stat.st_mtime), embedding_dim,
+                                  STORE_VERSION)
+    return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+
+def vocab_hash(word_list):
+    return hashlib.sha1('\n'.join(word_list).encode('utf8')).hexdigest()
+
+
+class VocabVectorCache(object):
+    """
+    GloVe rows of the vocabularies used so far, for one GloVe file.
+    resolved.npz keeps every word ever looked up (found or not) with its vector,
+    vocab-<hash>.npz keeps the found mask and vectors of one exact vocabulary.
+    """
+    def __init__(self, fname, embedding_dim=300):
+        self.fname = fname
+        self.embedding_dim = embedding_dim
+        self.cache_dir = fname + '.vocab_cache'
+        self.fingerprint = glove_fingerprint(fname, embedding_dim)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _load(self, path):
+        if not os.path.isfile(path):
+            return None
+        data = np.load(path)
+        if str(data['fingerprint']) != self.fingerprint:
+            return None
+        return data
+
+    def _save(self, path, **arrays):
+        # write then replace, so an interrupted run never leaves a truncated artefact
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, fingerprint=np.array(self.fingerprint), **arrays)
+        os.replace(tmp_path, path)
+
+    def get(self, word_list):
+        """
+        :return: (mean, std, found mask over word_list, vectors of the found words)
+        """
+        vocab_path = os.path.join(self.cache_dir, 'vocab-{}.npz'.format(vocab_hash(word_list)))
+        data = self._load(vocab_path)
+        if data is not None:
+            print('loading cached vocabulary embedding', vocab_path)
+            return float(data['mean']), float(data['std']), data['found'], data['vectors']
+
+        resolved_path = os.path.join(self.cache_dir, 'resolved.npz')
+        data = self._load(resolved_path)
+        if data is not None:
+            known_words = list(data['words'])
+            known_found = data['found']
+            known_vectors = data['vectors']
+            mean, std = float(data['mean']), float(data['std'])
+        else:
+            known_words = []
+            known_found = np.zeros(0, dtype=bool)
+            known_vectors = np.zeros((0, self.embedding_dim), dtype=np.float32)
+            mean, std = None, None
+        word2known = {w: i for i, w in enumerate(known_words)}
+
+        missing = sorted(set(w for w in word_list if w not in word2known))
+        if len(missing) > 0:
+            print('resolving', len(missing), 'words missing from the vocabulary cache')
+            store = GloveStore(self.fname, self.embedding_dim)
+            mean, std = store.mean, store.std
+            rows, found = store.lookup(missing)
+            vectors = np.zeros((len(missing), self.embedding_dim), dtype=np.float32)
+            vectors[found] = store.gather(rows[found])
+
+            for w in missing:
+                word2known[w] = len(known_words)
+                known_words.append(w)
+            known_found = np.concatenate((known_found, found))
+            known_vectors = np.concatenate((known_vectors, vectors), axis=0)
+            self._save(resolved_path, words=np.array(known_words), found=known_found, vectors=known_vectors,
+                       mean=np.array(mean), std=np.array(std))
+
+        idx = np.array([word2known[w] for w in word_list], dtype=np.int64)
+        found = known_found[idx]
+        vectors = known_vectors[idx[found]]
+        self._save(vocab_path, found=found, vectors=vectors, mean=np.array(mean), std=np.array(std))
+        return mean, std, found, vectors
+
+
+def build_embedding(id2word, fname, num_of_vocab, embedding_dim=300):
+    """
+    :param id2word, fname:
+    :return: embedding matrix of the vocabulary, rows of words missing from GloVe are random normal
+    """
+    word_list = [id2word[idx] for idx in range(num_of_vocab)]
+    mean, std, found, vectors = VocabVectorCache(fname, embedding_dim).get(word_list)
+
+    # always drawn, so the random state after this call does not depend on cache hits
+    emb = np.random.normal(mean, std, (num_of_vocab, embedding_dim))
+
+    print('loading glove')
+    special = np.array([word == '<pad>' or word == '<unk>' for word in word_list])
+    emb[found] = vectors
+    emb[special] = 0
+    num_found = int((found & ~special).sum())
+
+    print(num_found, 'of', num_of_vocab, 'found', 'coverage', num_found/num_of_vocab)
+
+    return emb
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a GloVe text file into the binary mmap store')
+    parser.add_argument('glovepath', type=str,
+                        help="path to a GloVe text file, e.g. glove.840B.300d.txt")
+    parser.add_argument('-dim', default=300, type=int,
+                        help="dimension of the vectors")
+    opt = parser.parse_args()
+    convert_glove(opt.glovepath, opt.dim)
@@ -0,0 +1,94 @@
+"""
+    Sentence interning. Turns repeat a lot in EmoContext ("ok", "why", canned bot replies), so every unique
+    cleaned turn gets an id and deterministic per-sentence work is done once per id.
+"""
+import numpy as np
+import torch
+
+
+def report_dedup(name, num_turns, num_unique):
+    if num_turns == 0:
+        return
+    print('{}: {} unique of {} turns, dedup ratio {:.2f}x ({:.1%} duplicates)'.format(
+        name, num_unique, num_turns, num_turns / max(num_unique, 1), 1 - num_unique / num_turns))
+
+
+class SentenceInterner(object):
+    def __init__(self, encoder=None, name='sentences', bulk_encoder=None):
+        """
+        :param encoder: optional function applied once to every unique sentence, its results are
+                        shared by all the turns with the same text
+        :param name: used in the report
+        :param bulk_encoder: optional function from a list of sentences to their encodings, used in place
+                             of encoder so that the new sentences of intern_many are encoded in one call
+        """
+        self.encoder = encoder
+        self.bulk_encoder = bulk_encoder
+        self.name = name
+        self.sentence2id = {}
+        self.sentences = []
+        self.encoded = []
+        self.num_turns = 0
+
+    def _add(self, sentence):
+        self.num_turns += 1
+        sid = self.sentence2id.get(sentence)
+        if sid is None:
+            sid = len(self.sentences)
+            self.sentence2id[sentence] = sid
+            self.sentences.append(sentence)
+        return sid
+
+    def _encode_new(self):
+        if self.bulk_encoder is None and self.encoder is None:
+            return
+        new = self.sentences[len(self.encoded):]
+        if len(new) == 0:
+            return
+        if self.bulk_encoder is not None:
+            self.encoded.extend(self.bulk_encoder(new))
+        else:
+            self.encoded.extend(self.encoder(sentence) for sentence in new)
+
+    def intern(self, sentence):
+        """
+        :return: id of the sentence
+        """
+        sid = self._add(sentence)
+        self._encode_new()
+        return sid
+
+    def intern_many(self, sentences):
+        """
+        :return: int64 array of the ids of the sentences
+        """
+        ids = np.fromiter((self._add(sentence) for sentence in sentences), dtype=np.int64, count=len(sentences))
+        self._encode_new()
+        return ids
+
+    def encode_many(self, sentences):
+        """
+        :return: array (len(sentences), ...) of the encodings of the sentences
+        """
+        return np.stack([self.encoded[sid] for sid in self.intern_many(sentences)])
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def __getitem__(self, sid):
+        return self.encoded[sid]
+
+    def report(self):
+        report_dedup(self.name, self.num_turns, len(self.sentences))
+
+
+def dedup_rows(key):
+    """
+    :param key: 2d tensor, e.g. padded token ids of a batch
+    :return: (index of one occurrence of every unique row, inverse mapping every row to its unique row)
+    """
+    unique_key, inverse = torch.unique(key, dim=0, return_inverse=True)
+    index = torch.zeros(unique_key.size(0), dtype=torch.long, device=key.device)
+    # rows are equal, so whichever occurrence wins the scatter is fine
+    index[inverse] = torch.arange(key.size(0), device=key.device)
+    return index, inverse
@@ -0,0 +1,96 @@
+"""
+    ONNX export and onnxruntime CPU serving. onnxruntime is only needed to run the exported graphs,
+    it is imported when an OnnxModel is created.
+"""
+import inspect
+import time
+import numpy as np
+import torch
+
+OPSET_VERSION = 12
+
+
+def export_onnx(model, inputs, out_path, input_names, output_names, opset_version=OPSET_VERSION):
+    """
+    Trace the model into an ONNX graph. The first axis of every input and output is the batch and stays
+    dynamic, all the other sizes are the ones of the example inputs.
+    """
+    model.eval()
+    dynamic_axes = {name: {0: 'batch'} for name in list(input_names) + list(output_names)}
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # recent torch defaults to the torch.export based exporter, the models are written for tracing
+        kwargs['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(model, inputs, out_path, input_names=list(input_names), output_names=list(output_names),
+                          dynamic_axes=dynamic_axes, opset_version=opset_version, do_constant_folding=True,
+                          **kwargs)
+    print('ONNX model saved to', out_path)
+
+
+class OnnxModel(object):
+    def __init__(self, path, num_threads=0):
+        """
+        :param path: .onnx file written by export_onnx
+        :param num_threads: intra-op threads of the session, 0 lets onnxruntime use one per physical core
+        """
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        # the graphs are a single chain of ops, a second pool would only compete with the intra-op one
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [x.name for x in self.session.get_inputs()]
+        self.output_names = [x.name for x in self.session.get_outputs()]
+
+    def __call__(self, *inputs):
+        """
+        :param inputs: tensors or arrays in the order of the exported forward
+        :return: list of numpy arrays, one per output
+        """
+        feed = {}
+        for name, x in zip(self.input_names, inputs):
+            if isinstance(x, torch.Tensor):
+                x = x.detach().cpu().numpy()
+            feed[name] = x
+        return self.session.run(self.output_names, feed)
+
+    def predict(self, *inputs):
+        """
+        :return: predicted label ids, numpy array (batch,)
+        """
+        return np.argmax(self(*inputs)[0], axis=1)
+
+
+def compare_with_torch(model, onnx_model, batches):
+    """
+    Run the PyTorch model and the ONNX graph on the same batches.
+    :param batches: list of input tuples, in the order of the forward of both models
+    :return: (max abs diff of the label logits, share of equal predictions,
+              conversations per second of PyTorch, conversations per second of onnxruntime)
+    """
+    model.eval()
+    max_diff = 0.
+    num_equal = 0
+    num_total = 0
+    torch_time = 0.
+    onnx_time = 0.
+    with torch.no_grad():
+        for inputs in batches:
+            start = time.time()
+            expected = model(*inputs)[0].cpu().numpy()
+            torch_time += time.time() - start
+
+            start = time.time()
+            output = onnx_model(*inputs)[0]
+            onnx_time += time.time() - start
+
+            max_diff = max(max_diff, float(np.abs(expected - output).max()))
+            num_equal += int((expected.argmax(1) == output.argmax(1)).sum())
+            num_total += expected.shape[0]
+    return max_diff, num_equal / max(num_total, 1), num_total / max(torch_time, 1e-9), \
+        num_total / max(onnx_time, 1e-9)
@@ -0,0 +1,99 @@
+"""
+    Dynamic int8 quantization of trained models for CPU inference. nn.LSTM and nn.Linear weights are stored in
+    int8 and the activations are quantized on the fly, batch by batch, so no calibration data is needed.
+    The hard-sigmoid LSTMs of TorchMoji are first turned into QuantizableLSTMHardSigmoid, whose projections
+    are plain nn.Linear modules and get quantized like the others.
+"""
+import io
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import module.lstm_hard_sigmoid
+import torchmoji.lstm
+
+if hasattr(torch, 'ao') and hasattr(torch.ao, 'quantization'):
+    from torch.ao.quantization import quantize_dynamic
+else:
+    from torch.quantization import quantize_dynamic
+
+HARD_SIGMOID_LSTMS = {
+    module.lstm_hard_sigmoid.LSTMHardSigmoid: module.lstm_hard_sigmoid.QuantizableLSTMHardSigmoid,
+    torchmoji.lstm.LSTMHardSigmoid: torchmoji.lstm.QuantizableLSTMHardSigmoid,
+}
+
+
+def swap_hard_sigmoid_lstms(model):
+    """
+    Replace, in place, every LSTMHardSigmoid of the model with its QuantizableLSTMHardSigmoid copy.
+    """
+    for name, child in model.named_children():
+        if type(child) in HARD_SIGMOID_LSTMS:
+            setattr(model, name, HARD_SIGMOID_LSTMS[type(child)].from_float(child))
+        else:
+            swap_hard_sigmoid_lstms(child)
+    return model
+
+
+def quantize_model(model):
+    """
+    :return: int8 copy of the model, in evaluation mode and on cpu, the model itself is not changed
+    """
+    model = copy.deepcopy(model).cpu()
+    model.eval()
+    swap_hard_sigmoid_lstms(model)
+    return quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+
+def model_size(model):
+    """
+    :return: size in bytes of the serialized state dict
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def predict(model, batches):
+    """
+    :param batches: list of input tuples, in the order of the forward of the model
+    :return: predicted label ids, seconds spent in the model
+    """
+    preds = []
+    elapsed = 0.
+    with torch.no_grad():
+        for inputs in batches:
+            start = time.time()
+            out = model(*inputs)[0]
+            elapsed += time.time() - start
+            preds.append(out.argmax(1).cpu().numpy())
+    return np.concatenate(preds), elapsed
+
+
+def compare_quantized(model, quantized, batches, gold, metrics):
+    """
+    Evaluate the float and the int8 model on the same batches and print the accuracy delta, speedup and
+    memory reduction.
+    :param gold: label ids of the batches
+    :param metrics: data.evaluate.get_metrics, or any function(gold, predictions) returning
+                    (accuracy, micro precision, micro recall, micro F1)
+    :return: (float result, int8 result, speedup, size reduction)
+    """
+    model.eval()
+    print('float model:')
+    float_pred, float_time = predict(model, batches)
+    float_result = metrics(gold, float_pred)
+    print('int8 model:')
+    int8_pred, int8_time = predict(quantized, batches)
+    int8_result = metrics(gold, int8_pred)
+
+    float_size = model_size(model)
+    int8_size = model_size(quantized)
+    speedup = float_time / max(int8_time, 1e-9)
+    reduction = float_size / max(int8_size, 1)
+    print('accuracy delta {:+.4f}, micro F1 delta {:+.4f}, same prediction {:.2%}'.format(
+        int8_result[0] - float_result[0], int8_result[3] - float_result[3], np.mean(float_pred == int8_pred)))
+    print('speedup {:.2f}x ({:.2f}s -> {:.2f}s), size {:.1f}MB -> {:.1f}MB ({:.2f}x smaller)'.format(
+        speedup, float_time, int8_time, float_size / 2 ** 20, int8_size / 2 ** 20, reduction))
+    return float_result, int8_result, speedup, reduction
@@ -0,0 +1,36 @@
+"""
+    Frozen artefacts shared by the fold processes (see utils/fold_pool.py): the GloVe matrix of the vocabulary
+    and the pretrained TorchMoji or BERT weights are loaded once by the trainer and placed in shared memory,
+    every fold copies them into its own model. The tensors reach the spawned workers pickled as handles to
+    their shared memory (torch.multiprocessing), so the workers attach the same pages instead of each loading
+    its own copy, and memory stays flat as the number of concurrent folds grows.
+
+    The tensors must stay read-only: models copy from them (load_state_dict, load_embedding) and never
+    take them as parameters.
+"""
+import numpy as np
+import torch
+
+
+def share_array(array, dtype=np.float32):
+    """
+    :param array: numpy array, copied once into shared memory
+    :return: torch tensor in shared memory
+    """
+    return torch.from_numpy(np.ascontiguousarray(array, dtype=dtype)).share_memory_()
+
+
+def share_state_dict(state_dict):
+    """
+    :return: the state dict with every tensor moved to shared cpu memory, in the same order
+    """
+    for key, value in state_dict.items():
+        state_dict[key] = value.detach().cpu().share_memory_()
+    return state_dict
+
+
+def load_shared_state_dict(path):
+    """
+    torch.load of a weight file into shared memory
+    """
+    return share_state_dict(torch.load(path, map_location='cpu'))
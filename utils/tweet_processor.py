@@ -7,9 +7,13 @@ import numpy as np
 from multiprocessing import Pool
 import emoji
 import string
+import hashlib
+import json
+import os
+import sqlite3
 printable = set(string.printable)
 
-text_processor = TextPreProcessor(
+TEXT_PROCESSOR_CONFIG = dict(
     # terms that will be normalized
     normalize=['url', 'email', 'percent', 'money', 'phone', 'user',
                'time', 'url', 'date', 'number'],
@@ -31,15 +35,63 @@ text_processor = TextPreProcessor(
     unpack_hashtags=True,  # perform word segmentation on hashtags
     unpack_contractions=True,  # Unpack contractions (can't -> can not)
     spell_correct_elong=True,  # spell correction for elongated words
+)
 
-    # select a tokenizer. You can use SocialTokenizer, or pass your own
-    # the tokenizer, should take as input a string and return a list of tokens
-    tokenizer=SocialTokenizer(lowercase=True).tokenize,
+# bump when processing_pipeline changes in a way the config does not capture
+PIPELINE_VERSION = 1
+PREPROCESS_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                     'data', 'preprocess_cache.sqlite')
 
-    # list of dictionaries, for replacing tokens extracted from the text,
-    # with other expressions. You can pass more than one dictionaries.
-    dicts=[emoticons]
-)
+
+def build_text_processor():
+    return TextPreProcessor(
+        # select a tokenizer. You can use SocialTokenizer, or pass your own
+        # the tokenizer, should take as input a string and return a list of tokens
+        tokenizer=SocialTokenizer(lowercase=True).tokenize,
+
+        # list of dictionaries, for replacing tokens extracted from the text,
+        # with other expressions. You can pass more than one dictionaries.
+        dicts=[emoticons],
+        **TEXT_PROCESSOR_CONFIG
+    )
+
+
+class _LazyTextProcessor(object):
+    """
+    Building the TextPreProcessor loads the segmenter and corrector statistics, which takes seconds.
+    Defer it to the first call so that a fully cached run never pays for it.
+    """
+    def __init__(self):
+        self._processor = None
+
+    def pre_process_doc(self, doc):
+        if self._processor is None:
+            self._processor = build_text_processor()
+        return self._processor.pre_process_doc(doc)
+
+
+text_processor = _LazyTextProcessor()
+
+
+def _package_version(name):
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution(name).version
+    except Exception:
+        return ''
+
+
+def pipeline_config_hash():
+    """
+    Hash of everything that determines the output of processing_pipeline, used to key the cache
+    """
+    config = {k: sorted(v) if isinstance(v, (set, list)) else v for k, v in TEXT_PROCESSOR_CONFIG.items()}
+    config['tokenizer'] = 'SocialTokenizer(lowercase=True)'
+    config['dicts'] = ['emoticons']
+    config['pipeline_version'] = PIPELINE_VERSION
+    config['ekphrasis'] = _package_version('ekphrasis')
+    config['emoji'] = getattr(emoji, '__version__', '')
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf8')).hexdigest()
 
 
 def process_tweet(s):
@@ -106,5 +158,142 @@ def processing_pipeline(text):
     return text
 
 
+# print(processing_pipelie('e day હત ા શ ા ર ો ગ મ ા ટ ે હ ો મ ી ય ો પ ે થ ી homeop'))
+
+
+class PreprocessCache(object):
+    """
+    Persistent content-addressed cache of processing_pipeline outputs, shared by all trainers.
+    Entries are keyed by sha1(config hash + raw text), so changing the TextPreProcessor
+    configuration never returns stale results.
+    """
+    # sqlite limits the number of host parameters per statement
+    QUERY_CHUNK = 500
+
+    def __init__(self, path=PREPROCESS_CACHE_PATH, config_hash=None):
+        self.path = path
+        self.config_hash = config_hash if config_hash is not None else pipeline_config_hash()
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pipeline (key BLOB PRIMARY KEY, text TEXT NOT NULL)')
+        self.conn.commit()
+
+    def key(self, raw):
+        return hashlib.sha1((self.config_hash + '\0' + raw).encode('utf8')).digest()
+
+    def get_many(self, raw_list):
+        """
+        :return: dict raw text -> processed text, for the entries found in the cache
+        """
+        key2raw = {}
+        for raw in raw_list:
+            key2raw[self.key(raw)] = raw
+        keys = list(key2raw.keys())
+        found = {}
+        for i in range(0, len(keys), self.QUERY_CHUNK):
+            chunk = keys[i:i + self.QUERY_CHUNK]
+            rows = self.conn.execute('SELECT key, text FROM pipeline WHERE key IN ({})'.format(
+                ','.join('?' * len(chunk))), chunk)
+            for key, text in rows:
+                found[key2raw[bytes(key)]] = text
+        return found
+
+    def put_many(self, pairs):
+        self.conn.executemany('INSERT OR REPLACE INTO pipeline (key, text) VALUES (?, ?)',
+                              [(self.key(raw), text) for raw, text in pairs])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def _init_pipeline_worker():
+    # build the TextPreProcessor once per worker, not once per task
+    if text_processor._processor is None:
+        text_processor._processor = build_text_processor()
+
+
+def _pipeline_workers(workers):
+    if workers <= 0:
+        return multiprocessing.cpu_count()
+    return workers
+
+
+class PipelinePool(object):
+    """
+    Process pool of processing_pipeline_parallel kept across calls, by callers that preprocess in batches.
+    The processes, and the TextPreProcessor of each, are started by the first texts to process: a run whose
+    texts are all cached never starts them.
+    """
+    def __init__(self, workers=0):
+        """
+        :param workers: number of processes, 0 uses all cores
+        """
+        self.workers = _pipeline_workers(workers)
+        self.pool = None
+
+    def map(self, func, iterable, chunksize=1):
+        if self.pool is None:
+            self.pool = Pool(self.workers, initializer=_init_pipeline_worker)
+        return self.pool.map(func, iterable, chunksize=chunksize)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def processing_pipeline_parallel(raw_list, workers=0, pool=None):
+    """
+    processing_pipeline over a list of texts, sharded across a process pool.
+    The output is identical to the serial path and in the same order.
+    :param workers: number of processes, 0 uses all cores, 1 runs in the current process
+    :param pool: PipelinePool to use instead of a new pool, left open
+    """
+    workers = min(_pipeline_workers(workers), len(raw_list))
+    if workers <= 1:
+        return [processing_pipeline(raw) for raw in raw_list]
+    # a few shards per worker keeps the pool balanced when some texts are much slower than others
+    chunk_size = max(1, len(raw_list) // (workers * 4))
+    if pool is not None:
+        return pool.map(processing_pipeline, raw_list, chunksize=chunk_size)
+    pool = Pool(workers, initializer=_init_pipeline_worker)
+    try:
+        return pool.map(processing_pipeline, raw_list, chunksize=chunk_size)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def processing_pipeline_many(raw_list, cache_path=PREPROCESS_CACHE_PATH, workers=1, cache=None, pool=None):
+    """
+    processing_pipeline over a list of texts, reading and filling the on-disk cache.
+    Each distinct text is processed at most once.
+    :param cache_path: sqlite file of the cache, None disables caching
+    :param workers: processes used for the texts missing from the cache, see processing_pipeline_parallel
+    :param cache: open PreprocessCache to use instead of opening cache_path, left open
+    :param pool: PipelinePool to use, left open
+    :return: list of processed texts, in the order of raw_list
+    """
+    unique = list(set(raw_list))
+    own_cache = cache is None and cache_path is not None
+    if own_cache:
+        cache = PreprocessCache(cache_path)
+    done = {}
+    try:
+        if cache is not None:
+            done = cache.get_many(unique)
+        missing = [raw for raw in unique if raw not in done]
+        print('preprocessing: {} texts, {} distinct, {} cached'.format(len(raw_list), len(unique), len(done)))
 
-# print(processing_pipelie('e day હત ા શ ા ર ો ગ મ ા ટ ે હ ો મ ી ય ો પ ે થ ી homeop'))
\ No newline at end of file
+        processed = processing_pipeline_parallel(missing, workers, pool)
+        done.update(zip(missing, processed))
+        if cache is not None and missing:
+            cache.put_many(zip(missing, processed))
+    finally:
+        if own_cache:
+            cache.close()
+    return [done[raw] for raw in raw_list]